@@ -0,0 +1,202 @@
+import collections
+import contextlib
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import metrics
+
+# Admission control in front of the purchase path (purchases, holds and
+# waitlist joins). Each event has a token bucket that lets at most `rate`
+# purchases a second (plus a burst) reach the booking engine. Purchases beyond that wait in a bounded queue that is
+# served round-robin across customers, so one account firing many requests
+# cannot starve the others. A full queue, or a wait longer than max_wait,
+# is answered at once with Overloaded and a retry-after hint instead of
+# letting every caller slow down together.
+
+ADMITTED = metrics.counter("admission_admitted_total", "Purchases let through admission control")
+REJECTED = metrics.counter("admission_rejected_total", "Purchases turned away by admission control", ("reason",))
+QUEUE_SECONDS = metrics.histogram("admission_queue_seconds", "Time purchases waited for admission")
+
+
+class Overloaded(ValueError):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Too many purchases for this event right now; retry in {retry_after:.1f}s.")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float, clock: Callable[[], float] = time.monotonic):
+        self._rate = rate
+        self._burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._stamp = clock()
+
+    def _refill(self) -> float:
+        now = self._clock()
+        self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self._rate)
+        self._stamp = now
+        return self._tokens
+
+    def try_take(self) -> bool:
+        if self._refill() >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    # Seconds until the next token; 0 if one is available now
+    def wait_time(self) -> float:
+        return max(0.0, (1 - self._refill()) / self._rate)
+
+    def get_rate(self) -> float:
+        return self._rate
+
+
+# Waiting purchases for one event: a deque per customer, and the customers
+# with something queued in round-robin order. Everything here is guarded by
+# cond, so busy events don't hold each other up.
+class _EventGate:
+    def __init__(self, bucket: TokenBucket):
+        self.cond = threading.Condition()
+        self.bucket = bucket
+        self.turns: Dict[str, collections.deque] = collections.OrderedDict()
+        self.size = 0
+        self.in_flight: Dict[str, int] = collections.Counter()  # tickets per customer queued or being bought
+
+    def head(self) -> Optional[object]:
+        for queue in self.turns.values():
+            return queue[0]
+        return None
+
+    def remove(self, username: str, ticket: object):
+        queue = self.turns[username]
+        queue.remove(ticket)
+        self.size -= 1
+        if not queue:
+            del self.turns[username]
+
+    # The head customer was served; it goes to the back of the line
+    def rotate(self, username: str):
+        queue = self.turns.pop(username)
+        queue.popleft()
+        self.size -= 1
+        if queue:
+            self.turns[username] = queue
+
+
+class AdmissionController:
+    def __init__(self, rate: float = 200.0, burst: float = 20.0, queue_size: int = 64,
+                 per_customer: int = 2, max_wait: float = 1.0, max_tickets: Optional[int] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self._rate = rate  # purchases per second per event
+        self._burst = burst
+        self._queue_size = queue_size  # waiting purchases per event
+        self._per_customer = per_customer  # waiting purchases per customer and event
+        self._max_wait = max_wait
+        self._max_tickets = max_tickets  # per account and event, None for no limit
+        self._clock = clock
+        self._gates: Dict[str, _EventGate] = {}
+        self._gates_lock = threading.Lock()
+
+    def get_max_tickets(self) -> Optional[int]:
+        return self._max_tickets
+
+    def _gate(self, event_id: str) -> _EventGate:
+        gate = self._gates.get(event_id)
+        if gate is None:
+            with self._gates_lock:
+                gate = self._gates.get(event_id)
+                if gate is None:
+                    gate = self._gates[event_id] = _EventGate(TokenBucket(self._rate, self._burst, self._clock))
+        return gate
+
+    def _reject(self, reason: str, retry_after: float):
+        REJECTED.labels(reason).inc()
+        raise Overloaded(retry_after)
+
+    # with controller.admit(username, event_id, qty, owned): purchase...
+    # owned() returns how many tickets for the event the customer already
+    # has; it is called under the event's gate lock, where a finished purchase
+    # is either still in flight or already owned, so it should only read
+    # counts kept up to date elsewhere. Raises ValueError
+    # over the per-account limit and Overloaded when the event's queue is
+    # full or the wait would exceed max_wait.
+    @contextlib.contextmanager
+    def admit(self, username: str, event_id: str, qty: int, owned: Optional[Callable[[], int]] = None):
+        start = self._clock()
+        gate = self._gate(event_id)
+        with gate.cond:
+            if self._max_tickets is not None:
+                have = (owned() if owned is not None else 0) + gate.in_flight[username]
+                if have + qty > self._max_tickets:
+                    REJECTED.labels("ticket limit").inc()
+                    raise ValueError(f"At most {self._max_tickets} tickets per customer for this event.")
+            # Counted from the start, so requests waiting together can't pass the limit
+            gate.in_flight[username] += qty
+            try:
+                if gate.size or not gate.bucket.try_take():
+                    self._wait_turn(gate, username, start)
+            except BaseException:
+                self._done(gate, username, qty)
+                raise
+        ADMITTED.inc()
+        QUEUE_SECONDS.observe(self._clock() - start)
+        try:
+            yield
+        finally:
+            with gate.cond:
+                self._done(gate, username, qty)
+
+    # Called with the gate's condition held
+    def _done(self, gate: _EventGate, username: str, qty: int):
+        gate.in_flight[username] -= qty
+        if not gate.in_flight[username]:
+            del gate.in_flight[username]
+
+    # Called with the gate's condition held; returns once this purchase has a token
+    def _wait_turn(self, gate: _EventGate, username: str, start: float):
+        queue = gate.turns.get(username)
+        if gate.size >= self._queue_size or (queue is not None and len(queue) >= self._per_customer):
+            self._reject("queue full", (gate.size + 1) / self._rate)
+        # The queue drains at `rate`; a wait past max_wait is refused up front
+        if gate.size / self._rate > self._max_wait:
+            self._reject("queue full", gate.size / self._rate - self._max_wait)
+        ticket = object()
+        gate.turns.setdefault(username, collections.deque()).append(ticket)
+        gate.size += 1
+        deadline = start + self._max_wait
+        while True:
+            if gate.head() is ticket and gate.bucket.try_take():
+                gate.rotate(username)
+                gate.cond.notify_all()
+                return
+            now = self._clock()
+            if now >= deadline:
+                gate.remove(username, ticket)
+                gate.cond.notify_all()
+                self._reject("timeout", gate.size / self._rate)
+            timeout = deadline - now
+            if gate.head() is ticket:
+                timeout = min(timeout, gate.bucket.wait_time())
+            gate.cond.wait(timeout)
+
+
+# Shared --admission flags for the server and the load generator
+def add_arguments(parser):
+    parser.add_argument("--admission", action="store_true",
+                        help="rate-limit and fairly queue purchases per event")
+    parser.add_argument("--admission-rate", type=float, default=200.0,
+                        help="purchases per second let through per event")
+    parser.add_argument("--admission-burst", type=float, default=20.0)
+    parser.add_argument("--admission-queue", type=int, default=64, help="waiting purchases per event")
+    parser.add_argument("--admission-wait", type=float, default=1.0,
+                        help="longest a purchase may wait before it is turned away, in seconds")
+    parser.add_argument("--max-tickets", type=int, help="tickets per customer and event")
+
+
+def from_args(args) -> Optional[AdmissionController]:
+    if not args.admission:
+        return None
+    return AdmissionController(args.admission_rate, args.admission_burst, args.admission_queue,
+                               max_wait=args.admission_wait, max_tickets=args.max_tickets)
@@ -0,0 +1,138 @@
+import argparse
+import itertools
+import json
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import profiling
+from objects import Admin
+from service import BookingService, reservation_to_dict
+from sqlite_storage import SQLiteBackend
+
+# Offline replay of box-office batches and partner bulk orders. Input is a
+# JSON-lines file with one operation per line:
+#   {"op": "create_account", "username": "...", "password": "...", "name": "..."}
+#   {"op": "purchase", "username": "...", "event": "E1", "ticket_type": "...", "qty": 2, "method": "..."}
+#   {"op": "cancel", "username": "...", "reservation_id": "..."}
+#   {"op": "set_discount", "ticket_type": "...", "amount": 5.0}
+# Lines are streamed through a generator pipeline; each batch of operations
+# is journaled with one write per file.
+
+
+def read_requests(stream: Iterable[str]) -> Iterator[Tuple[int, object]]:
+    # Yields (line number, parsed request or the ValueError raised parsing it)
+    for lineno, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield lineno, json.loads(line)
+        except ValueError as e:
+            yield lineno, e
+
+
+def chunked(items: Iterable, size: int) -> Iterator[List]:
+    it = iter(items)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BatchProcessor:
+    def __init__(self, service: BookingService, batch_size: int = 500):
+        self._service = service
+        self._batch_size = batch_size
+        self._admin = Admin("batch", "", "Batch Processor")
+
+    def process(self, requests: Iterable[Tuple[int, object]]) -> Iterator[Dict]:
+        for chunk in chunked(requests, self._batch_size):
+            # Results are held until the batch's journal write has happened
+            with self._service.batch():
+                results = [self.execute(lineno, request) for lineno, request in chunk]
+            yield from results
+
+    def execute(self, lineno: int, request) -> Dict:
+        try:
+            if isinstance(request, Exception):
+                raise ValueError(f"Malformed JSON: {request}")
+            if not isinstance(request, dict):
+                raise ValueError("Request must be a JSON object")
+            return {"line": lineno, "ok": True, "result": self._apply(request)}
+        except KeyError as e:
+            return {"line": lineno, "ok": False, "error": f"Missing field: {e.args[0]}"}
+        except (ValueError, TypeError) as e:
+            return {"line": lineno, "ok": False, "error": str(e)}
+
+    def _customer(self, request: Dict):
+        customer = self._service.get_customers().get(request["username"])
+        if customer is None:
+            raise ValueError(f"Unknown customer: {request['username']}")
+        return customer
+
+    def _apply(self, request: Dict):
+        op = request.get("op")
+        service = self._service
+        if op == "create_account":
+            customer = service.create_account(request["username"], request["password"], request.get("name"))
+            return {"username": customer.get_username()}
+        if op == "purchase":
+            customer = self._customer(request)
+            event = service.find_event(request["event"])
+            if event is None:
+                raise ValueError(f"Unknown event: {request['event']}")
+            res = service.purchase(customer, event, request["ticket_type"], int(request["qty"]),
+                                   request.get("method", "Credit Card"))
+            return reservation_to_dict(res)
+        if op == "cancel":
+            if not service.cancel(self._customer(request), request["reservation_id"]):
+                raise ValueError("No such reservation.")
+            return None
+        if op == "set_discount":
+            service.set_discount(self._admin, request["ticket_type"], float(request["amount"]))
+            return None
+        raise ValueError(f"Unknown op: {op}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a JSON-lines file of booking operations")
+    parser.add_argument("input", help="JSON-lines file, or - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="per-line results (default: stdout)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--data-dir", default=".")
+    parser.add_argument("--db", help="use this SQLite database instead of the pickle files")
+    parser.add_argument("--cache-size", type=int,
+                        help="load reservations on demand, keeping this many customers in memory")
+    profiling.add_arguments(parser)
+    args = parser.parse_args(argv)
+    profiling.configure_from_args(args)
+
+    backend = SQLiteBackend(args.db, args.cache_size) if args.db else None
+    service = BookingService(args.data_dir, backend, args.cache_size)
+    processor = BatchProcessor(service, args.batch_size)
+    src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    count = failed = 0
+    start = time.perf_counter()
+    try:
+        for result in processor.process(read_requests(src)):
+            out.write(json.dumps(result) + "\n")
+            count += 1
+            failed += not result["ok"]
+    finally:
+        # Final snapshot, as when the GUI or server shuts down
+        service.close()
+        if src is not sys.stdin:
+            src.close()
+        if out is not sys.stdout:
+            out.close()
+        profiling.close()
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {count} operations ({failed} failed) in {elapsed:.2f}s: {rate:.0f} ops/sec",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,600 @@
+import argparse
+import datetime
+import json
+import os
+import pickle
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Optional
+
+import codec
+from booking import BookingEngine
+from service import BookingService
+from objects import (
+    Admin, Customer, CustomerRegistry, Event, EventCatalog, Payment, Reservation,
+    SingleRacePass, SystemManager, Ticket, TicketBlock
+)
+from pricing import PricingEngine, np
+from reports import ReportEngine
+from sqlite_storage import SQLiteBackend
+from storage import (
+    EVENTS_FILE, SHARD_MANIFEST, PickleBackend, dumps, loads, save_events, shard_file_name, shard_of,
+    write_customers, write_manifest
+)
+from views import ReservationRows
+
+TICKET_TYPES = [("SingleRacePass", 100.0), ("WeekendPackage", 180.0),
+                ("SeasonMembership", 800.0), ("GroupDiscount", 400.0)]
+
+
+def make_events(events: int):
+    return [Event(f"E{i}", f"Race {i}", f"2026-{1 + i % 12:02d}-{1 + i % 28:02d}", 10 ** 9)
+            for i in range(events)]
+
+
+# Customer c of a synthetic data set; reservation n of the whole set is
+# c * reservations_per_customer + j, spread round-robin over the events
+def make_customer(c: int, catalog, reservations_per_customer: int, methods=("Credit Card",)):
+    cust = Customer(f"user{c}", "pw", f"User {c}")
+    for j in range(reservations_per_customer):
+        n = c * reservations_per_customer + j
+        ttype, price = TICKET_TYPES[n % len(TICKET_TYPES)]
+        rid = cust.next_reservation_id()
+        qty = 1 + n % 4
+        res = Reservation(rid, catalog[n % len(catalog)], Payment(price * qty, methods[n % len(methods)]))
+        res.add_block(TicketBlock(rid, 1, qty, ttype, price,
+                                  group_size=qty if ttype == "GroupDiscount" else None))
+        cust.add_reservation(res)
+    return cust
+
+
+def make_dataset(customers: int, events: int, reservations_per_customer: int):
+    catalog = make_events(events)
+    registry = CustomerRegistry()
+    for c in range(customers):
+        registry.add(make_customer(c, catalog, reservations_per_customer))
+    return registry, catalog
+
+
+def best_of(fn, repeat: int = 5) -> float:
+    # Best wall-clock time of several runs, in seconds
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+# Per-ticket add_ticket/log_sale versus one add_tickets/log_sale per order
+def bench_ticket_allocation(order_size: int = 500, orders: int = 200):
+    tickets = [SingleRacePass(f"R_{i+1}", 100.0) for i in range(order_size)]
+
+    def per_ticket():
+        event = Event("E1", "Race", "2025-11-23", order_size * orders)
+        mgr = SystemManager()
+        for o in range(orders):
+            res = Reservation(f"R{o}", event, Payment(0.0, "card"))
+            for ticket in tickets:
+                res.add_ticket(ticket)
+                mgr.log_sale(event, 1)
+
+    def bulk():
+        event = Event("E1", "Race", "2025-11-23", order_size * orders)
+        mgr = SystemManager()
+        for o in range(orders):
+            res = Reservation(f"R{o}", event, Payment(0.0, "card"))
+            res.add_tickets(tickets)
+            mgr.log_sale(event, order_size)
+
+    return {"per_ticket": best_of(per_ticket), "bulk": best_of(bulk)}
+
+
+# Purchases per second through BookingEngine as the worker thread count grows
+def bench_concurrent_booking(thread_counts=(1, 2, 4, 8, 16), purchases_per_thread: int = 2000,
+                             events: int = 8):
+    results = {}
+    for n_threads in thread_counts:
+        total = n_threads * purchases_per_thread
+        catalog = [Event(f"E{i}", f"Race {i}", "2025-11-23", total) for i in range(events)]
+        engine = BookingEngine(SystemManager())
+
+        def worker(customer):
+            for n in range(purchases_per_thread):
+                engine.purchase(customer, catalog[n % events], "SingleRacePass", 1, 100.0, "card")
+
+        threads = [threading.Thread(target=worker, args=(Customer(f"user{t}", "pw", "u"),))
+                   for t in range(n_threads)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        sold = sum(e.get_tickets_sold() for e in catalog)
+        assert sold == total, "oversold or lost purchases"
+        results[f"{n_threads} threads"] = total / elapsed
+    return results
+
+
+# Full save, full load and one incremental purchase for each storage backend.
+# The 1M reservation run takes a minute or two and about 2 GiB of memory.
+STORAGE_SIZES = (10_000, 100_000, 1_000_000)
+
+
+def bench_storage_backends(sizes=STORAGE_SIZES, reservations_per_customer: int = 10):
+    results = {}
+    for size in sizes:
+        customers, events = make_dataset(max(1, size // reservations_per_customer), 50,
+                                         reservations_per_customer)
+        extra = Customer("extra", "pw", "extra")
+        customers.add(extra)
+        for name in ("pickle", "sqlite"):
+            with tempfile.TemporaryDirectory() as tmp:
+                if name == "pickle":
+                    backend = PickleBackend(tmp)
+                else:
+                    backend = SQLiteBackend(os.path.join(tmp, "booking.db"))
+                backend.save_events(events)
+                start = time.perf_counter()
+                backend.save_customers(customers)
+                save = time.perf_counter() - start
+                start = time.perf_counter()
+                backend.load_events()
+                backend.load_customers()
+                load = time.perf_counter() - start
+                start = time.perf_counter()
+                for i in range(100):
+                    res = Reservation(f"extra_{i}", events[0], Payment(100.0, "card"))
+                    res.add_block(TicketBlock(f"extra_{i}", 1, 1, "SingleRacePass", 100.0))
+                    backend.reservation_added(extra, res)
+                purchase = (time.perf_counter() - start) / 100
+                backend.close()
+            results[f"{name} {size} save"] = save
+            results[f"{name} {size} load"] = load
+            results[f"{name} {size} purchase"] = purchase
+    return results
+
+
+# Price a large batch of order lines: the old per-order dict lookups in
+# calculate_discounts, the compiled table line by line, and column-at-a-time
+def bench_pricing(lines: int = 1_000_000):
+    rng = random.Random(7)
+    prices = dict(TICKET_TYPES)
+    flat = {"SingleRacePass": 5.0, "WeekendPackage": 10.0}
+    rules = [{"ticket_type": "SingleRacePass", "percent": 10, "min_qty": 5},
+             {"percent": 5, "min_qty": 20, "max_qty": 49},
+             {"min_group": 10, "flat": 25.0},
+             {"percent": 15, "start": "2025-09-01", "end": "2025-09-07"}]
+    engine = PricingEngine(prices, rules, flat)
+    types = engine.get_ticket_types()
+    dates = [(datetime.date(2025, 8, 1) + datetime.timedelta(days=i)).isoformat() for i in range(60)]
+    batch = [(rng.choice(types), rng.randint(1, 60), rng.choice(dates)) for _ in range(lines)]
+    manager = SystemManager(None)
+    manager.set_discount_rules(flat)
+    samples = {t: Ticket("quote", p, t) for t, p in prices.items()}
+
+    def legacy():
+        return [(prices[t] - manager.calculate_discounts(samples[t])) * q for t, q, _ in batch]
+
+    results = {"legacy flat discounts": best_of(legacy, 1),
+               "compiled price_lines": best_of(lambda: engine.price_lines(batch), 1)}
+    columns = ([types.index(t) for t, _, _ in batch], [q for _, q, _ in batch],
+               [datetime.date.fromisoformat(d).toordinal() for _, _, d in batch])
+    label = "compiled price_columns" + (" (numpy)" if np is not None else "")
+    results[label] = best_of(lambda: engine.price_columns(*columns), 1)
+    return results
+
+
+# Startup of the pickle backend, eager versus lazy: time to load the
+# customers, then memory held after serving `active` customers' reservations
+def bench_lazy_loading(customers: int = 20_000, reservations_per_customer: int = 10, active: int = 100):
+    registry, _ = make_dataset(customers, 50, reservations_per_customer)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        PickleBackend(tmp).save_customers(registry)
+        PickleBackend(tmp, cache_size=active).load_customers()  # writes the lazy snapshot
+        for name, cache_size in (("eager", None), ("lazy", active)):
+            load = best_of(lambda: PickleBackend(tmp, cache_size=cache_size).load_customers(), 3)
+            tracemalloc.start()
+            loaded = PickleBackend(tmp, cache_size=cache_size).load_customers()
+            for c in range(0, customers, max(1, customers // active)):
+                loaded.get(f"user{c}").get_reservations()
+            memory, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[f"{name} startup"] = load
+            results[f"{name} memory"] = memory
+    return results
+
+
+# Reservations pickled one at a time, as journal records and lazy snapshot
+# blobs are: with each event embedded (a private Event copy per reservation
+# after loading) versus referenced by id and resolved to the shared event
+def bench_event_sharing(reservations: int = 100_000, events: int = 10):
+    registry, catalog = make_dataset(max(1, reservations // 10), events, 10)
+    table = {e.get_event_id(): e for e in catalog}
+    all_res = [r for c in registry for r in c.get_reservations()]
+    results = {}
+    for name, refs in (("embedded", None), ("by id", table)):
+        records = [dumps(r, refs) for r in all_res]
+        tracemalloc.start()
+        loaded = [loads(b, refs) for b in records]
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert refs is None or all(r.get_event() is table[r.get_event().get_event_id()] for r in loaded)
+        results[f"{name} load"] = best_of(lambda: [loads(b, refs) for b in records], 3)
+        results[f"{name} memory"] = memory
+        results[f"{name} size"] = sum(len(b) for b in records)
+    return results
+
+
+# Latency of single purchases, as a GUI action sees it, with journal
+# compactions written inline versus by the background writer
+def bench_action_latency(sizes=(1_000, 20_000), actions: int = 1000, compact_threshold: int = 250):
+    results = {}
+    for size in sizes:
+        registry, events = make_dataset(size, 50, 10)
+        for mode, delay in (("inline", None), ("background", 0.05)):
+            with tempfile.TemporaryDirectory() as tmp:
+                seed = PickleBackend(tmp)
+                seed.save_events(events)
+                seed.save_customers(registry)
+                service = BookingService(backend=PickleBackend(tmp, compact_threshold, write_delay=delay))
+                customer = service.login("user0", "pw")
+                event = service.find_event("E0")
+                latencies = []
+                for _ in range(actions):
+                    start = time.perf_counter()
+                    service.purchase(customer, event, "SingleRacePass", 1, "Credit Card")
+                    latencies.append(time.perf_counter() - start)
+                service.close()
+            latencies.sort()
+            results[f"{mode} {size} p50"] = latencies[len(latencies) // 2]
+            results[f"{mode} {size} max"] = latencies[-1]
+    return results
+
+
+# Time to persist one purchase by compacting the journal: the single file
+# is rewritten whole, the sharded layout rewrites one shard. Loading times
+# are for the whole data directory.
+def bench_sharded_saves(sizes=(10_000, 50_000), shards: int = 16, reservations_per_customer: int = 5):
+    results = {}
+    for size in sizes:
+        registry, events = make_dataset(size, 50, reservations_per_customer)
+        for mode, count in (("single", None), (f"{shards} shards", shards)):
+            with tempfile.TemporaryDirectory() as tmp:
+                seed = PickleBackend(tmp, shards=count)
+                seed.save_events(events)
+                seed.save_customers(registry)
+                backend = PickleBackend(tmp)
+                service = BookingService(backend=backend)
+                store = backend.get_customer_store()
+                customer = service.login("user0", "pw")
+                event = service.find_event("E0")
+
+                def save():
+                    service.purchase(customer, event, "SingleRacePass", 1, "Credit Card")
+                    store.compact()
+
+                results[f"{mode} {size} save"] = best_of(save, 3)
+                results[f"{mode} {size} load"] = best_of(lambda: PickleBackend(tmp).load_customers(), 3)
+    return results
+
+
+# Customer snapshot encoded with the binary codec versus pickle protocol 5
+def bench_codec(customers: int = 20_000, reservations_per_customer: int = 10):
+    registry, events = make_dataset(customers, 50, reservations_per_customer)
+    data = list(registry)
+    table = {e.get_event_id(): e for e in events}
+    formats = (
+        ("pickle 5", lambda: pickle.dumps(data, protocol=5), pickle.loads),
+        ("codec", lambda: codec.encode_customers(data, table), lambda b: codec.decode(b, table)),
+        ("codec zlib", lambda: codec.encode_customers(data, table, compress=True),
+         lambda b: codec.decode(b, table)),
+    )
+    results = {}
+    for name, save, load in formats:
+        blob = save()
+        results[f"{name} save"] = best_of(save, 3)
+        results[f"{name} load"] = best_of(lambda: load(blob), 3)
+        results[f"{name} size"] = len(blob)
+    return results
+
+
+# 100k holds placed from several threads, then swept as they expire one
+# second at a time: the heap only touches the holds that are due, a full
+# scan of the active holds looks at all of them on every tick
+def bench_holds(holds: int = 100_000, n_threads: int = 8, events: int = 100, ttl_spread: int = 100):
+    clock = [0.0]
+    engine = BookingEngine(SystemManager(), clock=lambda: clock[0])
+    catalog = [Event(f"E{i}", f"Race {i}", "2025-11-23", holds) for i in range(events)]
+    per_thread = holds // n_threads
+    placed = [[] for _ in range(n_threads)]
+
+    def worker(t):
+        customer = Customer(f"user{t}", "pw", "u")
+        for n in range(per_thread):
+            placed[t].append(engine.hold(customer, catalog[n % events], 1,
+                                         ttl=1 + (t * per_thread + n) % ttl_spread))
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(n_threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    place = time.perf_counter() - start
+    book = engine.get_holds()
+    active = [hold for hs in placed for hold in hs]
+    assert len(book) == len(active)
+    idle = best_of(lambda: book.expire_due(0.5), 1000)
+
+    def full_scan():
+        for tick in range(1, ttl_spread + 1):
+            [h for h in active if h.get_expires_at() <= tick]
+
+    scan = best_of(full_scan, 1) / ttl_spread
+    start = time.perf_counter()
+    expired = 0
+    for tick in range(1, ttl_spread + 1):
+        clock[0] = tick
+        expired += book.expire_due()
+    heap = (time.perf_counter() - start) / ttl_spread
+    assert expired == len(active) and sum(e.get_held() for e in catalog) == 0
+    return {f"place {len(active)} holds ({n_threads} threads)": place,
+            "heap sweep per tick": heap,
+            "full scan per tick": scan,
+            "heap check, nothing due": idle}
+
+
+# Opening the reservation view and filling the event box: every row and
+# event name formatted up front versus one visible page and a type-ahead search
+def bench_views(sizes=(100, 10_000), page: int = 15):
+    results = {}
+    for size in sizes:
+        registry, events = make_dataset(1, 20, size)
+        customer = next(iter(registry))
+        rows = ReservationRows()
+
+        def first_open():
+            rows.set_customer(None)
+            rows.set_customer(customer)
+            rows.rows(0, page)
+
+        results[f"{size} reservations full list"] = best_of(
+            lambda: [f"ID: {r.get_reservation_id()} | Event: {r.get_event().get_name()} | "
+                     f"Total: ${r.get_total_price():.2f}" for r in customer.get_reservations()])
+        results[f"{size} reservations first page"] = best_of(first_open)
+        results[f"{size} reservations reopen"] = best_of(lambda: rows.rows(0, page))
+        catalog = EventCatalog([Event(f"E{i}", f"Race {i}", f"2026-{1 + i % 12:02d}-{1 + i % 28:02d}", 100)
+                                for i in range(size)])
+        results[f"{size} events full list"] = best_of(lambda: [e.get_name() for e in catalog])
+        results[f"{size} events search"] = best_of(lambda: catalog.search("race 12", 50))
+    return results
+
+
+# The customer report over a sharded data directory with 1 to N worker
+# processes. The data set is written one shard at a time, so it never sits
+# in this process all at once.
+def bench_reports(reservations: int = 1_000_000, worker_counts=None, shards: int = 32,
+                  reservations_per_customer: int = 5):
+    cores = os.cpu_count() or 1
+    if worker_counts is None:
+        worker_counts = sorted({2 ** i for i in range(cores.bit_length()) if 2 ** i <= cores} | {cores})
+    customers = reservations // reservations_per_customer
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        catalog = make_events(50)
+        table = {e.get_event_id(): e for e in catalog}
+        save_events(os.path.join(tmp, EVENTS_FILE), catalog)
+        members = [[] for _ in range(shards)]
+        for c in range(customers):
+            members[shard_of(f"user{c}", shards)].append(c)
+        files = [shard_file_name(i, shards) for i in range(shards)]
+        for name, shard in zip(files, members):
+            write_customers(os.path.join(tmp, name), [make_customer(c, catalog, reservations_per_customer,
+                                                                    ("Credit Card", "Debit Card", "PayPal"))
+                                                      for c in shard], table)
+        write_manifest(os.path.join(tmp, SHARD_MANIFEST), files)
+        expected = None
+        for workers in worker_counts:
+            engine = ReportEngine(workers)
+            report = engine.report_data_dir(tmp)
+            assert report["reservations"] == customers * reservations_per_customer
+            assert expected is None or report["by_method"] == expected
+            expected = report["by_method"]
+            results[f"{workers} worker(s)"] = best_of(lambda: engine.report_data_dir(tmp), 3)
+    return results
+
+
+# Micro-benchmark suite: every entry times one operation on a synthetic
+# data set, in seconds per call, so runs can be saved as a JSON baseline
+# and compared later (see compare_results)
+BASELINE_FILE = "benchmark_baseline.json"
+SUITE_CONFIG = {"customers": 2000, "events": 20, "reservations_per_customer": 5, "repeat": 5}
+
+
+def run_suite(customers: int = 2000, events: int = 20, reservations_per_customer: int = 5,
+              repeat: int = 5, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    registry, catalog = make_dataset(customers, events, reservations_per_customer)
+    usernames = [f"user{rng.randrange(customers)}" for _ in range(1000)]
+    orders = [(rng.choice(usernames), f"E{rng.randrange(events)}", TICKET_TYPES[rng.randrange(4)][0],
+               1 + rng.randrange(4)) for _ in range(200)]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        seed_backend = PickleBackend(tmp)
+        seed_backend.save_events(catalog)
+        seed_backend.save_customers(registry)
+        # Journal compactions are timed by save_customers, not inside purchases
+        backend = PickleBackend(tmp, compact_threshold=10 ** 9)
+        service = BookingService(backend=backend)
+
+        def login():
+            for username in usernames:
+                service.login(username, "pw")
+
+        def purchase():
+            for username, event_id, ttype, qty in orders:
+                customer = service.login(username, "pw")
+                res = service.purchase(customer, service.find_event(event_id), ttype, qty, "Credit Card")
+                service.cancel(customer, res.get_reservation_id())
+
+        results["login"] = best_of(login, repeat) / len(usernames)
+        results["purchase and cancel"] = best_of(purchase, repeat) / len(orders)
+        results["save_customers"] = best_of(lambda: backend.save_customers(service.get_customers()), repeat)
+        results["load_customers"] = best_of(lambda: PickleBackend(tmp).load_customers(), repeat)
+
+        mgr = SystemManager(os.path.join(tmp, "system_data.pkl"))
+        for customer in registry:
+            for res in customer.get_reservations():
+                mgr.log_reservation(res)
+        admin = Admin("admin", "admin", "Administrator")
+        results["SystemManager.save_data"] = best_of(mgr.save_data, repeat)
+        results["SystemManager.load_data"] = best_of(mgr.load_data, repeat)
+        results["sales report"] = best_of(lambda: admin.view_sales_report(mgr, detailed=True), repeat)
+        results["rebuild_analytics"] = best_of(lambda: mgr.rebuild_analytics(registry), repeat)
+    return results
+
+
+# Storage backend timings recorded next to the suite by `benchmarks.py storage
+# -o`; they are kept when the suite is saved again but not compared
+def save_baseline(path: str, config: dict, results: dict, storage: Optional[dict] = None):
+    if storage is None and os.path.exists(path):
+        storage = load_baseline(path).get("storage")
+    data = {"config": config, "python": platform.python_version(), "results": results}
+    if storage is not None:
+        data["storage"] = storage
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def save_storage_baseline(path: str, sizes, results: dict):
+    baseline = load_baseline(path)
+    storage = {"sizes": list(sizes), "python": platform.python_version(), "results": results}
+    save_baseline(path, baseline["config"], baseline["results"], storage)
+
+
+def load_baseline(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+# (name, baseline seconds, current seconds) for every benchmark more than
+# `threshold` (a fraction, 0.25 = 25%) slower than its baseline
+def compare_results(baseline: dict, current: dict, threshold: float = 0.25) -> list:
+    return [(name, baseline[name], seconds) for name, seconds in current.items()
+            if name in baseline and seconds > baseline[name] * (1 + threshold)]
+
+
+def _report_suite(baseline: dict, current: dict, regressions: list):
+    slower = {name for name, _, _ in regressions}
+    print(f"  {'benchmark':<28} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, seconds in current.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"  {name:<28} {'-':>12} {seconds * 1e6:9.1f} us")
+            continue
+        change = (seconds / base - 1) * 100 if base else 0.0
+        flag = "  REGRESSION" if name in slower else ""
+        print(f"  {name:<28} {base * 1e6:9.1f} us {seconds * 1e6:9.1f} us {change:+7.1f}%{flag}")
+
+
+def _report(name: str, results: dict):
+    print(name)
+    for label, seconds in results.items():
+        print(f"  {label:<28} {seconds * 1000:10.2f} ms")
+
+
+def _report_rate(name: str, results: dict):
+    print(name)
+    for label, rate in results.items():
+        print(f"  {label:<28} {rate:10.0f} ops/s")
+
+
+def _report_memory(name: str, results: dict):
+    print(name)
+    for label, value in results.items():
+        if label.endswith(("memory", "size")):
+            print(f"  {label:<28} {value / 2 ** 20:10.2f} MiB")
+        else:
+            print(f"  {label:<28} {value * 1000:10.2f} ms")
+
+
+def _suite_main(args) -> int:
+    if args.command == "suite":
+        config = {"customers": args.customers, "events": args.events,
+                  "reservations_per_customer": args.reservations, "repeat": args.repeat}
+        results = run_suite(**config)
+        _report_suite({}, results, [])
+        if args.output:
+            save_baseline(args.output, config, results)
+        return 0
+    if args.command == "storage":
+        results = bench_storage_backends(args.sizes)
+        _report("storage backends", results)
+        if args.output:
+            save_storage_baseline(args.output, args.sizes, results)
+        return 0
+    baseline = load_baseline(args.baseline)
+    results = run_suite(**baseline["config"])
+    regressions = compare_results(baseline["results"], results, args.threshold)
+    _report_suite(baseline["results"], results, regressions)
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) more than {args.threshold:.0%} slower than {args.baseline}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Booking system benchmarks")
+    commands = parser.add_subparsers(dest="command")
+    suite = commands.add_parser("suite", help="run the micro-benchmark suite")
+    suite.add_argument("--customers", type=int, default=SUITE_CONFIG["customers"])
+    suite.add_argument("--events", type=int, default=SUITE_CONFIG["events"])
+    suite.add_argument("--reservations", type=int, default=SUITE_CONFIG["reservations_per_customer"],
+                       help="reservations per customer")
+    suite.add_argument("--repeat", type=int, default=SUITE_CONFIG["repeat"])
+    suite.add_argument("-o", "--output", help=f"save the results as a baseline, e.g. {BASELINE_FILE}")
+    compare = commands.add_parser("compare", help="rerun the suite and flag regressions against a baseline")
+    compare.add_argument("--baseline", default=BASELINE_FILE)
+    compare.add_argument("--threshold", type=float, default=0.25,
+                         help="allowed slowdown as a fraction (default 0.25)")
+    storage = commands.add_parser("storage", help="run the storage backend benchmark only")
+    storage.add_argument("--sizes", type=int, nargs="*", default=list(STORAGE_SIZES),
+                         help="reservation counts (default: 10000 100000 1000000)")
+    storage.add_argument("-o", "--output", help=f"record the results in a saved baseline, e.g. {BASELINE_FILE}")
+    parser.add_argument("--order-size", type=int, default=500)
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--storage-sizes", type=int, nargs="*", default=list(STORAGE_SIZES),
+                        help="reservation counts for the storage benchmark (default: 10000 100000 1000000)")
+    parser.add_argument("--pricing-lines", type=int, default=1_000_000)
+    parser.add_argument("--lazy-customers", type=int, default=20_000)
+    parser.add_argument("--report-reservations", type=int, default=1_000_000)
+    parser.add_argument("--report-workers", type=int, nargs="*",
+                        help="worker counts for the report benchmark (default: 1, 2, 4... up to the cores)")
+    args = parser.parse_args()
+    if args.command is not None:
+        sys.exit(_suite_main(args))
+
+    _report(f"ticket allocation ({args.orders} orders x {args.order_size} tickets)",
+            bench_ticket_allocation(args.order_size, args.orders))
+    _report_rate("concurrent booking", bench_concurrent_booking())
+    _report("storage backends", bench_storage_backends(args.storage_sizes))
+    _report(f"pricing ({args.pricing_lines} order lines)", bench_pricing(args.pricing_lines))
+    _report_memory(f"lazy loading ({args.lazy_customers} customers, 100 active)",
+                   bench_lazy_loading(args.lazy_customers))
+    _report_memory("event sharing (100000 reservations, 10 events)", bench_event_sharing())
+    _report("purchase latency (customers)", bench_action_latency())
+    _report("sharded saves (customers)", bench_sharded_saves())
+    _report_memory("snapshot codec (20000 customers x 10 reservations)", bench_codec())
+    _report("GUI list views", bench_views())
+    _report("seat holds (100000 holds expiring over 100 s)", bench_holds())
+    _report(f"customer report ({args.report_reservations} reservations, {os.cpu_count()} cores)",
+            bench_reports(args.report_reservations, args.report_workers or None))
@@ -0,0 +1,296 @@
+import collections
+import contextlib
+import threading
+import time
+import zlib
+from typing import Callable, Dict, Iterable, List, Optional
+
+from holds import HOLD_TTL, HoldBook, SeatHold
+from objects import SOLD_OUT, Customer, Event, Payment, Reservation, SystemManager, TicketBlock
+from storage import StorageBackend
+from waitlist import Waitlist, WaitlistEntry
+
+
+# Tickets per customer and event, for per-account limits. Booked tickets are
+# counted from a customer's reservations the first time they are asked for
+# and kept up to date under the customer's lock from then on; held and
+# waitlisted tickets are counted as they come and go.
+class _Claims:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._booked: Dict[str, collections.Counter] = {}
+        self._pending: Dict[str, collections.Counter] = {}
+
+    def counts_booked(self, username: str) -> bool:
+        return username in self._booked
+
+    # Called with the customer's lock held
+    def count_booked(self, username: str, reservations: Iterable[Reservation]):
+        counts = collections.Counter()
+        for res in reservations:
+            counts[res.get_event().get_event_id()] += res.get_ticket_count()
+        with self._lock:
+            self._booked[username] = counts
+
+    def get(self, username: str, event_id: str) -> int:
+        with self._lock:
+            booked = self._booked.get(username)
+            pending = self._pending.get(username)
+            return (booked[event_id] if booked else 0) + (pending[event_id] if pending else 0)
+
+    # Called with the customer's lock held; a no-op until the customer is counted
+    def add_booked(self, username: str, event_id: str, qty: int):
+        with self._lock:
+            counts = self._booked.get(username)
+            if counts is not None:
+                counts[event_id] += qty
+                if not counts[event_id]:
+                    del counts[event_id]
+
+    def add_pending(self, username: str, event_id: str, qty: int):
+        with self._lock:
+            counts = self._pending.setdefault(username, collections.Counter())
+            counts[event_id] += qty
+            if not counts[event_id]:
+                del counts[event_id]
+                if not counts:
+                    del self._pending[username]
+
+
+# Thread-safe purchase path. Locks are striped by event id so purchases for
+# different events run in parallel while purchases for the same event
+# serialize on its capacity check. A second set of stripes keyed by username
+# keeps reservation ids unique when one customer buys from several threads.
+# Seats can also be held for hold_ttl seconds and bought later with
+# confirm_hold; holds that run out give their seats back. Seats coming back
+# go to the event's waitlist first; on_promoted(entry, reservation) is
+# called for every waitlist entry booked that way.
+# With a backend, every booking and cancellation is stored in one backend
+# transaction while the customer's and the event's locks are held, and is
+# taken back if that fails. Lock order is customer, event, backend
+# transaction, then SystemManager; nothing that holds a later lock waits
+# for an earlier one.
+class BookingEngine:
+    def __init__(self, system_manager: SystemManager, stripes: int = 64, hold_ttl: float = HOLD_TTL,
+                 clock=time.monotonic, on_promoted: Optional[Callable] = None,
+                 backend: Optional[StorageBackend] = None):
+        self._system_manager = system_manager
+        self._backend = backend
+        self._event_locks: List[threading.Lock] = [threading.Lock() for _ in range(stripes)]
+        self._customer_locks: List[threading.Lock] = [threading.Lock() for _ in range(stripes)]
+        self._hold_ttl = hold_ttl
+        self._holds = HoldBook(self._give_back, clock)
+        self._waitlist = Waitlist()
+        self._on_promoted = on_promoted
+        self._claims = _Claims()
+
+    @staticmethod
+    def _stripe(locks: List[threading.Lock], key: str) -> threading.Lock:
+        # crc32 rather than hash() so the stripe is stable across processes
+        return locks[zlib.crc32(key.encode()) % len(locks)]
+
+    def event_lock(self, event_id: str) -> threading.Lock:
+        return self._stripe(self._event_locks, event_id)
+
+    def customer_lock(self, username: str) -> threading.Lock:
+        return self._stripe(self._customer_locks, username)
+
+    def get_holds(self) -> HoldBook:
+        return self._holds
+
+    def get_waitlist(self) -> Waitlist:
+        return self._waitlist
+
+    # Tickets the customer has for the event: booked, held or waitlisted.
+    # The first call for a customer reads its reservations; later ones don't.
+    def get_claimed(self, customer: Customer, event: Event) -> int:
+        username = customer.get_username()
+        if not self._claims.counts_booked(username):
+            with self.customer_lock(username):
+                if not self._claims.counts_booked(username):
+                    self._claims.count_booked(username, customer.get_reservations())
+        return self._claims.get(username, event.get_event_id())
+
+    # Books qty tickets of one type; raises ValueError("Event sold out") and
+    # changes nothing if the event cannot seat the whole order. Without an
+    # explicit per-ticket discount, SystemManager's flat rule for the type applies.
+    # Lock order is always customer, then event.
+    def purchase(self, customer: Customer, event: Event, ticket_type: str,
+                 qty: int, unit_price: float, method: str,
+                 discount: Optional[float] = None) -> Reservation:
+        return self._book(customer, event, ticket_type, qty, unit_price, method, discount, held=False)
+
+    def _transaction(self):
+        return self._backend.batch() if self._backend is not None else contextlib.nullcontext()
+
+    # held: the seats were already set aside by a hold. If storing the
+    # booking fails, the seats go back (held ones stay held) and the
+    # reservation and its sale are taken out of memory again.
+    def _book(self, customer: Customer, event: Event, ticket_type: str, qty: int, unit_price: float,
+              method: str, discount: Optional[float], held: bool) -> Reservation:
+        with self.customer_lock(customer.get_username()):
+            rid = customer.next_reservation_id()
+            block = TicketBlock(rid, 1, qty, ticket_type, unit_price,
+                                group_size=qty if ticket_type == "GroupDiscount" else None)
+            if discount is None:
+                discount = self._system_manager.calculate_discounts(block)
+            block.set_discount(discount)
+            res = Reservation(rid, event, Payment(block.get_discounted_total(), method))
+            with self.event_lock(event.get_event_id()):
+                if held:
+                    res.add_held_block(block)
+                else:
+                    res.add_block(block)
+                # Added before storing, so a lazy load can't read the stored reservation as well
+                customer.add_reservation(res)
+                logged = False
+                try:
+                    with self._transaction():
+                        self._system_manager.log_reservation(res)
+                        logged = True
+                        if self._backend is not None:
+                            self._backend.reservation_added(customer, res)
+                except BaseException:
+                    if held:
+                        event.unconfirm_hold(qty)
+                    else:
+                        event.release(qty)
+                    if logged:
+                        self._system_manager.forget_reservation(res)
+                    customer.delete_reservation(rid)
+                    raise
+                # Held seats were counted as pending when the hold or waitlist entry was made
+                self._claims.add_booked(customer.get_username(), event.get_event_id(), qty)
+                if held:
+                    self._claims.add_pending(customer.get_username(), event.get_event_id(), -qty)
+        return res
+
+    # Gives the reservation's seats back to the event and takes its sale out
+    # of the sales log, then seats whoever is waiting. None if there is no
+    # such reservation. If storing the cancellation fails, nothing changes.
+    def cancel(self, customer: Customer, reservation_id: str) -> Optional[Reservation]:
+        with self.customer_lock(customer.get_username()):
+            res = customer.get_reservation(reservation_id)
+            if res is None:
+                return None
+            event = res.get_event()
+            with self.event_lock(event.get_event_id()):
+                # Released first: the stored sold count is read from the event
+                event.release(res.get_ticket_count())
+                logged = False
+                try:
+                    with self._transaction():
+                        self._system_manager.log_cancellation(res)
+                        logged = True
+                        if self._backend is not None:
+                            self._backend.reservation_deleted(customer, reservation_id, event)
+                except BaseException:
+                    event.increment_tickets_sold(res.get_ticket_count())
+                    if logged:
+                        self._system_manager.forget_reservation(res, -1)
+                    raise
+            customer.delete_reservation(reservation_id)
+            self._claims.add_booked(customer.get_username(), event.get_event_id(), -res.get_ticket_count())
+        self._backfill(event)
+        return res
+
+    # Sets qty seats aside for the customer; raises ValueError("Event sold out")
+    # if fewer are left. The hold lasts ttl seconds (default hold_ttl).
+    def hold(self, customer: Customer, event: Event, qty: int, ttl: Optional[float] = None) -> SeatHold:
+        if qty <= 0:
+            raise ValueError("Quantity must be positive.")
+        self._holds.expire_due()
+        with self.event_lock(event.get_event_id()):
+            if not event.try_hold(qty):
+                SOLD_OUT.inc()
+                raise ValueError("Event sold out")
+        self._claims.add_pending(customer.get_username(), event.get_event_id(), qty)
+        hold = SeatHold(self._holds.next_id(), customer.get_username(), event, qty,
+                        self._holds.now() + (self._hold_ttl if ttl is None else ttl))
+        self._holds.add(hold)
+        return hold
+
+    # False if the hold has already expired or been released
+    def release_hold(self, customer: Customer, hold_id: str) -> bool:
+        hold = self._take_hold(customer, hold_id)
+        if hold is None:
+            return False
+        self._give_back(hold)
+        return True
+
+    # Buys the held seats, priced like purchase(); raises ValueError if the
+    # hold has expired, was released or belongs to someone else
+    def confirm_hold(self, customer: Customer, hold_id: str, ticket_type: str, unit_price: float,
+                     method: str, discount: Optional[float] = None) -> Reservation:
+        self._holds.expire_due()
+        hold = self._take_hold(customer, hold_id)
+        if hold is None:
+            raise ValueError("Hold expired or not found.")
+        try:
+            return self._book(customer, hold.get_event(), ticket_type, hold.get_quantity(), unit_price,
+                              method, discount, held=True)
+        except BaseException:
+            # The seats are still held, so the customer can try again
+            self._holds.add(hold)
+            raise
+
+    def _take_hold(self, customer: Customer, hold_id: str) -> Optional[SeatHold]:
+        hold = self._holds.get(hold_id)
+        if hold is not None and hold.get_username() != customer.get_username():
+            raise ValueError("Hold belongs to another customer.")
+        return self._holds.take(hold_id)
+
+    def _give_back(self, hold: SeatHold):
+        event = hold.get_event()
+        with self.event_lock(event.get_event_id()):
+            event.release_hold(hold.get_quantity())
+        self._claims.add_pending(hold.get_username(), event.get_event_id(), -hold.get_quantity())
+        self._backfill(event)
+
+    # Waitlist: joins the event's queue at the given price. The entry is
+    # booked as soon as seats allow, possibly right away.
+    def join_waitlist(self, customer: Customer, event: Event, ticket_type: str, qty: int, unit_price: float,
+                      method: str, discount: Optional[float] = None, priority: int = 0) -> WaitlistEntry:
+        if qty <= 0:
+            raise ValueError("Quantity must be positive.")
+        if qty > event.get_capacity():
+            raise ValueError("More tickets than the event has seats.")
+        entry = WaitlistEntry(self._waitlist.next_id(), customer, event, qty, ticket_type,
+                              unit_price, method, discount, priority)
+        self._claims.add_pending(customer.get_username(), event.get_event_id(), qty)
+        self._waitlist.add(entry)
+        self._backfill(event)
+        return entry
+
+    def leave_waitlist(self, customer: Customer, entry_id: str) -> bool:
+        entry = self._waitlist.get(entry_id)
+        if entry is None or entry.get_customer() is not customer:
+            return False
+        if self._waitlist.remove(entry_id) is None:
+            return False
+        self._claims.add_pending(customer.get_username(), entry.get_event().get_event_id(), -entry.get_quantity())
+        return True
+
+    # Seats the head of the event's waitlist while it fits. The seats are
+    # claimed as a hold under the event lock, and booked after it is
+    # released so the customer-then-event lock order is kept. If a booking
+    # fails, its entry is dropped, the entries after it go back to the
+    # queue, and the error is raised once their seats are free again.
+    def _backfill(self, event: Event):
+        with self.event_lock(event.get_event_id()):
+            promoted = self._waitlist.pop_fitting(event.get_event_id(), event.get_remaining_capacity())
+            for entry in promoted:
+                event.try_hold(entry.get_quantity())
+        for i, entry in enumerate(promoted):
+            try:
+                res = self._book(entry.get_customer(), event, entry.get_ticket_type(), entry.get_quantity(),
+                                 entry.get_unit_price(), entry.get_method(), entry.get_discount(), held=True)
+            except BaseException:
+                with self.event_lock(event.get_event_id()):
+                    event.release_hold(sum(e.get_quantity() for e in promoted[i:]))
+                self._claims.add_pending(entry.get_customer().get_username(), event.get_event_id(),
+                                         -entry.get_quantity())
+                self._waitlist.requeue(promoted[i + 1:])
+                raise
+            if self._on_promoted is not None:
+                self._on_promoted(entry, res)
@@ -0,0 +1,331 @@
+import struct
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+from objects import TICKET_CLASSES, Customer, Event, Payment, Reservation, Ticket, TicketBlock
+
+# Compact binary format for customer and event snapshots. A file is
+#   <magic "GPBK"><schema version u16><kind u8><flags u8><body>
+# and the body, zlib-compressed if flags has COMPRESSED, is
+#   <crc32 u32 of the rest of the body>
+#   <string count u32> then <length u16><utf-8 bytes> per string
+#   <event count u32> then the event records
+#   <customer count u32> then the customer records (customer files only)
+# with records laid out by the structs below. Strings that repeat across
+# records (event ids, dates, ticket types, payment methods) are stored
+# once in the string table and referred to by index; strings unique to a
+# record (usernames, names, ids) are inline. Reservations refer to their
+# event by id; a customer file carries only the events missing from the
+# event table it was written against, as storage's event references do.
+# Objects are rebuilt through __setstate__, as unpickling would, so a
+# field added to a class is handled the same way for both formats.
+# Schema versions:
+#   1: no checksum
+#   2: the body starts with its checksum, so a damaged snapshot is refused
+#      instead of decoded into wrong values
+
+MAGIC = b"GPBK"
+SCHEMA_VERSION = 2
+
+# Record kinds
+CUSTOMERS = 1
+EVENTS = 2
+
+# Header flags
+COMPRESSED = 1
+
+# Forward migrations: MIGRATIONS[n](kind, body) rewrites an uncompressed
+# version n body into version n + 1. Files are upgraded on read, one
+# version at a time; writes always use SCHEMA_VERSION.
+MIGRATIONS: Dict[int, Callable[[int, bytes], bytes]] = {}
+
+_HEADER = struct.Struct("<4sHBB")
+_CHECKSUM = struct.Struct("<I")
+_COUNT = struct.Struct("<I")
+_LENGTH = struct.Struct("<H")
+# username, password and name lengths, reservation seq (-1: None), reservations
+_CUSTOMER = struct.Struct("<HHHqI")
+# id length, event, date (NONE: None), payment method, amount, blocks, loose tickets
+_RESERVATION = struct.Struct("<HIIIdII")
+# flags, type, start, count, price, discount, group size (-1: None)
+_BLOCK = struct.Struct("<BIIIddq")
+# flags, id length, type, price, group size (-1: not a GroupDiscount)
+_TICKET = struct.Struct("<BHIdq")
+# name length, id, date, capacity, tickets sold
+_EVENT = struct.Struct("<HIIqq")
+
+NONE = 0xFFFFFFFF  # string index standing for None
+
+_PREFIX_IS_ID = 1  # block flag: ticket ids are prefixed with the reservation id
+_TYPED = 1  # ticket flag: the class is TICKET_CLASSES[type], not plain Ticket
+
+
+def is_encoded(data: bytes) -> bool:
+    return data[:len(MAGIC)] == MAGIC
+
+
+class _Strings:
+    def __init__(self):
+        self._index: Dict[str, int] = {}
+
+    def ref(self, value: Optional[str]) -> int:
+        if value is None:
+            return NONE
+        index = self._index.get(value)
+        if index is None:
+            index = self._index[value] = len(self._index)
+        return index
+
+    def table(self) -> bytes:
+        parts = [_COUNT.pack(len(self._index))]
+        for value in self._index:
+            parts.append(_inline(value))
+        return b"".join(parts)
+
+
+def _utf8(value: str) -> bytes:
+    raw = value.encode("utf-8")
+    if len(raw) > 0xFFFF:
+        raise ValueError("String too long to encode.")
+    return raw
+
+
+def _inline(value: str) -> bytes:
+    raw = _utf8(value)
+    return _LENGTH.pack(len(raw)) + raw
+
+
+def _frame(kind: int, strings: _Strings, sections: List[bytes], compress: bool) -> bytes:
+    body = strings.table() + b"".join(sections)
+    body = _CHECKSUM.pack(zlib.crc32(body)) + body
+    flags = 0
+    if compress:
+        body = zlib.compress(body)
+        flags |= COMPRESSED
+    return _HEADER.pack(MAGIC, SCHEMA_VERSION, kind, flags) + body
+
+
+def _encode_events(events: List[Event], strings: _Strings) -> bytes:
+    out = [_COUNT.pack(len(events))]
+    for event in events:
+        state = event.__getstate__()
+        name = _utf8(state["_name"])
+        out.append(_EVENT.pack(len(name), strings.ref(state["_event_id"]), strings.ref(state["_date"]),
+                               state["_capacity"], state["_tickets_sold"]))
+        out.append(name)
+    return b"".join(out)
+
+
+def encode_events(events, compress: bool = False) -> bytes:
+    strings = _Strings()
+    return _frame(EVENTS, strings, [_encode_events(list(events), strings)], compress)
+
+
+# Events found in `events` (by id) are written as references only
+def encode_customers(customers, events: Optional[Dict[str, Event]] = None,
+                     compress: bool = False) -> bytes:
+    known = {} if events is None else events
+    strings = _Strings()
+    ref = strings.ref
+    embedded: Dict[str, Event] = {}
+    out = []
+    count = 0
+    for customer in customers:
+        state = customer.__getstate__()
+        username = _utf8(state["_username"])
+        password = _utf8(state["_password"])
+        name = _utf8(state["_name"])
+        seq = state.get("_reservation_seq")
+        reservations = state["_reservations"]
+        out.append(_CUSTOMER.pack(len(username), len(password), len(name),
+                                  -1 if seq is None else seq, len(reservations)))
+        out.append(username + password + name)
+        for res in reservations:
+            rid = res.get_reservation_id()
+            raw_id = _utf8(rid)
+            payment = res.get_payment()
+            blocks = res.get_blocks()
+            loose = res.get_loose_tickets()
+            event = res.get_event()
+            event_id = event.get_event_id()
+            if event_id not in known:
+                embedded.setdefault(event_id, event)
+            out.append(_RESERVATION.pack(len(raw_id), ref(event_id),
+                                         ref(res.get_date()), ref(payment.get_method()),
+                                         payment.get_amount(), len(blocks), len(loose)))
+            out.append(raw_id)
+            for block in blocks:
+                group_size = block.get_group_size()
+                same_prefix = block.get_prefix() == rid
+                out.append(_BLOCK.pack(_PREFIX_IS_ID if same_prefix else 0, ref(block.get_type()),
+                                       block.get_start(), block.get_count(), block.get_price(),
+                                       block.get_discount(), -1 if group_size is None else group_size))
+                if not same_prefix:
+                    out.append(_inline(block.get_prefix()))
+            for ticket in loose:
+                ttype = ticket.get_type()
+                raw_ticket_id = _utf8(ticket.get_ticket_id())
+                typed = type(ticket) is TICKET_CLASSES.get(ttype)
+                group_size = ticket.get_group_size() if typed and ttype == "GroupDiscount" else -1
+                out.append(_TICKET.pack(_TYPED if typed else 0, len(raw_ticket_id), ref(ttype),
+                                        ticket.get_price(), group_size))
+                out.append(raw_ticket_id)
+        count += 1
+    sections = [_encode_events(list(embedded.values()), strings), _COUNT.pack(count)] + out
+    return _frame(CUSTOMERS, strings, sections, compress)
+
+
+# Version 1 had no checksum; the body is taken as it was written
+def _add_checksum(kind: int, body: bytes) -> bytes:
+    return _CHECKSUM.pack(zlib.crc32(body)) + body
+
+
+MIGRATIONS[1] = _add_checksum
+
+
+# Header fields and the uncompressed body, migrated to SCHEMA_VERSION and
+# checked against its checksum
+def _open(data: bytes) -> Tuple[int, bytes]:
+    if len(data) < _HEADER.size or not is_encoded(data):
+        raise ValueError("Not an encoded snapshot.")
+    _, version, kind, flags = _HEADER.unpack_from(data)
+    body = data[_HEADER.size:]
+    if flags & COMPRESSED:
+        body = zlib.decompress(body)
+    if version > SCHEMA_VERSION:
+        raise ValueError(f"Snapshot schema version {version} is newer than this program ({SCHEMA_VERSION}).")
+    while version < SCHEMA_VERSION:
+        migrate = MIGRATIONS.get(version)
+        if migrate is None:
+            raise ValueError(f"No migration from snapshot schema version {version}.")
+        body = migrate(kind, body)
+        version += 1
+    if body[:_CHECKSUM.size] != _CHECKSUM.pack(zlib.crc32(memoryview(body)[_CHECKSUM.size:])):
+        raise ValueError("Snapshot checksum mismatch.")
+    return kind, body
+
+
+def _read_strings(body: bytes, pos: int) -> Tuple[List[str], int]:
+    (count,) = _COUNT.unpack_from(body, pos)
+    pos += _COUNT.size
+    strings = []
+    unpack_length = _LENGTH.unpack_from
+    for _ in range(count):
+        (n,) = unpack_length(body, pos)
+        pos += 2
+        strings.append(body[pos:pos + n].decode("utf-8"))
+        pos += n
+    return strings, pos
+
+
+# A list of events or customers. Reservation events are resolved against
+# `events` first, then against the events carried in the file; ids found
+# in neither share one placeholder Event added to `events`.
+def decode(data: bytes, events: Optional[Dict[str, Event]] = None) -> list:
+    kind, body = _open(data)
+    if kind not in (CUSTOMERS, EVENTS):
+        raise ValueError(f"Unknown snapshot kind: {kind}")
+    strings, pos = _read_strings(body, _CHECKSUM.size)
+    carried, pos = _decode_events(body, pos, strings)
+    if kind == EVENTS:
+        return carried
+    return _decode_customers(body, pos, strings, {} if events is None else events,
+                             {e.get_event_id(): e for e in carried})
+
+
+def _decode_events(body: bytes, pos: int, strings: List[str]) -> Tuple[List[Event], int]:
+    (count,) = _COUNT.unpack_from(body, pos)
+    pos += _COUNT.size
+    result = []
+    for _ in range(count):
+        name_len, event_id, date, capacity, sold = _EVENT.unpack_from(body, pos)
+        pos += _EVENT.size
+        event = Event.__new__(Event)
+        event.__setstate__({"_event_id": strings[event_id], "_name": body[pos:pos + name_len].decode("utf-8"),
+                            "_date": strings[date], "_capacity": capacity, "_tickets_sold": sold})
+        pos += name_len
+        result.append(event)
+    return result, pos
+
+
+def _decode_customers(body: bytes, pos: int, strings: List[str], events: Dict[str, Event],
+                      carried: Dict[str, Event]) -> List[Customer]:
+    (count,) = _COUNT.unpack_from(body, pos)
+    pos += _COUNT.size
+
+    def string(index: int) -> Optional[str]:
+        return None if index == NONE else strings[index]
+
+    event_objects: Dict[int, Event] = {}
+
+    def event_at(index: int) -> Event:
+        event = event_objects.get(index)
+        if event is None:
+            event_id = strings[index]
+            event = events.get(event_id) or carried.get(event_id)
+            if event is None:
+                event = events.setdefault(event_id, Event(event_id, event_id, "", 0))
+            event_objects[index] = event
+        return event
+
+    unpack_customer, unpack_reservation = _CUSTOMER.unpack_from, _RESERVATION.unpack_from
+    unpack_block, unpack_ticket, unpack_length = _BLOCK.unpack_from, _TICKET.unpack_from, _LENGTH.unpack_from
+    customer_size, reservation_size = _CUSTOMER.size, _RESERVATION.size
+    block_size, ticket_size = _BLOCK.size, _TICKET.size
+    new_customer, new_reservation = Customer.__new__, Reservation.__new__
+    customers = []
+    for _ in range(count):
+        user_len, pass_len, name_len, seq, n_res = unpack_customer(body, pos)
+        pos += customer_size
+        username = body[pos:pos + user_len].decode("utf-8")
+        pos += user_len
+        password = body[pos:pos + pass_len].decode("utf-8")
+        pos += pass_len
+        name = body[pos:pos + name_len].decode("utf-8")
+        pos += name_len
+        reservations = []
+        for _ in range(n_res):
+            id_len, event, date, method, amount, n_blocks, n_loose = unpack_reservation(body, pos)
+            pos += reservation_size
+            rid = body[pos:pos + id_len].decode("utf-8")
+            pos += id_len
+            blocks = []
+            for _ in range(n_blocks):
+                flags, ttype, start, n, price, discount, group_size = unpack_block(body, pos)
+                pos += block_size
+                if flags & _PREFIX_IS_ID:
+                    prefix = rid
+                else:
+                    (prefix_len,) = unpack_length(body, pos)
+                    pos += 2
+                    prefix = body[pos:pos + prefix_len].decode("utf-8")
+                    pos += prefix_len
+                blocks.append(TicketBlock(prefix, start, n, strings[ttype], price, discount,
+                                          None if group_size < 0 else group_size))
+            tickets = []
+            for _ in range(n_loose):
+                flags, ticket_len, ttype, price, group_size = unpack_ticket(body, pos)
+                pos += ticket_size
+                ticket_id = body[pos:pos + ticket_len].decode("utf-8")
+                pos += ticket_len
+                tickets.append(_ticket(ticket_id, price, strings[ttype], flags, group_size))
+            res = new_reservation(Reservation)
+            res.__setstate__({"_reservation_id": rid, "_event": event_at(event), "_tickets": tickets,
+                              "_blocks": blocks, "_payment": Payment(amount, string(method)),
+                              "_date": string(date)})
+            reservations.append(res)
+        customer = new_customer(Customer)
+        customer.__setstate__({"_username": username, "_password": password, "_name": name,
+                               "_reservations": reservations,
+                               "_reservation_seq": None if seq < 0 else seq})
+        customers.append(customer)
+    return customers
+
+
+def _ticket(ticket_id: str, price: float, ttype: str, flags: int, group_size: int) -> Ticket:
+    if not flags & _TYPED:
+        return Ticket(ticket_id, price, ttype)
+    cls = TICKET_CLASSES[ttype]
+    if group_size >= 0:
+        return cls(ticket_id, price, group_size)
+    return cls(ticket_id, price)
@@ -1,53 +1,18 @@
+import argparse
+import threading
 import tkinter as tk
-from tkinter import ttk, messagebox
-import pickle
-import os
-from objects import (
-    Customer, Admin, Event,
-    SingleRacePass, WeekendPackage,
-    SeasonMembership, GroupDiscount,
-    Reservation, Payment, SystemManager
-)
-
-# File constants
-CUSTOMERS_FILE = "customers.pkl"
-EVENTS_FILE = "events.pkl"
-
-# Helper functions for persistence
-
-def load_customers():
-    try:
-        with open(CUSTOMERS_FILE, "rb") as f:
-            return pickle.load(f)
-    except Exception:
-        return []
-
-
-def save_customers(customers):
-    with open(CUSTOMERS_FILE, "wb") as f:
-        pickle.dump(customers, f)
-
-
-def load_events():
-    # Initialize sample events if none exist
-    if not os.path.exists(EVENTS_FILE):
-        sample = [
-            Event("E1", "Friday Practice", "2025-11-21", 200),
-            Event("E2", "Qualifying", "2025-11-22", 200),
-            Event("E3", "Grand Prix Race", "2025-11-23", 200),
-        ]
-        save_events(sample)
-        return sample
-    try:
-        with open(EVENTS_FILE, "rb") as f:
-            return pickle.load(f)
-    except Exception:
-        return []
-
-
-def save_events(events):
-    with open(EVENTS_FILE, "wb") as f:
-        pickle.dump(events, f)
+from tkinter import ttk, messagebox, filedialog
+
+import metrics
+import profiling
+import reports
+from service import BookingService, CUSTOMER_CACHE_SIZE, WRITE_DELAY, TICKET_PRICES, PAYMENT_METHODS
+from views import ReservationRows
+
+# Events offered at once by the type-ahead event box
+EVENT_SEARCH_LIMIT = 50
+# Milliseconds after the last keystroke before the event box searches
+SEARCH_DELAY = 150
 
 
 class TicketBookingApp(tk.Tk):
@@ -56,11 +21,15 @@ class TicketBookingApp(tk.Tk):
         self.title("Grand Prix Ticket Booking System")
         self.geometry("700x500")
 
-        # Load data
-        self.customers = load_customers()
-        self.events = load_events()
-        self.system_manager = SystemManager()
-        self.system_manager.load_data()
+        # Recorded for the admin Metrics frame
+        metrics.enable()
+
+        # Load data; reservations are read per customer when first shown and
+        # changes are saved by a background thread, never on the Tk thread
+        self.service = BookingService(cache_size=CUSTOMER_CACHE_SIZE, write_delay=WRITE_DELAY)
+        self.customers = self.service.get_customers()
+        self.events = self.service.get_events()
+        self.system_manager = self.service.get_system_manager()
 
         # Current user
         self.current_user = None
@@ -75,7 +44,7 @@ class TicketBookingApp(tk.Tk):
         self.frames = {}
         for F in (LoginFrame, CustomerFrame, ViewReservationsFrame,
                   NewReservationFrame, EditProfileFrame,
-                  AdminFrame, ViewSalesFrame, UpdateDiscountFrame):
+                  AdminFrame, ViewSalesFrame, CustomerReportFrame, MetricsFrame, UpdateDiscountFrame):
             frame = F(container, self)
             self.frames[F.__name__] = frame
             frame.grid(row=0, column=0, sticky="nsew")
@@ -89,19 +58,81 @@ class TicketBookingApp(tk.Tk):
         # Call loaders explicitly after frame is raised
         if hasattr(frame, 'load_reservations'):
             frame.load_reservations()
+        if hasattr(frame, 'load_events'):
+            frame.load_events()
         if hasattr(frame, 'update_report'):
             frame.update_report()
         if hasattr(frame, 'load_profile'):
             frame.load_profile()
 
     def on_closing(self):
-        # Save all data
-        save_customers(self.customers)
-        save_events(self.events)
-        self.system_manager.save_data()
+        # Flush pending background writes and save all data
+        try:
+            self.service.close()
+        except Exception as e:
+            messagebox.showerror("Error", f"Could not save data: {e}")
         self.destroy()
 
 
+# Listbox that holds only the rows in view. The source has len() and
+# rows(start, stop); scrolling asks it for the new page, so showing a list
+# costs the same for ten rows or ten thousand.
+class VirtualList(ttk.Frame):
+    def __init__(self, parent, source, height=15, width=80):
+        super().__init__(parent)
+        self._source = source
+        self._height = height
+        self._offset = 0
+        self.listbox = tk.Listbox(self, width=width, height=height, exportselection=False)
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self._on_scroll)
+        self.listbox.grid(row=0, column=0, sticky="nsew")
+        self.scrollbar.grid(row=0, column=1, sticky="ns")
+        self.position = ttk.Label(self)
+        self.position.grid(row=1, column=0, columnspan=2)
+        self.listbox.bind("<MouseWheel>", lambda e: self.scroll(-1 if e.delta > 0 else 1))
+        self.listbox.bind("<Button-4>", lambda e: self.scroll(-1))
+        self.listbox.bind("<Button-5>", lambda e: self.scroll(1))
+        self.listbox.bind("<Prior>", lambda e: self.scroll(-self._height))
+        self.listbox.bind("<Next>", lambda e: self.scroll(self._height))
+
+    def refresh(self):
+        total = len(self._source)
+        self._offset = max(0, min(self._offset, total - self._height))
+        self.listbox.delete(0, tk.END)
+        rows = self._source.rows(self._offset, self._offset + self._height)
+        if rows:
+            self.listbox.insert(tk.END, *rows)
+        if total:
+            self.scrollbar.set(self._offset / total, min(1.0, (self._offset + self._height) / total))
+            self.position.config(text=f"{self._offset + 1}-{self._offset + len(rows)} of {total}")
+        else:
+            self.scrollbar.set(0.0, 1.0)
+            self.position.config(text="")
+
+    def scroll(self, rows):
+        self._offset += rows
+        self.refresh()
+        return "break"
+
+    def _on_scroll(self, action, amount, unit=None):
+        if action == "moveto":
+            self._offset = int(float(amount) * len(self._source))
+            self.refresh()
+        elif unit == "pages":
+            self.scroll(int(amount) * self._height)
+        else:
+            self.scroll(int(amount))
+
+    def reset(self):
+        self._offset = 0
+        self.refresh()
+
+    # Index into the source, or None
+    def get_selection(self):
+        sel = self.listbox.curselection()
+        return self._offset + sel[0] if sel else None
+
+
 class LoginFrame(ttk.Frame):
     def __init__(self, parent, app):
         super().__init__(parent)
@@ -134,17 +165,18 @@ class LoginFrame(ttk.Frame):
         role = self.role_var.get()
 
         if role == "Customer":
-            for cust in self.app.customers:
-                if cust.get_username() == username and cust.check_password(password):
-                    self.app.current_user = cust
-                    messagebox.showinfo("Success", f"Welcome, {cust.get_name()}!")
-                    self.app.show_frame("CustomerFrame")
-                    return
+            cust = self.app.service.login(username, password)
+            if cust:
+                self.app.current_user = cust
+                messagebox.showinfo("Success", f"Welcome, {cust.get_name()}!")
+                self.app.show_frame("CustomerFrame")
+                return
             messagebox.showerror("Error", "Invalid customer credentials.")
 
         else:  # Admin
-            if username == "admin" and password == "admin":
-                self.app.current_user = Admin(username, password, "Administrator")
+            admin = self.app.service.login_admin(username, password)
+            if admin:
+                self.app.current_user = admin
                 messagebox.showinfo("Success", "Logged in as Admin.")
                 self.app.show_frame("AdminFrame")
             else:
@@ -153,17 +185,11 @@ class LoginFrame(ttk.Frame):
     def create_account(self):
         username = self.username_entry.get().strip()
         password = self.password_entry.get().strip()
-        name = username
-        if not username or not password:
-            messagebox.showerror("Error", "Enter username and password to create account.")
+        try:
+            self.app.service.create_account(username, password)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
             return
-        for cust in self.app.customers:
-            if cust.get_username() == username:
-                messagebox.showerror("Error", "Username already exists.")
-                return
-        new_cust = Customer(username, password, name)
-        self.app.customers.append(new_cust)
-        save_customers(self.app.customers)
         messagebox.showinfo("Success", "Account created. You can now log in.")
 
 
@@ -210,13 +236,12 @@ class EditProfileFrame(ttk.Frame):
     def save_name(self):
         """Save the new name and persist to file."""
         new_name = self.name_entry.get().strip()
-        if not new_name:
-            messagebox.showerror("Error", "Name cannot be empty.")
+        # Update the user object and persist the change
+        try:
+            self.app.service.rename(self.app.current_user, new_name)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
             return
-        # Update the user object
-        self.app.current_user.set_name(new_name)
-        # Persist customers
-        save_customers(self.app.customers)
         messagebox.showinfo("Success", "Your display name has been updated.")
         # Return to dashboard
         self.app.show_frame("CustomerFrame")
@@ -228,8 +253,9 @@ class ViewReservationsFrame(ttk.Frame):
         self.app = app
         ttk.Label(self, text="Your Reservations", font=(None, 16)).pack(pady=10)
 
-        self.listbox = tk.Listbox(self, width=80)
-        self.listbox.pack(pady=10)
+        self.rows = ReservationRows()
+        self.list = VirtualList(self, self.rows)
+        self.list.pack(pady=10)
 
         btn_frame = ttk.Frame(self)
         btn_frame.pack(pady=10)
@@ -239,22 +265,28 @@ class ViewReservationsFrame(ttk.Frame):
     def load_reservations(self):
         if not self.app.current_user:
             return
-        self.listbox.delete(0, tk.END)
-        for res in self.app.current_user.get_reservations():
-            self.listbox.insert(tk.END,
-                                f"ID: {res.get_reservation_id()} | Event: {res.get_event().get_name()} | Total: ${res.get_total_price():.2f}")
+        # Only the visible page is formatted; lines already seen come from the cache
+        self.rows.set_customer(self.app.current_user)
+        self.list.reset()
 
     def delete_res(self):
-        sel = self.listbox.curselection()
-        if not sel:
+        idx = self.list.get_selection()
+        if idx is None:
             messagebox.showerror("Error", "Select a reservation to delete.")
             return
-        idx = sel[0]
-        res = self.app.current_user.get_reservations()[idx]
-        self.app.current_user.delete_reservation(res.get_reservation_id())
-        save_customers(self.app.customers)
+        res = self.rows.get(idx)
+        # A failed cancel is rolled back by the service; storage errors land here too
+        try:
+            cancelled = self.app.service.cancel(self.app.current_user, res.get_reservation_id())
+        except Exception as e:
+            messagebox.showerror("Error", str(e))
+            return
+        if not cancelled:
+            messagebox.showerror("Error", "Reservation no longer exists.")
+            self.list.refresh()
+            return
         messagebox.showinfo("Success", "Reservation deleted.")
-        self.load_reservations()
+        self.list.refresh()
 
 
 class NewReservationFrame(ttk.Frame):
@@ -265,12 +297,16 @@ class NewReservationFrame(ttk.Frame):
 
         frm = ttk.Frame(self)
         frm.pack(pady=10)
+        # Type-ahead: the drop-down offers the events matching what has been typed
         ttk.Label(frm, text="Event:").grid(row=0, column=0)
-        self.event_cb = ttk.Combobox(frm, values=[e.get_name() for e in app.events])
+        self.event_cb = ttk.Combobox(frm)
         self.event_cb.grid(row=0, column=1)
+        self.event_cb.bind("<KeyRelease>", self._schedule_search)
+        self._search_job = None
+        self._choices = {}  # label shown in the box -> event id
 
         ttk.Label(frm, text="Ticket Type:").grid(row=1, column=0)
-        self.type_cb = ttk.Combobox(frm, values=["SingleRacePass","WeekendPackage","SeasonMembership","GroupDiscount"]) 
+        self.type_cb = ttk.Combobox(frm, values=list(TICKET_PRICES)) 
         self.type_cb.grid(row=1, column=1)
 
         ttk.Label(frm, text="Quantity:").grid(row=2, column=0)
@@ -278,7 +314,7 @@ class NewReservationFrame(ttk.Frame):
         self.qty_entry.grid(row=2, column=1)
 
         ttk.Label(frm, text="Payment Method:").grid(row=3, column=0)
-        self.pay_cb = ttk.Combobox(frm, values=["Credit Card","Digital Wallet"])   
+        self.pay_cb = ttk.Combobox(frm, values=PAYMENT_METHODS)   
         self.pay_cb.grid(row=3, column=1)
 
         btn_frame = ttk.Frame(self)
@@ -286,44 +322,70 @@ class NewReservationFrame(ttk.Frame):
         ttk.Button(btn_frame, text="Purchase", command=self.purchase).pack(side="left", padx=5)
         ttk.Button(btn_frame, text="Back", command=lambda: app.show_frame("CustomerFrame")).pack(side="left", padx=5)
 
+    def load_events(self):
+        self.event_cb.set("")
+        self.search_events()
+
+    def _schedule_search(self, event):
+        if event.keysym in ("Up", "Down", "Return", "Escape", "Tab"):
+            return
+        if self._search_job is not None:
+            self.after_cancel(self._search_job)
+        self._search_job = self.after(SEARCH_DELAY, self.search_events)
+
+    def search_events(self):
+        self._search_job = None
+        matches = self.app.events.search(self.event_cb.get(), EVENT_SEARCH_LIMIT)
+        # Events can share a name, so each choice carries its date and id
+        self._choices = {f"{e.get_name()} ({e.get_date()}, {e.get_event_id()})": e.get_event_id()
+                         for e in matches}
+        self.event_cb.config(values=list(self._choices))
+
     def purchase(self):
-        ev_name = self.event_cb.get()
+        ev_label = self.event_cb.get().strip()
         ttype = self.type_cb.get()
         qty = self.qty_entry.get().strip()
         method = self.pay_cb.get()
-        if not ev_name or not ttype or not qty.isdigit() or not method:
+        if not ev_label or not ttype or not qty.isdigit() or not method:
             messagebox.showerror("Error", "Fill all fields correctly.")
             return
         qty = int(qty)
-        event = next((e for e in self.app.events if e.get_name()==ev_name), None)
+        # A choice from the list, or an event id typed in full
+        event = self.app.events.get(self._choices.get(ev_label, ev_label))
         if not event:
             messagebox.showerror("Error", "Invalid event selected.")
             return
-        rid = f"{self.app.current_user.get_username()}_{len(self.app.current_user.get_reservations())+1}"
-        payment = Payment(0.0, method)
-        res = Reservation(rid, event, payment)
-        total = 0.0
-        for i in range(qty):
-            if ttype == "SingleRacePass":
-                ticket = SingleRacePass(f"{rid}_{i+1}", 100.0)
-            elif ttype == "WeekendPackage":
-                ticket = WeekendPackage(f"{rid}_{i+1}", 180.0)
-            elif ttype == "SeasonMembership":
-                ticket = SeasonMembership(f"{rid}_{i+1}", 800.0)
-            else:
-                ticket = GroupDiscount(f"{rid}_{i+1}", 400.0, group_size=qty)
-            disc = self.app.system_manager.calculate_discounts(ticket)
-            price = ticket.get_price() - disc
-            total += price
-            res.add_ticket(ticket)
-            self.app.system_manager.log_sale(event, 1)
-        payment.set_amount(total)
-        self.app.current_user.add_reservation(res)
-        save_customers(self.app.customers)
-        self.app.system_manager.save_data()
+        # Capacity is checked and claimed once for the whole order
+        try:
+            res = self.app.service.purchase(self.app.current_user, event, ttype, qty, method)
+        except ValueError as e:
+            if str(e) == "Event sold out":
+                self.offer_waitlist(event, ttype, qty, method)
+                return
+            messagebox.showerror("Error", str(e))
+            return
+        total = res.get_payment().get_amount()
         messagebox.showinfo("Success", f"Purchased {qty} ticket(s). Total: ${total:.2f}")
         self.app.show_frame("CustomerFrame")
 
+    def offer_waitlist(self, event, ttype, qty, method):
+        left = event.get_remaining_capacity()
+        if not messagebox.askyesno("Sold Out", f"Only {left} ticket(s) left for this event.\n"
+                                              f"Join the waitlist for {qty} ticket(s)?"):
+            return
+        try:
+            entry = self.app.service.join_waitlist(self.app.current_user, event, ttype, qty, method)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        position = self.app.service.waitlist_position(entry.get_entry_id())
+        if position is None:
+            messagebox.showinfo("Success", f"Seats came free: purchased {qty} ticket(s).")
+        else:
+            messagebox.showinfo("Waitlist", f"You are number {position} on the waitlist. The tickets "
+                                            "will be booked and charged when seats come free.")
+        self.app.show_frame("CustomerFrame")
+
 
 class AdminFrame(ttk.Frame):
     def __init__(self, parent, app):
@@ -334,6 +396,10 @@ class AdminFrame(ttk.Frame):
         btn_frame.pack(pady=20)
         ttk.Button(btn_frame, text="View Sales", width=20,
                    command=lambda: app.show_frame("ViewSalesFrame")).pack(pady=5)
+        ttk.Button(btn_frame, text="Customer Report", width=20,
+                   command=lambda: app.show_frame("CustomerReportFrame")).pack(pady=5)
+        ttk.Button(btn_frame, text="Metrics", width=20,
+                   command=lambda: app.show_frame("MetricsFrame")).pack(pady=5)
         ttk.Button(btn_frame, text="Update Discounts", width=20,
                    command=lambda: app.show_frame("UpdateDiscountFrame")).pack(pady=5)
         ttk.Button(btn_frame, text="Logout", width=20,
@@ -351,11 +417,101 @@ class ViewSalesFrame(ttk.Frame):
 
     def update_report(self):
         self.txt.delete("1.0", tk.END)
-        sales = self.app.system_manager.track_sales()
-        for eid, count in sales.items():
-            event = next((e for e in self.app.events if e.get_event_id()==eid), None)
-            name = event.get_name() if event else eid
-            self.txt.insert(tk.END, f"{name}: {count} tickets sold\n")
+        if not self.app.current_user:
+            return
+        # Precomputed totals, so this is independent of how much has been sold
+        report = self.app.service.sales_report(self.app.current_user, detailed=True)
+        for dimension, title in (("event", "By event"), ("ticket_type", "By ticket type"),
+                                 ("method", "By payment method"), ("date", "By sale date")):
+            self.txt.insert(tk.END, f"{title}\n")
+            for key, (count, revenue) in sorted(report.get(dimension, {}).items()):
+                if dimension == "event":
+                    event = self.app.events.get(key)
+                    key = event.get_name() if event else key
+                self.txt.insert(tk.END, f"  {key}: {count} tickets sold, ${revenue:.2f}\n")
+            self.txt.insert(tk.END, "\n")
+
+
+# Reservation-level report over every customer. It reads all reservations,
+# so it runs on worker processes started from a background thread and the
+# window stays responsive meanwhile.
+class CustomerReportFrame(ttk.Frame):
+    def __init__(self, parent, app):
+        super().__init__(parent)
+        self.app = app
+        self.result = None
+        ttk.Label(self, text="Customer Report", font=(None, 16)).pack(pady=10)
+        self.txt = tk.Text(self, width=80, height=20)
+        self.txt.pack(pady=10)
+        self.status = ttk.Label(self, text="")
+        self.status.pack()
+        btn_frame = ttk.Frame(self)
+        btn_frame.pack()
+        self.run_btn = ttk.Button(btn_frame, text="Run", command=self.run_report)
+        self.run_btn.pack(side="left", padx=5)
+        ttk.Button(btn_frame, text="Back", command=lambda: app.show_frame("AdminFrame")).pack(side="left", padx=5)
+
+    def run_report(self):
+        admin = self.app.current_user
+        if not admin:
+            return
+        self.run_btn.state(["disabled"])
+        self.status.config(text="Running...")
+        self.result = None
+
+        def work():
+            try:
+                self.result = self.app.service.customer_report(admin)
+            except Exception as e:
+                self.result = e
+
+        threading.Thread(target=work, daemon=True).start()
+        self.after(100, self.check_report)
+
+    def check_report(self):
+        if self.result is None:
+            self.after(100, self.check_report)
+            return
+        self.run_btn.state(["!disabled"])
+        self.status.config(text="")
+        if isinstance(self.result, Exception):
+            messagebox.showerror("Error", f"Could not run the report: {self.result}")
+            return
+        self.txt.delete("1.0", tk.END)
+        self.txt.insert(tk.END, "\n".join(reports.report_lines(self.result)))
+
+
+class MetricsFrame(ttk.Frame):
+    def __init__(self, parent, app):
+        super().__init__(parent)
+        self.app = app
+        ttk.Label(self, text="Metrics", font=(None, 16)).pack(pady=10)
+        self.txt = tk.Text(self, width=80, height=20)
+        self.txt.pack(pady=10)
+        btn_frame = ttk.Frame(self)
+        btn_frame.pack()
+        ttk.Button(btn_frame, text="Refresh", command=self.update_report).pack(side="left", padx=5)
+        ttk.Button(btn_frame, text="Export", command=self.export).pack(side="left", padx=5)
+        ttk.Button(btn_frame, text="Back", command=lambda: app.show_frame("AdminFrame")).pack(side="left", padx=5)
+
+    def update_report(self):
+        self.txt.delete("1.0", tk.END)
+        if not self.app.current_user:
+            return
+        for line in metrics.summary_lines():
+            self.txt.insert(tk.END, line + "\n")
+
+    def export(self):
+        path = filedialog.asksaveasfilename(defaultextension=".prom", initialfile="metrics.prom",
+                                            filetypes=[("Prometheus text", "*.prom"), ("All files", "*")])
+        if not path:
+            return
+        try:
+            metrics.write_prometheus(path)
+        except OSError as e:
+            messagebox.showerror("Error", f"Could not export metrics: {e}")
+            return
+        messagebox.showinfo("Success", f"Metrics written to {path}")
 
 
 class UpdateDiscountFrame(ttk.Frame):
@@ -366,7 +522,7 @@ class UpdateDiscountFrame(ttk.Frame):
         frm = ttk.Frame(self)
         frm.pack(pady=10)
         ttk.Label(frm, text="Ticket Type:").grid(row=0, column=0)
-        self.type_cb = ttk.Combobox(frm, values=["SingleRacePass","WeekendPackage","SeasonMembership","GroupDiscount"])
+        self.type_cb = ttk.Combobox(frm, values=list(TICKET_PRICES))
         self.type_cb.grid(row=0, column=1)
         ttk.Label(frm, text="Discount Amount:").grid(row=1, column=0)
         self.amount_entry = ttk.Entry(frm)
@@ -384,11 +540,23 @@ class UpdateDiscountFrame(ttk.Frame):
             return
         amt_f = float(amt)
         admin = self.app.current_user  # type: Admin
-        admin.update_discounts(self.app.system_manager, {ttype: amt_f})
-        self.app.system_manager.save_data()
+        try:
+            self.app.service.set_discount(admin, ttype, amt_f)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
         messagebox.showinfo("Success", f"Discount for {ttype} set to ${amt_f:.2f}")
 
 
-if __name__ == "__main__":
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Grand Prix Ticket Booking System")
+    profiling.add_arguments(parser)
+    args = parser.parse_args(argv)
+    profiling.configure_from_args(args)
     app = TicketBookingApp()
     app.mainloop()
+    profiling.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import metrics
+from objects import Event
+
+# Seconds seats stay held while a customer pays
+HOLD_TTL = 300.0
+
+EXPIRY_ERRORS = metrics.counter("hold_expiry_errors_total", "Expired holds whose give-back raised")
+
+
+# Seats set aside on an event for one customer until expires_at (a
+# monotonic clock reading). Holds live in memory only: after a restart
+# every hold is gone and its seats are free again.
+class SeatHold:
+    __slots__ = ("_hold_id", "_username", "_event", "_quantity", "_expires_at")
+
+    def __init__(self, hold_id: str, username: str, event: Event, quantity: int, expires_at: float):
+        self._hold_id = hold_id
+        self._username = username
+        self._event = event
+        self._quantity = quantity
+        self._expires_at = expires_at
+
+    def get_hold_id(self) -> str:
+        return self._hold_id
+
+    def get_username(self) -> str:
+        return self._username
+
+    def get_event(self) -> Event:
+        return self._event
+
+    def get_quantity(self) -> int:
+        return self._quantity
+
+    def get_expires_at(self) -> float:
+        return self._expires_at
+
+
+# Active holds by id plus a min-heap of (expires_at, seq, hold_id), so
+# finding what has expired costs O(log n) per expired hold instead of a scan.
+# Confirmed and released holds leave their heap entry behind; it is dropped
+# when it reaches the top. on_expire(hold) gives the seats back and is called
+# outside the lock. start() runs a sweeper thread that sleeps until the next
+# deadline; without it, expire_due() is called from hold and confirm. If
+# on_expire raises, the other due holds are still given back and the error
+# is counted; expire_due() then raises the first one, the sweeper carries on.
+class HoldBook:
+    def __init__(self, on_expire: Callable[[SeatHold], None], clock: Callable[[], float] = time.monotonic):
+        self._on_expire = on_expire
+        self._clock = clock
+        self._holds: Dict[str, SeatHold] = {}
+        self._heap: List[tuple] = []
+        self._seq = itertools.count(1)
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def __len__(self) -> int:
+        return len(self._holds)
+
+    def now(self) -> float:
+        return self._clock()
+
+    def next_id(self) -> str:
+        return f"H{next(self._seq)}"
+
+    def get(self, hold_id: str) -> Optional[SeatHold]:
+        return self._holds.get(hold_id)
+
+    def add(self, hold: SeatHold):
+        with self._cond:
+            self._holds[hold.get_hold_id()] = hold
+            entry = (hold.get_expires_at(), next(self._seq), hold.get_hold_id())
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                self._cond.notify()  # earlier than what the sweeper is sleeping towards
+
+    # Removes an active hold and returns it; None if it is unknown or already gone
+    def take(self, hold_id: str) -> Optional[SeatHold]:
+        with self._cond:
+            return self._holds.pop(hold_id, None)
+
+    def _pop_due(self, now: float) -> List[SeatHold]:
+        due = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, _, hold_id = heapq.heappop(heap)
+            hold = self._holds.pop(hold_id, None)
+            if hold is not None:
+                due.append(hold)
+        return due
+
+    # Releases every hold whose time is up; returns how many
+    def expire_due(self, now: Optional[float] = None) -> int:
+        if now is None:
+            now = self._clock()
+        with self._cond:
+            if not self._heap or self._heap[0][0] > now:
+                return 0
+            due = self._pop_due(now)
+        self._expire(due)
+        return len(due)
+
+    def _expire(self, due: List[SeatHold]):
+        error = None
+        for hold in due:
+            try:
+                self._on_expire(hold)
+            except Exception as e:
+                EXPIRY_ERRORS.inc()
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name="hold-sweeper", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._stopped = True
+            self._cond.notify()
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    timeout = self._heap[0][0] - self._clock() if self._heap else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                due = self._pop_due(self._clock())
+            try:
+                self._expire(due)
+            except Exception:
+                pass  # counted in _expire; nobody is waiting on the sweeper to report it
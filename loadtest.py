@@ -0,0 +1,299 @@
+import argparse
+import json
+import math
+import random
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+import admission
+import metrics
+import profiling
+from admission import Overloaded
+from objects import Admin, Event
+from service import TICKET_PRICES, BookingService
+from sqlite_storage import SQLiteBackend
+from storage import PickleBackend
+
+# Closed-loop load generator for the booking path. Each worker thread
+# issues one operation, waits for it to finish, then paces itself so all
+# workers together stay near the target rate (or run flat out without one).
+# Operations are drawn from a weighted mix of
+#   login, cancel, report, and a purchase of any ticket type by name
+# e.g. {"login": 20, "SingleRacePass": 30, "GroupDiscount": 10, "cancel": 10}.
+# Runs headless: nothing here imports tkinter.
+
+DEFAULT_MIX = {
+    "login": 20,
+    "SingleRacePass": 25,
+    "WeekendPackage": 15,
+    "SeasonMembership": 5,
+    "GroupDiscount": 10,
+    "cancel": 15,
+    "report": 10,
+}
+METHODS = ["Credit Card", "Debit Card", "PayPal"]
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    # "login=20,SingleRacePass=30,cancel=10"
+    mix = {}
+    for part in text.split(","):
+        op, sep, weight = part.partition("=")
+        op = op.strip()
+        if not sep or (op not in ("login", "cancel", "report") and op not in TICKET_PRICES):
+            raise ValueError(f"Bad mix entry: {part!r}")
+        mix[op] = float(weight)
+    if not any(w > 0 for w in mix.values()):
+        raise ValueError("The mix needs at least one positive weight.")
+    return mix
+
+
+# Nearest-rank percentile of sorted values
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    return values[max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))]
+
+
+class LoadGenerator:
+    def __init__(self, service: BookingService, usernames: List[str], password: str = "pw",
+                 mix: Optional[Dict[str, float]] = None, workers: int = 16,
+                 rate: Optional[float] = None, max_qty: int = 4, seed: int = 0):
+        self._service = service
+        self._usernames = usernames
+        self._password = password
+        self._mix = dict(mix or DEFAULT_MIX)
+        self._workers = workers
+        self._rate = rate  # total operations per second; None = as fast as possible
+        self._max_qty = max_qty
+        self._seed = seed
+        self._admin = Admin("loadtest", "", "Load Generator")
+
+    def run(self, duration: float) -> Dict:
+        ops = list(self._mix)
+        weights = [self._mix[op] for op in ops]
+        results = [{"latencies": {op: [] for op in ops}, "rejections": [], "sold_out": 0, "errors": 0}
+                   for _ in range(self._workers)]
+        start = time.perf_counter()
+        end = start + duration
+        threads = [threading.Thread(target=self._worker, args=(i, ops, weights, start, end, results[i]))
+                   for i in range(self._workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        return self._report(ops, results, elapsed)
+
+    def _worker(self, index: int, ops: List[str], weights: List[float], start: float, end: float,
+                result: Dict):
+        rng = random.Random(self._seed * 1000 + index)
+        # Each worker gets an equal share of the rate, offset so workers don't fire together
+        interval = self._workers / self._rate if self._rate else 0.0
+        next_at = start + interval * index / self._workers
+        latencies = result["latencies"]
+        while True:
+            if interval:
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_at += interval
+            now = time.perf_counter()
+            if now >= end:
+                return
+            op = rng.choices(ops, weights)[0]
+            try:
+                self._execute(op, rng)
+            except Overloaded as e:
+                # Turned away by admission control: counted apart, then back off as told
+                result["rejections"].append(time.perf_counter() - now)
+                time.sleep(min(e.retry_after, max(0.0, end - time.perf_counter())))
+                continue
+            except ValueError as e:
+                if "sold out" in str(e).lower():
+                    result["sold_out"] += 1
+                else:
+                    result["errors"] += 1
+            except Exception:
+                result["errors"] += 1
+            latencies[op].append(time.perf_counter() - now)
+
+    def _execute(self, op: str, rng: random.Random):
+        service = self._service
+        username = rng.choice(self._usernames)
+        if op == "report":
+            service.sales_report(self._admin, detailed=True)
+            return
+        customer = service.login(username, self._password)
+        if customer is None:
+            raise RuntimeError(f"Login failed for {username}")
+        if op == "login":
+            return
+        if op == "cancel":
+            reservations = customer.get_reservations()
+            if reservations:
+                service.cancel(customer, rng.choice(reservations).get_reservation_id())
+            return
+        event = rng.choice(service.list_events())
+        service.purchase(customer, event, op, rng.randint(1, self._max_qty), rng.choice(METHODS))
+
+    def _report(self, ops: List[str], results: List[Dict], elapsed: float) -> Dict:
+        report = {"operations": {}, "elapsed": elapsed}
+        everything = []
+        for op in ops:
+            values = sorted(v for r in results for v in r["latencies"][op])
+            everything.extend(values)
+            report["operations"][op] = _summary(values)
+        everything.sort()
+        report["total"] = _summary(everything)
+        report["throughput"] = len(everything) / elapsed if elapsed > 0 else 0.0
+        report["rejected"] = _summary(sorted(v for r in results for v in r["rejections"]))
+        report["sold_out"] = sum(r["sold_out"] for r in results)
+        report["errors"] = sum(r["errors"] for r in results)
+        report["oversold"] = find_oversold(self._service)
+        return report
+
+
+def _summary(values: List[float]) -> Dict:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": values[-1] if values else 0.0,
+    }
+
+
+# Events whose sold count, or the tickets held in customers' reservations,
+# exceed capacity: {event_id: {"capacity", "sold", "booked"}}
+def find_oversold(service: BookingService) -> Dict[str, Dict]:
+    booked: Dict[str, int] = {}
+    for customer in service.get_customers():
+        for res in customer.get_reservations():
+            event_id = res.get_event().get_event_id()
+            booked[event_id] = booked.get(event_id, 0) + res.get_ticket_count()
+    oversold = {}
+    for event in service.list_events():
+        event_id = event.get_event_id()
+        capacity, sold = event.get_capacity(), event.get_tickets_sold()
+        if sold > capacity or booked.get(event_id, 0) > capacity:
+            oversold[event_id] = {"capacity": capacity, "sold": sold, "booked": booked.get(event_id, 0)}
+    return oversold
+
+
+# Synthetic data directory: `events` events of `capacity` seats and
+# customers user0 .. user{n-1}, all with password "pw"
+def make_data_dir(path: str, customers: int, events: int, capacity: int):
+    backend = PickleBackend(path)
+    backend.save_events([Event(f"E{i + 1}", f"Race {i + 1}", f"2026-03-{1 + i % 28:02d}", capacity)
+                         for i in range(events)])
+    service = BookingService(backend=backend)
+    usernames = [f"user{i}" for i in range(customers)]
+    with service.batch():
+        for username in usernames:
+            service.create_account(username, "pw")
+    service.close()
+
+
+def _print_report(report: Dict):
+    print(f"  {'operation':<18} {'count':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}  (ms)")
+    for op, s in list(report["operations"].items()) + [("total", report["total"])]:
+        print(f"  {op:<18} {s['count']:>8} {s['p50'] * 1000:9.2f} {s['p95'] * 1000:9.2f} "
+              f"{s['p99'] * 1000:9.2f} {s['max'] * 1000:9.2f}")
+    if report["rejected"]["count"]:
+        s = report["rejected"]
+        print(f"  {'(turned away)':<18} {s['count']:>8} {s['p50'] * 1000:9.2f} {s['p95'] * 1000:9.2f} "
+              f"{s['p99'] * 1000:9.2f} {s['max'] * 1000:9.2f}")
+    print(f"  throughput {report['throughput']:.0f} ops/s over {report['elapsed']:.1f}s, "
+          f"{report['sold_out']} sold-out rejections, {report['errors']} errors, "
+          f"{len(report['oversold'])} oversold events")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Closed-loop load test of the booking operations")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--rate", type=float, help="target operations per second (default: unthrottled)")
+    parser.add_argument("--mix", type=parse_mix, default=None,
+                        help="weighted operations, e.g. login=20,SingleRacePass=30,cancel=10,report=5")
+    parser.add_argument("--max-qty", type=int, default=4, help="largest tickets per purchase")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", help="use this data directory instead of fresh synthetic data")
+    parser.add_argument("--customers", type=int, default=1000, help="synthetic customers")
+    parser.add_argument("--events", type=int, default=3, help="synthetic events")
+    parser.add_argument("--capacity", type=int, default=5000, help="seats per synthetic event")
+    parser.add_argument("--db", help="use this SQLite database instead of the pickle files")
+    parser.add_argument("--cache-size", type=int,
+                        help="load reservations on demand, keeping this many customers in memory")
+    parser.add_argument("--write-delay", type=float, help="write snapshots in the background")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--metrics-file", help="record metrics and write them here in Prometheus format")
+    parser.add_argument("--compare-admission", action="store_true",
+                        help="run twice on fresh synthetic data, without and with admission control")
+    profiling.add_arguments(parser)
+    admission.add_arguments(parser)
+    args = parser.parse_args(argv)
+    profiling.configure_from_args(args)
+    if args.metrics_file:
+        metrics.enable()
+    if args.compare_admission and (args.data_dir or args.db):
+        parser.error("--compare-admission needs fresh synthetic data")
+
+    try:
+        if args.compare_admission:
+            args.admission = True
+            runs = [("without admission control", None), ("with admission control", admission.from_args(args))]
+        else:
+            runs = [(None, admission.from_args(args))]
+        reports = {}
+        for title, controller in runs:
+            report = _run(args, controller)
+            if report is None:
+                parser.error("no customers with password 'pw' to log in as")
+            if title:
+                print(title)
+            _print_report(report)
+            reports[title or "run"] = report
+    finally:
+        profiling.close()
+    if args.compare_admission:
+        p99 = [reports[title]["operations"] for title, _ in runs]
+        purchases = [op for op in p99[0] if op in TICKET_PRICES]
+        for title, ops in zip(("without", "with"), p99):
+            worst = max((ops[op]["p99"] for op in purchases), default=0.0)
+            print(f"  purchase p99 {title} admission control: {worst * 1000:.2f} ms")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports if args.compare_admission else reports["run"], f, indent=2)
+    if args.metrics_file:
+        metrics.write_prometheus(args.metrics_file)
+    sys.exit(1 if any(r["oversold"] for r in reports.values()) else 0)
+
+
+# One load test run; None if there is nobody to log in as
+def _run(args, controller) -> Optional[Dict]:
+    synthetic = args.data_dir is None and args.db is None
+    with tempfile.TemporaryDirectory() as tmp:
+        if synthetic:
+            make_data_dir(tmp, args.customers, args.events, args.capacity)
+        backend = SQLiteBackend(args.db, args.cache_size) if args.db else None
+        service = BookingService(args.data_dir or tmp, backend, args.cache_size, args.write_delay,
+                                 admission=controller)
+        # Only accounts with the generator's password can log in
+        usernames = [c.get_username() for c in service.get_customers() if c.check_password("pw")]
+        if not usernames:
+            service.close()
+            return None
+        generator = LoadGenerator(service, usernames, mix=args.mix, workers=args.workers,
+                                  rate=args.rate, max_qty=args.max_qty, seed=args.seed)
+        try:
+            return generator.run(args.duration)
+        finally:
+            service.close()
+
+
+if __name__ == "__main__":
+    main()
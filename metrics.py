@@ -0,0 +1,375 @@
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Process-wide counters, gauges and latency histograms, exported in the
+# Prometheus text format. Recording is a no-op until enable() is called
+# (or BOOKING_METRICS=1 is set), so instrumented code pays one flag check.
+# Metrics with label names are recorded through labels(*values), e.g.
+#   PURCHASES.labels("GroupDiscount").inc()
+
+# Latency buckets in seconds, from half a millisecond to ten seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("_child", "_start")
+
+    def __init__(self, child: '_HistogramChild'):
+        self._child = child
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._child.observe(time.perf_counter() - self._start)
+        return False
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, registry: 'Registry', name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self._registry = registry
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self._default = self._child()
+            self._children[()] = self._default
+
+    def _child(self):
+        raise NotImplementedError
+
+    def labels(self, *values) -> object:
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(key, self._child())
+        return child
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], float]]:
+        raise NotImplementedError
+
+    # Zeroes every value in place, so children already handed out stay valid
+    def reset(self):
+        with self._lock:
+            for child in self._children.values():
+                child.__init__(self)
+
+
+class _CounterChild:
+    __slots__ = ("_metric", "value")
+
+    def __init__(self, metric: 'Counter'):
+        self._metric = metric
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        metric = self._metric
+        if not metric._registry.enabled:
+            return
+        with metric._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _child(self):
+        return _CounterChild(self)
+
+    def inc(self, amount: float = 1.0):
+        self._default.inc(amount)
+
+    def get(self, *labels) -> float:
+        return self.labels(*labels).value
+
+    def samples(self):
+        return [(self.name, key, child.value) for key, child in list(self._children.items())]
+
+
+class _GaugeChild:
+    __slots__ = ("_metric", "value")
+
+    def __init__(self, metric: 'Gauge'):
+        self._metric = metric
+        self.value = 0.0
+
+    def set(self, value: float):
+        if self._metric._registry.enabled:
+            self.value = value
+
+    def inc(self, amount: float = 1.0):
+        metric = self._metric
+        if not metric._registry.enabled:
+            return
+        with metric._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.inc(-amount)
+
+
+# A gauge can instead be read from a function at export time; for a
+# labelled gauge the function returns {label values tuple: value}
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, registry, name, help_text, labelnames=()):
+        super().__init__(registry, name, help_text, labelnames)
+        self._function: Optional[Callable] = None
+
+    def _child(self):
+        return _GaugeChild(self)
+
+    def set(self, value: float):
+        self._default.set(value)
+
+    def inc(self, amount: float = 1.0):
+        self._default.inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self._default.dec(amount)
+
+    def set_function(self, function: Optional[Callable]):
+        self._function = function
+
+    def get(self, *labels) -> float:
+        values = {key: value for _, key, value in self.samples()}
+        return values.get(tuple(str(v) for v in labels), 0.0)
+
+    def samples(self):
+        if self._function is not None:
+            value = self._function()
+            if isinstance(value, dict):
+                return [(self.name, tuple(str(v) for v in key), float(v)) for key, v in value.items()]
+            return [(self.name, (), float(value))]
+        return [(self.name, key, child.value) for key, child in list(self._children.items())]
+
+
+class _HistogramChild:
+    __slots__ = ("_metric", "counts", "sum", "count")
+
+    def __init__(self, metric: 'Histogram'):
+        self._metric = metric
+        self.counts = [0] * (len(metric.buckets) + 1)  # per bucket, the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        metric = self._metric
+        if not metric._registry.enabled:
+            return
+        index = bisect.bisect_left(metric.buckets, value)
+        with metric._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        if not self._metric._registry.enabled:
+            return _NULL_TIMER
+        return _Timer(self)
+
+    # Estimated from the buckets, interpolating linearly inside one
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        buckets = self._metric.buckets
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                if i == len(buckets):
+                    return buckets[-1] if buckets else 0.0
+                lower = buckets[i - 1] if i else 0.0
+                return lower + (buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return buckets[-1] if buckets else 0.0
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help_text, labelnames=(), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(registry, name, help_text, labelnames)
+
+    def _child(self):
+        return _HistogramChild(self)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    # with HISTOGRAM.time(): ...
+    def time(self):
+        return self._default.time()
+
+    def get(self, *labels) -> _HistogramChild:
+        return self.labels(*labels)
+
+    def samples(self):
+        result = []
+        for key, child in list(self._children.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += n
+                result.append((self.name + "_bucket", key + (("+Inf" if bound == float("inf") else repr(bound)),),
+                               cumulative))
+            result.append((self.name + "_sum", key, child.sum))
+            result.append((self.name + "_count", key, child.count))
+        return result
+
+
+# Counter names end in _total, as Prometheus expects
+class Registry:
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    # Metrics are created once per name; asking again returns the same one
+    def _get(self, cls, name: str, help_text: str, labelnames: Sequence[str], **kwargs) -> _Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(self, name, help_text, labelnames, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} is already a {metric.kind}")
+            return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get(Counter, name, help_text, labelnames)
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def get_metrics(self) -> List[_Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def reset(self):
+        for metric in self.get_metrics():
+            metric.reset()
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for metric in self.get_metrics():
+            lines.append(f"# HELP {metric.name} {_escape_help(metric.help)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            names = metric.labelnames + (("le",) if metric.kind == "histogram" else ())
+            for sample, key, value in metric.samples():
+                pairs = ",".join(f'{n}="{_escape_label(v)}"' for n, v in zip(names, key))
+                lines.append(f"{sample}{{{pairs}}} {_format(value)}" if pairs else f"{sample} {_format(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = Registry(enabled=os.environ.get("BOOKING_METRICS", "") not in ("", "0"))
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+def enable():
+    REGISTRY.enabled = True
+
+
+def disable():
+    REGISTRY.enabled = False
+
+
+def is_enabled() -> bool:
+    return REGISTRY.enabled
+
+
+# One line per counter or gauge value and per histogram, for the admin frame:
+#   booking_purchase_seconds: 120 calls, mean 1.20 ms, p50 0.80 ms, p95 4.10 ms, p99 9.00 ms
+def summary_lines(registry: Registry = REGISTRY) -> List[str]:
+    lines = []
+    for metric in registry.get_metrics():
+        if metric.kind == "histogram":
+            for key, child in sorted(metric._children.items()):
+                mean = child.sum / child.count if child.count else 0.0
+                lines.append(f"{metric.name}{_label_text(metric.labelnames, key)}: {child.count} calls, "
+                             f"mean {mean * 1000:.2f} ms, p50 {child.quantile(0.5) * 1000:.2f} ms, "
+                             f"p95 {child.quantile(0.95) * 1000:.2f} ms, p99 {child.quantile(0.99) * 1000:.2f} ms")
+        else:
+            for _, key, value in sorted(metric.samples()):
+                lines.append(f"{metric.name}{_label_text(metric.labelnames, key)}: {_format(value)}")
+    return lines
+
+
+def _label_text(names: Sequence[str], key: Tuple[str, ...]) -> str:
+    if not key:
+        return ""
+    return "{" + ", ".join(f"{n}={v}" for n, v in zip(names, key)) + "}"
+
+
+def write_prometheus(path: str, registry: Registry = REGISTRY):
+    # Temp file plus rename, so a scraper never reads a half-written file
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(registry.to_prometheus())
+    os.replace(tmp, path)
+
+
+# Serves GET /metrics from a daemon thread; returns the server (shutdown() stops it)
+def serve(port: int, host: str = "127.0.0.1", registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,34 @@
+import argparse
+
+from sqlite_storage import migrate_pickles_to_sqlite
+from storage import reshard
+
+# Storage maintenance commands
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Booking data migration tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    to_sqlite = commands.add_parser("to-sqlite", help="import the pickle files into a SQLite database")
+    to_sqlite.add_argument("--data-dir", default=".", help="directory holding customers.pkl etc.")
+    to_sqlite.add_argument("--db", default="booking.db")
+
+    sharding = commands.add_parser("reshard", help="split the customer file into shards, or change their number")
+    sharding.add_argument("--data-dir", default=".")
+    sharding.add_argument("--shards", type=int, required=True,
+                          help="number of shard files; 0 goes back to a single customers.pkl")
+
+    args = parser.parse_args(argv)
+    if args.command == "to-sqlite":
+        counts = migrate_pickles_to_sqlite(args.data_dir, args.db)
+        print(f"Imported {counts['customers']} customers, {counts['events']} events and "
+              f"{counts['reservations']} reservations into {args.db}")
+    elif args.command == "reshard":
+        counts = reshard(args.data_dir, args.shards)
+        layout = f"{counts['shards']} shards" if counts["shards"] else "a single file"
+        print(f"Wrote {counts['customers']} customers to {layout} in {args.data_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,16 @@
+import bisect
+import contextlib
+import datetime
+import os
 import pickle
-from typing import List, Dict
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Iterator, Optional
+
+import metrics
+
+SOLD_OUT = metrics.counter("booking_sold_out_total", "Orders refused because the event had too few seats left")
+SYSTEM_SAVE_SECONDS = metrics.histogram("system_save_seconds", "Time taken by SystemManager.save_data")
 
 # Base user class
 class User:
@@ -7,13 +18,37 @@ class User:
         self._username = username
         self._password = password
         self._name = name
+        self._registry = None  # CustomerRegistry indexing this user, if any
+        self._dirty = False  # changed since storage last wrote it
+
+    # The registry back-reference and dirty flag are never persisted
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_registry", None)
+        state.pop("_dirty", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._registry = None
+        self._dirty = False
+
+    # Dirty flag: set by mutators, cleared by storage once the change is written
+    def is_dirty(self) -> bool:
+        return self._dirty
+
+    def clear_dirty(self):
+        self._dirty = False
 
     # Username
     def get_username(self) -> str:
         return self._username
 
     def set_username(self, username: str):
+        if self._registry is not None:
+            self._registry.rename(self, username)
         self._username = username
+        self._dirty = True
 
     # Name
     def get_name(self) -> str:
@@ -21,6 +56,7 @@ class User:
 
     def set_name(self, name: str):
         self._name = name
+        self._dirty = True
 
     # Password check (no setter for security)
     def check_password(self, password: str) -> bool:
@@ -31,18 +67,143 @@ class User:
 class Customer(User):
     def __init__(self, username: str, password: str, name: str):
         super().__init__(username, password, name)
-        self._reservations: List['Reservation'] = []
+        self._reservations: Optional[List['Reservation']] = []  # None until a lazy customer is loaded
+        self._reservation_seq = 0
+        self._loader = None  # reads the reservations of a lazily loaded customer
+
+    # The loader belongs to the storage backend and is never persisted
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop("_loader", None)
+        state["_reservations"] = self.get_reservations()
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._loader = None
+
+    # Lazy loading: with a loader set, unload() drops the reservations and
+    # the next access reads them back through loader(customer)
+    def set_loader(self, loader):
+        self._loader = loader
+
+    def is_loaded(self) -> bool:
+        return self._reservations is not None
+
+    def unload(self):
+        if self._loader is not None:
+            self._reservations = None
 
     def get_reservations(self) -> List['Reservation']:
-        return self._reservations
+        reservations = self._reservations
+        if reservations is None:
+            reservations = self._reservations = self._loader(self)
+        if self._loader is not None and self._registry is not None:
+            self._registry.touch(self)
+        return reservations
+
+    # Ids are f"{username}_{n}" with n never reused, even after deletions
+    def next_reservation_id(self) -> str:
+        if getattr(self, "_reservation_seq", None) is None:
+            # Counter not stored with the customer: resume after the highest id
+            suffixes = (r.get_reservation_id().rsplit("_", 1)[-1] for r in self.get_reservations())
+            self._reservation_seq = max((int(n) for n in suffixes if n.isdigit()), default=0)
+        self._reservation_seq += 1
+        return f"{self._username}_{self._reservation_seq}"
+
+    def get_reservation_seq(self) -> Optional[int]:
+        return getattr(self, "_reservation_seq", None)
+
+    # Used by storage backends; None resumes after the highest existing id
+    def restore_reservation_seq(self, seq: Optional[int]):
+        self._reservation_seq = seq
+
+    def get_reservation(self, reservation_id: str) -> Optional['Reservation']:
+        return next((r for r in self.get_reservations() if r.get_reservation_id() == reservation_id), None)
 
     def add_reservation(self, reservation: 'Reservation'):
-        self._reservations.append(reservation)
+        self.get_reservations().append(reservation)
+        self._dirty = True
 
     def delete_reservation(self, reservation_id: str):
         self._reservations = [
-            r for r in self._reservations if r.get_reservation_id() != reservation_id
+            r for r in self.get_reservations() if r.get_reservation_id() != reservation_id
         ]
+        self._dirty = True
+
+
+# Hash index of customers by username. With a cache_size, at most that many
+# lazily loaded customers keep their reservations in memory; the least
+# recently used are unloaded first.
+class CustomerRegistry:
+    def __init__(self, customers: Optional[List[Customer]] = None, cache_size: Optional[int] = None):
+        self._by_username: Dict[str, Customer] = {}
+        self._cache_size = cache_size
+        self._loaded: 'OrderedDict[int, Customer]' = OrderedDict()  # id(customer) -> customer, oldest first
+        self._cache_lock = threading.Lock()
+        for customer in customers or []:
+            self.add(customer)
+
+    def __len__(self) -> int:
+        return len(self._by_username)
+
+    def __iter__(self) -> Iterator[Customer]:
+        return iter(list(self._by_username.values()))
+
+    def __contains__(self, username: str) -> bool:
+        return username in self._by_username
+
+    def get(self, username: str) -> Optional[Customer]:
+        return self._by_username.get(username)
+
+    def authenticate(self, username: str, password: str) -> Optional[Customer]:
+        customer = self._by_username.get(username)
+        if customer is not None and customer.check_password(password):
+            return customer
+        return None
+
+    def add(self, customer: Customer):
+        username = customer.get_username()
+        if username in self._by_username:
+            raise ValueError("Username already exists")
+        self._by_username[username] = customer
+        customer._registry = self
+
+    def remove(self, username: str):
+        customer = self._by_username.pop(username, None)
+        if customer is not None:
+            customer._registry = None
+            with self._cache_lock:
+                self._loaded.pop(id(customer), None)
+
+    def get_cache_size(self) -> Optional[int]:
+        return self._cache_size
+
+    def get_loaded_count(self) -> int:
+        return len(self._loaded)
+
+    # Called by Customer.get_reservations. The cache should comfortably exceed
+    # the number of concurrent writers so a customer is never evicted while
+    # a purchase for it is in flight.
+    def touch(self, customer: Customer):
+        if self._cache_size is None:
+            return
+        with self._cache_lock:
+            self._loaded[id(customer)] = customer
+            self._loaded.move_to_end(id(customer))
+            while len(self._loaded) > self._cache_size:
+                _, oldest = self._loaded.popitem(last=False)
+                oldest.unload()
+
+    # Called by User.set_username before the name changes
+    def rename(self, customer: Customer, new_username: str):
+        old_username = customer.get_username()
+        if new_username == old_username:
+            return
+        if new_username in self._by_username:
+            raise ValueError("Username already exists")
+        del self._by_username[old_username]
+        self._by_username[new_username] = customer
 
 
 # Admin inherits from User
@@ -50,12 +211,19 @@ class Admin(User):
     def __init__(self, username: str, password: str, name: str):
         super().__init__(username, password, name)
 
-    def view_sales_report(self, system_manager: 'SystemManager') -> Dict:
+    # Tickets sold per event id; detailed=True returns the count/revenue
+    # totals per event, ticket type, sale date and payment method instead
+    def view_sales_report(self, system_manager: 'SystemManager', detailed: bool = False) -> Dict:
+        if detailed:
+            return system_manager.get_sales_analytics()
         return system_manager.track_sales()
 
     def update_discounts(self, system_manager: 'SystemManager', new_rules):
         system_manager.set_discount_rules(new_rules)
 
+    def update_pricing_rules(self, system_manager: 'SystemManager', rules: List[Dict]):
+        system_manager.set_pricing_rules(rules)
+
 
 # Represents a racing event
 class Event:
@@ -65,6 +233,30 @@ class Event:
         self._date = date
         self._capacity = capacity
         self._tickets_sold = 0
+        self._held = 0  # seats set aside by unexpired holds (see holds.py)
+        self._catalog = None  # EventCatalog indexing this event, if any
+        self._dirty = False  # changed since storage last wrote it
+
+    # The catalog back-reference, held seats and dirty flag are never persisted
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_catalog", None)
+        state.pop("_held", None)
+        state.pop("_dirty", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._held = 0
+        self._catalog = None
+        self._dirty = False
+
+    # Dirty flag: set by mutators, cleared by storage once the change is written
+    def is_dirty(self) -> bool:
+        return self._dirty
+
+    def clear_dirty(self):
+        self._dirty = False
 
     # Event ID
     def get_event_id(self) -> str:
@@ -75,14 +267,20 @@ class Event:
         return self._name
 
     def set_name(self, name: str):
+        if self._catalog is not None:
+            self._catalog.reindex(self, name, self._date)
         self._name = name
+        self._dirty = True
 
     # Date
     def get_date(self) -> str:
         return self._date
 
     def set_date(self, date: str):
+        if self._catalog is not None:
+            self._catalog.reindex(self, self._name, date)
         self._date = date
+        self._dirty = True
 
     # Capacity and sales
     def get_capacity(self) -> int:
@@ -90,15 +288,188 @@ class Event:
 
     def set_capacity(self, capacity: int):
         self._capacity = capacity
+        self._dirty = True
 
     def get_tickets_sold(self) -> int:
         return self._tickets_sold
 
     def increment_tickets_sold(self, count: int = 1):
         self._tickets_sold += count
+        self._dirty = True
+
+    # Used when replaying the journal; marked dirty so the events file catches up
+    def restore_tickets_sold(self, count: int):
+        if count != self._tickets_sold:
+            self._tickets_sold = count
+            self._dirty = True
 
+    # Seats of a cancelled reservation become available again
+    def release(self, n: int):
+        self._tickets_sold = max(0, self._tickets_sold - n)
+        self._dirty = True
+
+    # Seats neither sold nor held
     def get_remaining_capacity(self) -> int:
-        return self._capacity - self._tickets_sold
+        return self._capacity - self._tickets_sold - self._held
+
+    # All-or-nothing: claims n seats only if all n are available
+    def try_allocate(self, n: int) -> bool:
+        if n < 0 or n > self.get_remaining_capacity():
+            return False
+        self._tickets_sold += n
+        self._dirty = True
+        return True
+
+    # Holds: seats set aside while a customer pays, later sold or given back.
+    # Like try_allocate, callers serialize these per event.
+    def get_held(self) -> int:
+        return self._held
+
+    def try_hold(self, n: int) -> bool:
+        if n <= 0 or n > self.get_remaining_capacity():
+            return False
+        self._held += n
+        return True
+
+    def release_hold(self, n: int):
+        self._held -= n
+
+    # Held seats become sold seats
+    def confirm_hold(self, n: int):
+        self._held -= n
+        self._tickets_sold += n
+        self._dirty = True
+
+    # Undoes confirm_hold when the booking could not be stored
+    def unconfirm_hold(self, n: int):
+        self._tickets_sold -= n
+        self._held += n
+        self._dirty = True
+
+
+# Events indexed by id and name, with a sorted (date, id) index for range queries
+# and a sorted (word, id) index for type-ahead search by name or id.
+# Dates are ISO "YYYY-MM-DD" strings, so string order is date order.
+class EventCatalog:
+    def __init__(self, events: Optional[List[Event]] = None):
+        self._by_id: Dict[str, Event] = {}
+        self._by_name: Dict[str, List[Event]] = {}  # name -> events with it, the first added first
+        self._added: Dict[str, int] = {}  # event id -> position in the order events were added
+        self._next_added = 0
+        self._by_date: List[tuple] = []
+        self._by_word: List[tuple] = []
+        for event in events or []:
+            self.add(event)
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __iter__(self) -> Iterator[Event]:
+        return iter(list(self._by_id.values()))
+
+    def __contains__(self, event_id: str) -> bool:
+        return event_id in self._by_id
+
+    def get(self, event_id: str) -> Optional[Event]:
+        return self._by_id.get(event_id)
+
+    def get_by_name(self, name: str) -> Optional[Event]:
+        events = self._by_name.get(name)
+        return events[0] if events else None
+
+    def add(self, event: Event):
+        eid = event.get_event_id()
+        if eid in self._by_id:
+            raise ValueError("Event id already exists")
+        self._by_id[eid] = event
+        self._added[eid] = self._next_added
+        self._next_added += 1
+        self._index_name(event.get_name(), event)
+        bisect.insort(self._by_date, (event.get_date(), eid))
+        self._index_words(event.get_name(), eid)
+        event._catalog = self
+
+    def remove(self, event_id: str):
+        event = self._by_id.pop(event_id, None)
+        if event is None:
+            return
+        self._unindex(event)
+        del self._added[event_id]
+        event._catalog = None
+
+    # Called by Event.set_name/set_date before the fields change
+    def reindex(self, event: Event, name: str, date: str):
+        self._unindex(event)
+        self._index_name(name, event)
+        bisect.insort(self._by_date, (date, event.get_event_id()))
+        self._index_words(name, event.get_event_id())
+
+    # A renamed event keeps its place among the events sharing its new name
+    def _index_name(self, name: str, event: Event):
+        bisect.insort(self._by_name.setdefault(name, []), event,
+                      key=lambda e: self._added[e.get_event_id()])
+
+    def _index_words(self, name: str, event_id: str):
+        for word in _search_words(name, event_id):
+            bisect.insort(self._by_word, (word, event_id))
+
+    def _unindex(self, event: Event):
+        events = self._by_name.get(event.get_name(), [])
+        if event in events:
+            events.remove(event)
+            if not events:
+                del self._by_name[event.get_name()]
+        key = (event.get_date(), event.get_event_id())
+        i = bisect.bisect_left(self._by_date, key)
+        if i < len(self._by_date) and self._by_date[i] == key:
+            del self._by_date[i]
+        for word in _search_words(event.get_name(), event.get_event_id()):
+            key = (word, event.get_event_id())
+            i = bisect.bisect_left(self._by_word, key)
+            if i < len(self._by_word) and self._by_word[i] == key:
+                del self._by_word[i]
+
+    # Events dated start..end inclusive, in date order
+    def between(self, start: str, end: str) -> List[Event]:
+        lo = bisect.bisect_left(self._by_date, (start,))
+        hi = bisect.bisect_right(self._by_date, (end, chr(0x10FFFF)))
+        return [self._by_id[eid] for _, eid in self._by_date[lo:hi]]
+
+    # Next n events on or after from_date (default today), in date order
+    def upcoming(self, n: int, from_date: Optional[str] = None) -> List[Event]:
+        if from_date is None:
+            from_date = datetime.date.today().isoformat()
+        lo = bisect.bisect_left(self._by_date, (from_date,))
+        return [self._by_id[eid] for _, eid in self._by_date[lo:lo + n]]
+
+    # Up to limit events in date order where some word of the name (or the
+    # id) starts with each word of the query, case-insensitively: "mon gr"
+    # finds "Monaco Grand Prix". Cost grows with the matches, not the catalog.
+    def search(self, query: str, limit: int = 50) -> List[Event]:
+        words = query.lower().split()
+        if not words:
+            return self.upcoming(limit, "")
+        # Scan the query word with the fewest candidates and check the others
+        ranges = [(bisect.bisect_left(self._by_word, (q,)),
+                   bisect.bisect_left(self._by_word, (q + chr(0x10FFFF),)), q) for q in words]
+        lo, hi, first = min(ranges, key=lambda r: r[1] - r[0])
+        rest = [q for q in words if q != first]
+        found = {}
+        for i in range(lo, hi):
+            if len(found) >= limit:
+                break
+            eid = self._by_word[i][1]
+            if eid in found:
+                continue
+            event = self._by_id[eid]
+            names = _search_words(event.get_name(), eid)
+            if all(any(w.startswith(q) for w in names) for q in rest):
+                found[eid] = event
+        return sorted(found.values(), key=lambda e: (e.get_date(), e.get_event_id()))
+
+
+def _search_words(name: str, event_id: str) -> set:
+    return set(name.lower().split()) | {event_id.lower()}
 
 
 # General Ticket
@@ -155,6 +526,81 @@ class GroupDiscount(Ticket):
         self._group_size = size
 
 
+# Ticket classes by type name, used to expand TicketBlocks back into tickets
+TICKET_CLASSES = {
+    "SingleRacePass": SingleRacePass,
+    "WeekendPackage": WeekendPackage,
+    "SeasonMembership": SeasonMembership,
+    "GroupDiscount": GroupDiscount,
+}
+
+
+# A run of identical tickets stored as one record. Ticket ids are
+# f"{prefix}_{n}" for n in start .. start + count - 1; individual Ticket
+# objects are only built while iterating.
+class TicketBlock:
+    __slots__ = ("_prefix", "_start", "_count", "_type", "_price", "_discount", "_group_size")
+
+    def __init__(self, prefix: str, start: int, count: int, ticket_type: str,
+                 price: float, discount: float = 0.0, group_size: Optional[int] = None):
+        self._prefix = prefix
+        self._start = start
+        self._count = count
+        self._type = ticket_type
+        self._price = price
+        self._discount = discount
+        self._group_size = group_size
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[Ticket]:
+        cls = TICKET_CLASSES.get(self._type)
+        for n in range(self._start, self._start + self._count):
+            ticket_id = f"{self._prefix}_{n}"
+            if cls is GroupDiscount:
+                yield GroupDiscount(ticket_id, self._price, self._group_size or self._count)
+            elif cls is not None:
+                yield cls(ticket_id, self._price)
+            else:
+                yield Ticket(ticket_id, self._price, self._type)
+
+    def get_prefix(self) -> str:
+        return self._prefix
+
+    def get_start(self) -> int:
+        return self._start
+
+    def get_count(self) -> int:
+        return self._count
+
+    def get_group_size(self) -> Optional[int]:
+        return self._group_size
+
+    def get_type(self) -> str:
+        return self._type
+
+    # Unit price before discount
+    def get_price(self) -> float:
+        return self._price
+
+    # Discount applied per ticket
+    def get_discount(self) -> float:
+        return self._discount
+
+    def set_discount(self, discount: float):
+        self._discount = discount
+
+    def get_ticket_ids(self) -> range:
+        return range(self._start, self._start + self._count)
+
+    def get_total_price(self) -> float:
+        return self._price * self._count
+
+    def get_discounted_total(self) -> float:
+        return (self._price - self._discount) * self._count
+
+
 # Payment details
 class Payment:
     def __init__(self, amount: float, method: str):
@@ -178,11 +624,20 @@ class Payment:
 
 # Reservation / Purchase Order
 class Reservation:
-    def __init__(self, reservation_id: str, event: Event, payment: Payment):
+    def __init__(self, reservation_id: str, event: Event, payment: Payment, date: Optional[str] = None):
         self._reservation_id = reservation_id
         self._event = event
         self._tickets: List[Ticket] = []
+        self._blocks: List[TicketBlock] = []
         self._payment = payment
+        self._date = date or datetime.date.today().isoformat()  # date of purchase
+
+    # Reservations pickled before ticket blocks existed only have _tickets,
+    # and older ones have no purchase date
+    def __setstate__(self, state):
+        state.setdefault("_blocks", [])
+        state.setdefault("_date", None)
+        self.__dict__.update(state)
 
     def get_reservation_id(self) -> str:
         return self._reservation_id
@@ -190,47 +645,194 @@ class Reservation:
     def get_event(self) -> Event:
         return self._event
 
+    # Used when loading: points the reservation at the canonical copy of its event
+    def restore_event(self, event: Event):
+        self._event = event
+
+    def get_date(self) -> Optional[str]:
+        return self._date
+
     def get_tickets(self) -> List[Ticket]:
+        return list(self.iter_tickets())
+
+    def iter_tickets(self) -> Iterator[Ticket]:
+        yield from self._tickets
+        for block in self._blocks:
+            yield from block
+
+    # Tickets added individually rather than as part of a block
+    def get_loose_tickets(self) -> List[Ticket]:
         return self._tickets
 
+    def get_blocks(self) -> List[TicketBlock]:
+        return self._blocks
+
+    def get_ticket_count(self) -> int:
+        return len(self._tickets) + sum(b.get_count() for b in self._blocks)
+
+    def get_payment(self) -> Payment:
+        return self._payment
+
     def add_ticket(self, ticket: Ticket):
-        if self._event.get_remaining_capacity() > 0:
-            self._tickets.append(ticket)
-            self._event.increment_tickets_sold(1)
-        else:
+        self.add_tickets([ticket])
+
+    # Claims capacity for the whole batch at once; on failure nothing is added
+    def add_tickets(self, tickets: List[Ticket]):
+        if not self._event.try_allocate(len(tickets)):
+            SOLD_OUT.inc()
             raise ValueError("Event sold out")
+        self._tickets.extend(tickets)
+
+    # Puts back persisted tickets without claiming capacity again; the
+    # event's sold count is persisted with the event itself
+    def restore_tickets(self, tickets: List[Ticket], blocks: List[TicketBlock]):
+        self._tickets.extend(tickets)
+        self._blocks.extend(blocks)
+
+    def add_block(self, block: TicketBlock):
+        if not self._event.try_allocate(block.get_count()):
+            SOLD_OUT.inc()
+            raise ValueError("Event sold out")
+        self._blocks.append(block)
+
+    # Adds a block whose seats were already set aside by a hold
+    def add_held_block(self, block: TicketBlock):
+        self._event.confirm_hold(block.get_count())
+        self._blocks.append(block)
 
     def get_total_price(self) -> float:
-        return sum(t.get_price() for t in self._tickets)
+        return (sum(t.get_price() for t in self._tickets)
+                + sum(b.get_total_price() for b in self._blocks))
+
+    # (ticket type, count, revenue) per block or loose ticket
+    def get_type_totals(self) -> List[tuple]:
+        return ([(t.get_type(), 1, t.get_price()) for t in self._tickets]
+                + [(b.get_type(), b.get_count(), b.get_discounted_total()) for b in self._blocks])
+
+
+def _add_to_total(analytics: Dict, dimension: str, key, count: int, revenue: float):
+    if key is None:
+        return
+    totals = analytics.setdefault(dimension, {}).setdefault(key, [0, 0.0])
+    totals[0] += count
+    totals[1] += revenue
+
+
+# Applies a sale record to a sales log (event id -> tickets) and to the
+# analytics totals ({dimension: {key: [count, revenue]}}). Records are
+#   ("log_sale", event_id, count)
+#   ("sale", sign, event_id, count, revenue, date, method, type_totals)
+# where sign is 1 for a sale and -1 for a cancellation.
+def apply_sale_record(sales: Dict[str, int], analytics: Dict, record: tuple):
+    if record[0] == "log_sale":
+        _, eid, count = record
+        sales[eid] = sales.get(eid, 0) + count
+        _add_to_total(analytics, "event", eid, count, 0.0)
+    elif record[0] == "sale":
+        _, sign, eid, count, revenue, date, method, type_totals = record
+        sales[eid] = sales.get(eid, 0) + sign * count
+        _add_to_total(analytics, "event", eid, sign * count, sign * revenue)
+        _add_to_total(analytics, "date", date, sign * count, sign * revenue)
+        _add_to_total(analytics, "method", method, sign * count, sign * revenue)
+        for ttype, n, rev in type_totals:
+            _add_to_total(analytics, "ticket_type", ttype, sign * n, sign * rev)
+
+
+def _sale_record(reservation: Reservation, sign: int) -> tuple:
+    payment = reservation.get_payment()
+    return ("sale", sign, reservation.get_event().get_event_id(), reservation.get_ticket_count(),
+            payment.get_amount(), reservation.get_date(), payment.get_method(),
+            tuple(reservation.get_type_totals()))
 
 
 # Manages persistence and administrative logic
 class SystemManager:
-    def __init__(self, data_file: str = "system_data.pkl"):
+    def __init__(self, data_file: str = "system_data.pkl", backend=None):
         self._data_file = data_file
+        self._backend = backend  # optional storage.StorageBackend; replaces the data_file pickle
         self._discount_rules = {}
+        self._pricing_rules: List[Dict] = []  # rule dicts understood by pricing.PricingEngine
+        self._rules_version = 0  # bumped whenever discounts or pricing rules change
         self._sales_log: Dict[str, int] = {}  # event_id -> tickets sold
+        # {"event"|"ticket_type"|"date"|"method": {key: [tickets, revenue]}}, kept up to date per sale
+        self._analytics: Dict[str, Dict] = {}
+        self._lock = threading.RLock()  # sales may be logged from booking worker threads
+        self._dirty = False  # changed since the last save_data
 
     def load_data(self):
+        if self._backend is not None:
+            self._set_data(self._backend.load_system())
+            return
         try:
             with open(self._data_file, "rb") as f:
-                data = pickle.load(f)
-                self._discount_rules = data.get("discounts", {})
-                self._sales_log = data.get("sales", {})
+                self._set_data(pickle.load(f))
         except FileNotFoundError:
             # No existing data; start fresh
             pass
 
+    def _set_data(self, data: Dict):
+        with self._lock:
+            self._discount_rules = data.get("discounts", {})
+            self._pricing_rules = data.get("pricing", [])
+            self._sales_log = data.get("sales", {})
+            self._analytics = data.get("analytics", {})
+            self._rules_version += 1
+            self._dirty = False
+
     def save_data(self):
-        data = {
-            "discounts": self._discount_rules,
-            "sales": self._sales_log
-        }
-        with open(self._data_file, "wb") as f:
-            pickle.dump(data, f)
+        with self._writing(), SYSTEM_SAVE_SECONDS.time():
+            data = {
+                "discounts": self._discount_rules,
+                "pricing": self._pricing_rules,
+                "sales": self._sales_log,
+                "analytics": self._analytics
+            }
+            if self._backend is not None:
+                self._backend.save_system(data)
+            else:
+                # Temp file plus rename, so a crash never leaves a half-written file
+                tmp = self._data_file + ".tmp"
+                with open(tmp, "wb") as f:
+                    pickle.dump(data, f)
+                os.replace(tmp, self._data_file)
+            self._dirty = False
+
+    def is_dirty(self) -> bool:
+        return self._dirty
+
+    # The backend's transaction is entered before the lock: booking threads
+    # log sales from inside one (see BookingEngine for the lock order)
+    @contextlib.contextmanager
+    def _writing(self):
+        with self._backend.batch() if self._backend is not None else contextlib.nullcontext(), self._lock:
+            yield
+
+    # Hands each change to the backend, which persists it incrementally
+    def _record(self, record):
+        self._dirty = True
+        if self._backend is not None:
+            self._backend.system_changed(record)
 
     def set_discount_rules(self, rules):
-        self._discount_rules = rules
+        with self._writing():
+            self._discount_rules = rules
+            self._rules_version += 1
+            self._record(("set_discount_rules", dict(rules)))
+
+    def get_discount_rules(self) -> Dict[str, float]:
+        return dict(self._discount_rules)
+
+    def set_pricing_rules(self, rules: List[Dict]):
+        with self._writing():
+            self._pricing_rules = [dict(r) for r in rules]
+            self._rules_version += 1
+            self._record(("set_pricing_rules", [dict(r) for r in rules]))
+
+    def get_pricing_rules(self) -> List[Dict]:
+        return [dict(r) for r in self._pricing_rules]
+
+    def get_rules_version(self) -> int:
+        return self._rules_version
 
     def calculate_discounts(self, ticket: Ticket) -> float:
         # Example: apply a flat discount if rule exists for type
@@ -239,6 +841,44 @@ class SystemManager:
     def track_sales(self) -> Dict[str, int]:
         return dict(self._sales_log)
 
+    def get_sales_analytics(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {dim: {key: list(totals) for key, totals in by_key.items()}
+                    for dim, by_key in self._analytics.items()}
+
+    # The backend takes the record first, so a failed write leaves the log unchanged
+    def _log(self, record: tuple):
+        with self._writing():
+            self._record(record)
+            apply_sale_record(self._sales_log, self._analytics, record)
+
     def log_sale(self, event: Event, count: int = 1):
-        eid = event.get_event_id()
-        self._sales_log[eid] = self._sales_log.get(eid, 0) + count
+        self._log(("log_sale", event.get_event_id(), count))
+
+    # A whole reservation, with its revenue, ticket types, date and payment method
+    def log_reservation(self, reservation: Reservation, sign: int = 1):
+        self._log(_sale_record(reservation, sign))
+
+    def log_cancellation(self, reservation: Reservation):
+        self.log_reservation(reservation, -1)
+
+    # Takes a logged sale (sign 1) or cancellation (sign -1) out of memory
+    # only, after the backend rolled back the transaction that recorded it
+    def forget_reservation(self, reservation: Reservation, sign: int = 1):
+        with self._lock:
+            apply_sale_record(self._sales_log, self._analytics, _sale_record(reservation, -sign))
+            self._dirty = True
+
+    # One-off backfill for data saved before analytics existed
+    def rebuild_analytics(self, customers):
+        analytics: Dict[str, Dict] = {}
+        for customer in customers:
+            for res in customer.get_reservations():
+                payment = res.get_payment()
+                apply_sale_record({}, analytics, ("sale", 1, res.get_event().get_event_id(),
+                                                  res.get_ticket_count(), payment.get_amount(),
+                                                  res.get_date(), payment.get_method(),
+                                                  tuple(res.get_type_totals())))
+        with self._lock:
+            self._analytics = analytics
+            self._dirty = True
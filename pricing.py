@@ -0,0 +1,153 @@
+import bisect
+import datetime
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # vectorized pricing is optional
+    np = None
+
+# Pricing rules are plain dicts so they persist anywhere. Every key is optional:
+#   "ticket_type": only orders of this type (default: all types)
+#   "percent":     percentage off the base price
+#   "flat":        amount off per ticket, after the percentage
+#   "min_qty", "max_qty":  quantity tier, inclusive bounds
+#   "min_group":   group-size rule; same as min_qty restricted to GroupDiscount
+#   "start", "end":        ISO dates bounding the order date, inclusive
+# All rules that match an order line stack: percentages add up (capped at
+# 100) and flat amounts add up. Unit prices never go below zero.
+
+
+def _ordinal(date: Optional[str]) -> int:
+    if date is None:
+        return datetime.date.today().toordinal()
+    return datetime.date.fromisoformat(date).toordinal()
+
+
+def _normalize(rule: Dict) -> Dict:
+    rule = dict(rule)
+    if "min_group" in rule:
+        rule["ticket_type"] = "GroupDiscount"
+        rule["min_qty"] = max(rule.get("min_qty", 0), rule.pop("min_group"))
+    return rule
+
+
+# A rule set compiled into a lookup table. Quantity and date thresholds of
+# all rules are merged into two sorted breakpoint lists; every (type, date
+# segment, quantity segment) cell holds the summed percentage and flat
+# discount, so pricing a line is two bisects and a table read.
+class PricingEngine:
+    def __init__(self, base_prices: Dict[str, float], rules: Iterable[Dict] = (),
+                 flat_discounts: Optional[Dict[str, float]] = None):
+        rules = [_normalize(r) for r in rules]
+        # SystemManager's per-type flat discounts are just one more kind of rule
+        for ttype, amount in (flat_discounts or {}).items():
+            rules.append({"ticket_type": ttype, "flat": amount})
+
+        self._types: List[str] = list(base_prices)
+        self._type_index = {t: i for i, t in enumerate(self._types)}
+        self._base = [base_prices[t] for t in self._types]
+
+        qty_points, date_points = set(), set()
+        for r in rules:
+            if "min_qty" in r:
+                qty_points.add(r["min_qty"])
+            if "max_qty" in r:
+                qty_points.add(r["max_qty"] + 1)
+            if "start" in r:
+                date_points.add(_ordinal(r["start"]))
+            if "end" in r:
+                date_points.add(_ordinal(r["end"]) + 1)
+        # Segment i covers [points[i-1], points[i]); segment 0 is everything below points[0]
+        self._qty_points = sorted(qty_points)
+        self._date_points = sorted(date_points)
+
+        # Representative value inside each segment, used to test rule bounds
+        qty_reps = [self._qty_points[0] - 1 if self._qty_points else 0] + self._qty_points
+        date_reps = [self._date_points[0] - 1 if self._date_points else 0] + self._date_points
+
+        # table[type][date segment][qty segment] = (percent, flat)
+        self._table: List[List[List[Tuple[float, float]]]] = []
+        for ttype in self._types:
+            by_date = []
+            for d in date_reps:
+                row = []
+                for q in qty_reps:
+                    percent = flat = 0.0
+                    for r in rules:
+                        if self._matches(r, ttype, q, d):
+                            percent += r.get("percent", 0.0)
+                            flat += r.get("flat", 0.0)
+                    row.append((min(percent, 100.0), flat))
+                by_date.append(row)
+            self._table.append(by_date)
+
+    @staticmethod
+    def _matches(rule: Dict, ttype: str, qty: int, date_ord: int) -> bool:
+        if rule.get("ticket_type") not in (None, ttype):
+            return False
+        if qty < rule.get("min_qty", qty) or qty > rule.get("max_qty", qty):
+            return False
+        if "start" in rule and date_ord < _ordinal(rule["start"]):
+            return False
+        if "end" in rule and date_ord > _ordinal(rule["end"]):
+            return False
+        return True
+
+    def get_ticket_types(self) -> List[str]:
+        return list(self._types)
+
+    def _cell(self, type_idx: int, qty: int, date_ord: int) -> Tuple[float, float]:
+        d = bisect.bisect_right(self._date_points, date_ord)
+        q = bisect.bisect_right(self._qty_points, qty)
+        return self._table[type_idx][d][q]
+
+    # (unit base price, discount per ticket) for one order line
+    def quote(self, ticket_type: str, qty: int, date: Optional[str] = None) -> Tuple[float, float]:
+        idx = self._type_index.get(ticket_type)
+        if idx is None:
+            raise ValueError(f"Unknown ticket type: {ticket_type}")
+        base = self._base[idx]
+        percent, flat = self._cell(idx, qty, _ordinal(date))
+        unit = max(base * (1 - percent / 100.0) - flat, 0.0)
+        return base, base - unit
+
+    # Totals for many (ticket_type, qty, date) lines in one call
+    def price_lines(self, lines: Iterable[Tuple[str, int, Optional[str]]]) -> List[float]:
+        # Date segments are cached per distinct date string; the hot loop is
+        # one bisect over the quantity breakpoints
+        type_index, base, table = self._type_index, self._base, self._table
+        qty_points, date_points = self._qty_points, self._date_points
+        segments: Dict[Optional[str], int] = {}
+        totals = []
+        for ttype, qty, date in lines:
+            idx = type_index.get(ttype)
+            if idx is None:
+                raise ValueError(f"Unknown ticket type: {ttype}")
+            d = segments.get(date)
+            if d is None:
+                d = segments[date] = bisect.bisect_right(date_points, _ordinal(date))
+            percent, flat = table[idx][d][bisect.bisect_right(qty_points, qty)]
+            unit = base[idx] * (1 - percent / 100.0) - flat
+            totals.append(unit * qty if unit > 0 else 0.0)
+        return totals
+
+    def price_order(self, lines: Iterable[Tuple[str, int, Optional[str]]]) -> float:
+        return sum(self.price_lines(lines))
+
+    # Column-oriented batch pricing: type indexes (see get_ticket_types),
+    # quantities and date ordinals. Uses NumPy when it is installed.
+    def price_columns(self, type_idx: Sequence[int], qtys: Sequence[int], date_ords: Sequence[int]):
+        if np is None:
+            return [max(self._base[t] * (1 - p / 100.0) - f, 0.0) * q
+                    for t, q, d in zip(type_idx, qtys, date_ords)
+                    for p, f in (self._cell(t, q, d),)]
+        cells = np.asarray(self._table, dtype=float)  # types x dates x qtys x (percent, flat)
+        t = np.asarray(type_idx)
+        q = np.asarray(qtys)
+        d = np.searchsorted(np.asarray(self._date_points, dtype=np.int64), np.asarray(date_ords), side="right")
+        qi = np.searchsorted(np.asarray(self._qty_points, dtype=np.int64), q, side="right")
+        percent = cells[t, d, qi, 0]
+        flat = cells[t, d, qi, 1]
+        base = np.asarray(self._base)[t]
+        return np.maximum(base * (1 - percent / 100.0) - flat, 0.0) * q
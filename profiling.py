@@ -0,0 +1,281 @@
+import atexit
+import collections
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+# On-demand profiling of chosen operations (purchase, save, load, report).
+# A sampling thread records the stacks of threads inside a profiled
+# operation every few milliseconds, so the cost is bounded by the interval
+# rather than by how many calls the operation makes. Results are written
+# per operation to the output directory:
+#   <op>.collapsed  stacks in the collapsed format flamegraph.pl and
+#                   speedscope read: "outer;inner;leaf <samples>"
+#   <op>.pstats     with deterministic=True, cProfile statistics
+#   profile.log     one line per captured operation with its duration
+# With a threshold only operations at least that slow are kept.
+# Turned on with BOOKING_PROFILE=<dir> (plus BOOKING_PROFILE_THRESHOLD_MS,
+# BOOKING_PROFILE_OPS and BOOKING_PROFILE_MODE=cprofile) or --profile.
+
+OPERATIONS = ("purchase", "save", "load", "report")
+SAMPLE_INTERVAL = 0.005
+MAX_DEPTH = 64
+
+
+class _NullContext:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullContext()
+
+
+class _Capture:
+    __slots__ = ("profiler", "operation", "stacks", "cprofile", "start", "thread_id")
+
+    def __init__(self, profiler: 'Profiler', operation: str):
+        self.profiler = profiler
+        self.operation = operation
+        self.stacks = collections.Counter()
+        self.cprofile = None
+
+    def __enter__(self):
+        self.thread_id = threading.get_ident()
+        self.cprofile = self.profiler._start_cprofile()
+        self.start = time.perf_counter()
+        self.profiler._begin(self)
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.profiler._end(self, elapsed)
+        return False
+
+
+class Profiler:
+    def __init__(self, output_dir: str, threshold: float = 0.0, operations: Optional[Iterable[str]] = None,
+                 interval: float = SAMPLE_INTERVAL, deterministic: bool = False):
+        self._output_dir = output_dir
+        self._threshold = threshold  # seconds
+        self._operations = frozenset(operations or OPERATIONS)
+        self._interval = interval
+        self._deterministic = deterministic
+        self._lock = threading.Lock()
+        self._active: Dict[int, _Capture] = {}
+        self._stacks: Dict[str, collections.Counter] = collections.defaultdict(collections.Counter)
+        self._stats: Dict[str, pstats.Stats] = {}
+        self._log = []
+        self._captured: Dict[str, int] = collections.Counter()
+        self._skipped: Dict[str, int] = collections.Counter()
+        # Only one cProfile can run at a time; others are sampled only
+        self._cprofile_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._closed = False
+
+    def get_output_dir(self) -> str:
+        return self._output_dir
+
+    def get_threshold(self) -> float:
+        return self._threshold
+
+    def get_operations(self) -> frozenset:
+        return self._operations
+
+    # {operation: (captured, skipped as faster than the threshold)}
+    def get_counts(self) -> Dict[str, Tuple[int, int]]:
+        with self._lock:
+            return {op: (self._captured[op], self._skipped[op])
+                    for op in set(self._captured) | set(self._skipped)}
+
+    def get_stacks(self, operation: str) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stacks.get(operation, {}))
+
+    def profile(self, operation: str):
+        if operation not in self._operations or self._closed:
+            return _NULL
+        return _Capture(self, operation)
+
+    def _start_cprofile(self) -> Optional[cProfile.Profile]:
+        if not self._deterministic or not self._cprofile_lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # another profiler (e.g. a debugger) is active
+            self._cprofile_lock.release()
+            return None
+        return profile
+
+    def _begin(self, capture: _Capture):
+        with self._lock:
+            if capture.thread_id in self._active:
+                # Nested operation (e.g. a save inside a purchase); the outer one records it
+                capture.thread_id = None
+                return
+            self._active[capture.thread_id] = capture
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+                self._sampler.start()
+        self._wakeup.set()
+
+    def _end(self, capture: _Capture, elapsed: float):
+        if capture.cprofile is not None:
+            capture.cprofile.disable()
+            self._cprofile_lock.release()
+        if capture.thread_id is None:
+            return
+        with self._lock:
+            del self._active[capture.thread_id]
+            op = capture.operation
+            if elapsed < self._threshold:
+                self._skipped[op] += 1
+                return
+            self._captured[op] += 1
+            self._stacks[op].update(capture.stacks)
+            self._log.append(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {op} {elapsed * 1000:.2f} ms "
+                             f"{sum(capture.stacks.values())} samples")
+            if capture.cprofile is not None:
+                if op in self._stats:
+                    self._stats[op].add(capture.cprofile)
+                else:
+                    self._stats[op] = pstats.Stats(capture.cprofile)
+
+    def _sample_loop(self):
+        while not self._closed:
+            with self._lock:
+                active = bool(self._active)
+                if active:
+                    frames = sys._current_frames()
+                    for capture in self._active.values():
+                        frame = frames.get(capture.thread_id)
+                        if frame is not None:
+                            capture.stacks[_collapse(frame)] += 1
+                    del frames
+            if active:
+                time.sleep(self._interval)
+            else:
+                self._wakeup.wait(0.1)
+                self._wakeup.clear()
+
+    # Writes every operation's files; called on close and safe to call any time
+    def flush(self):
+        os.makedirs(self._output_dir, exist_ok=True)
+        with self._lock:
+            stacks = {op: dict(counter) for op, counter in self._stacks.items()}
+            stats = dict(self._stats)
+            log, self._log = self._log, []
+        for op, counter in stacks.items():
+            tmp = os.path.join(self._output_dir, op + ".collapsed.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                for stack, count in sorted(counter.items()):
+                    f.write(f"{stack} {count}\n")
+            os.replace(tmp, os.path.join(self._output_dir, op + ".collapsed"))
+        for op, stat in stats.items():
+            stat.dump_stats(os.path.join(self._output_dir, op + ".pstats"))
+        if log:
+            with open(os.path.join(self._output_dir, "profile.log"), "a", encoding="utf-8") as f:
+                f.write("\n".join(log) + "\n")
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self.flush()
+
+
+# "module:function" frames, outermost first, joined with ";"; only the
+# innermost MAX_DEPTH frames are kept
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        code = frame.f_code
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        # Spaces and ";" would break the format (e.g. "<frozen runpy>")
+        names.append(f"{module}:{code.co_name}".replace(" ", "_").replace(";", "_"))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+_profiler: Optional[Profiler] = None
+
+
+def configure(output_dir: Optional[str], threshold: float = 0.0, operations: Optional[Iterable[str]] = None,
+              interval: float = SAMPLE_INTERVAL, deterministic: bool = False) -> Optional[Profiler]:
+    global _profiler
+    if _profiler is not None:
+        _profiler.close()
+    _profiler = None
+    if output_dir:
+        _profiler = Profiler(output_dir, threshold, operations, interval, deterministic)
+    return _profiler
+
+
+def get_profiler() -> Optional[Profiler]:
+    return _profiler
+
+
+# with profiling.profile("purchase"): ...  (does nothing unless profiling is on)
+def profile(operation: str):
+    if _profiler is None:
+        return _NULL
+    return _profiler.profile(operation)
+
+
+def close():
+    configure(None)
+
+
+def parse_operations(text: Optional[str]) -> Optional[Tuple[str, ...]]:
+    if not text:
+        return None
+    ops = tuple(op.strip() for op in text.split(",") if op.strip())
+    for op in ops:
+        if op not in OPERATIONS:
+            raise ValueError(f"Unknown operation to profile: {op}")
+    return ops
+
+
+def configure_from_environment() -> Optional[Profiler]:
+    env = os.environ
+    return configure(env.get("BOOKING_PROFILE"),
+                     float(env.get("BOOKING_PROFILE_THRESHOLD_MS") or 0) / 1000,
+                     parse_operations(env.get("BOOKING_PROFILE_OPS")),
+                     deterministic=env.get("BOOKING_PROFILE_MODE") == "cprofile")
+
+
+# Shared --profile flags for the GUI and the headless tools
+def add_arguments(parser):
+    parser.add_argument("--profile", metavar="DIR",
+                        help="profile operations and write collapsed stacks to DIR")
+    parser.add_argument("--profile-threshold", type=float, metavar="MS",
+                        help="keep only operations at least this many milliseconds long")
+    parser.add_argument("--profile-ops", type=parse_operations,
+                        help=f"comma-separated operations to profile (default: {','.join(OPERATIONS)})")
+    parser.add_argument("--profile-cprofile", action="store_true",
+                        help="also write deterministic cProfile statistics (<op>.pstats)")
+
+
+# Each flag given wins over its environment variable
+def configure_from_args(args) -> Optional[Profiler]:
+    env = os.environ
+    threshold = args.profile_threshold
+    if threshold is None:
+        threshold = float(env.get("BOOKING_PROFILE_THRESHOLD_MS") or 0)
+    return configure(args.profile or env.get("BOOKING_PROFILE"), threshold / 1000,
+                     args.profile_ops or parse_operations(env.get("BOOKING_PROFILE_OPS")),
+                     deterministic=args.profile_cprofile or env.get("BOOKING_PROFILE_MODE") == "cprofile")
+
+
+configure_from_environment()
+atexit.register(close)
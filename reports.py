@@ -0,0 +1,272 @@
+import argparse
+import heapq
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import profiling
+from objects import Customer, GroupDiscount, Reservation
+from sqlite_storage import SQLiteBackend
+from storage import (
+    CUSTOMERS_JOURNAL, PickleBackend, customer_snapshot_files, loads, read_lazy_index, read_snapshot
+)
+
+# Reservation-level reports (revenue by payment method, group-size
+# distribution, top customers by spend) computed map/reduce style: the
+# customers are split into partitions, each partition is reduced to a
+# ReportPartial on a worker process, and the parent merges the partials.
+# A customer is always in exactly one partition, so partials merge without
+# double counting. Partitions of a data directory are its shard files or
+# runs of its lazy snapshot's index, and workers read those themselves;
+# only the small partials cross the process boundary. A data directory is
+# reported as last saved: changes still in its journal are left out.
+
+TOP_CUSTOMERS = 10
+# Partitions per worker, so a slow partition doesn't leave the others idle
+PARTITIONS_PER_WORKER = 4
+
+
+class SnapshotChanged(ValueError):
+    pass
+
+
+# Totals for some of the customers; merge() adds another partial's
+class ReportPartial:
+    def __init__(self, top_n: int = TOP_CUSTOMERS):
+        self._top_n = top_n
+        self._customers = 0
+        self._reservations = 0
+        self._tickets = 0
+        self._revenue = 0.0
+        self._by_method: Dict[str, List] = {}  # method -> [tickets, revenue], as in the sales analytics
+        self._group_sizes: Dict[int, int] = {}  # group size -> groups booked
+        self._top: List[Tuple[float, str]] = []  # min-heap of the top_n (spend, username)
+
+    def add_customer(self, username: str, reservations: Iterable[Reservation]):
+        spend = 0.0
+        by_method, group_sizes = self._by_method, self._group_sizes
+        for res in reservations:
+            payment = res.get_payment()
+            amount = payment.get_amount()
+            tickets = res.get_ticket_count()
+            spend += amount
+            self._reservations += 1
+            self._tickets += tickets
+            totals = by_method.get(payment.get_method())
+            if totals is None:
+                totals = by_method[payment.get_method()] = [0, 0.0]
+            totals[0] += tickets
+            totals[1] += amount
+            for block in res.get_blocks():
+                if block.get_type() == "GroupDiscount":
+                    size = block.get_group_size() or block.get_count()
+                    group_sizes[size] = group_sizes.get(size, 0) + 1
+            # Loose group tickets of one reservation and size make up one group
+            for size in {t.get_group_size() for t in res.get_loose_tickets() if isinstance(t, GroupDiscount)}:
+                group_sizes[size] = group_sizes.get(size, 0) + 1
+        self._customers += 1
+        self._revenue += spend
+        if spend > 0:
+            self._offer((spend, username))
+
+    # Equal spends go to the later username, whatever the partitioning
+    def _offer(self, entry: Tuple[float, str]):
+        if len(self._top) < self._top_n:
+            heapq.heappush(self._top, entry)
+        elif entry > self._top[0]:
+            heapq.heapreplace(self._top, entry)
+
+    def merge(self, other: 'ReportPartial') -> 'ReportPartial':
+        self._customers += other._customers
+        self._reservations += other._reservations
+        self._tickets += other._tickets
+        self._revenue += other._revenue
+        for method, (tickets, revenue) in other._by_method.items():
+            totals = self._by_method.setdefault(method, [0, 0.0])
+            totals[0] += tickets
+            totals[1] += revenue
+        for size, groups in other._group_sizes.items():
+            self._group_sizes[size] = self._group_sizes.get(size, 0) + groups
+        for entry in other._top:
+            self._offer(entry)
+        return self
+
+    def get_customer_count(self) -> int:
+        return self._customers
+
+    def get_reservation_count(self) -> int:
+        return self._reservations
+
+    def to_dict(self) -> Dict:
+        return {
+            "customers": self._customers,
+            "reservations": self._reservations,
+            "tickets": self._tickets,
+            "revenue": self._revenue,
+            "by_method": {method: list(totals) for method, totals in sorted(self._by_method.items())},
+            "group_sizes": dict(sorted(self._group_sizes.items())),
+            "top_customers": [[username, spend] for spend, username in sorted(self._top, reverse=True)],
+        }
+
+
+# Partitions are tuples, so they pickle cheaply:
+#   ("file", path)                      a customer snapshot or shard file
+#   ("lazy", path, signature, rows)     (username, offset, length) rows of a lazy snapshot
+#   ("customers", rows)                 (username, reservations) rows already in memory
+# Runs on the worker processes.
+def map_partition(partition: Tuple, top_n: int = TOP_CUSTOMERS) -> ReportPartial:
+    partial = ReportPartial(top_n)
+    kind = partition[0]
+    if kind == "file":
+        for customer in read_snapshot(partition[1], {}):
+            partial.add_customer(customer.get_username(), customer.get_reservations())
+    elif kind == "lazy":
+        _, path, signature, rows = partition
+        with open(path, "rb") as f:
+            if _signature(os.fstat(f.fileno())) != signature:
+                # Rewritten by a compaction since the index was read
+                raise SnapshotChanged(f"{path} changed while the report was running")
+            for username, offset, length in rows:
+                f.seek(offset)
+                partial.add_customer(username, loads(f.read(length), {}))
+    elif kind == "customers":
+        for username, reservations in partition[1]:
+            partial.add_customer(username, reservations)
+    else:
+        raise ValueError(f"Unknown partition kind: {kind}")
+    return partial
+
+
+def _signature(stat: os.stat_result) -> Tuple[int, int]:
+    return stat.st_size, stat.st_mtime_ns
+
+
+# Contiguous runs of near-equal length
+def _split(items: list, parts: int) -> List[list]:
+    size = max(1, -(-len(items) // max(1, parts)))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def data_dir_partitions(data_dir: str, parts: int) -> List[Tuple]:
+    kind, paths = customer_snapshot_files(data_dir)
+    if kind != "lazy":
+        # A shard is the smallest unit a file can be read in
+        return [("file", path) for path in paths if os.path.exists(path)]
+    path = paths[0]
+    signature = _signature(os.stat(path))
+    rows = [(username, offset, length) for username, _, _, _, offset, length in read_lazy_index(path)]
+    if _signature(os.stat(path)) != signature:
+        raise SnapshotChanged(f"{path} changed while its index was read")
+    return [("lazy", path, signature, run) for run in _split(rows, parts)]
+
+
+# Customers already in this process; their reservations are pickled to the workers
+def customer_partitions(customers: Iterable[Customer], parts: int) -> List[Tuple]:
+    rows = [(c.get_username(), c.get_reservations()) for c in customers]
+    return [("customers", run) for run in _split(rows, parts)]
+
+
+def has_unsaved_changes(data_dir: str) -> bool:
+    journal = os.path.join(data_dir, CUSTOMERS_JOURNAL)
+    return any(os.path.exists(path) and os.path.getsize(path) for path in (journal, journal + ".old"))
+
+
+class ReportEngine:
+    def __init__(self, workers: Optional[int] = None, top_n: int = TOP_CUSTOMERS):
+        if workers is not None and workers < 1:
+            raise ValueError("Worker count must be at least 1.")
+        self._workers = workers or os.cpu_count() or 1
+        self._top_n = top_n
+
+    def get_workers(self) -> int:
+        return self._workers
+
+    # With one worker the partitions are reduced in this process. Partials
+    # are merged in partition order, so totals don't depend on timing.
+    def run(self, partitions: Sequence[Tuple]) -> ReportPartial:
+        total = ReportPartial(self._top_n)
+        if self._workers == 1 or len(partitions) < 2:
+            for partition in partitions:
+                total.merge(map_partition(partition, self._top_n))
+            return total
+        with ProcessPoolExecutor(max_workers=min(self._workers, len(partitions))) as pool:
+            for partial in pool.map(map_partition, partitions, [self._top_n] * len(partitions)):
+                total.merge(partial)
+        return total
+
+    def report_data_dir(self, data_dir: str, attempts: int = 3) -> Dict:
+        parts = self._workers * PARTITIONS_PER_WORKER
+        for attempt in range(attempts):
+            try:
+                return self.run(data_dir_partitions(data_dir, parts)).to_dict()
+            except SnapshotChanged:
+                if attempt == attempts - 1:
+                    raise
+
+    def report_customers(self, customers: Iterable[Customer]) -> Dict:
+        return self.run(customer_partitions(customers, self._workers * PARTITIONS_PER_WORKER)).to_dict()
+
+
+def report_lines(report: Dict) -> List[str]:
+    lines = [f"{report['customers']} customers, {report['reservations']} reservations, "
+             f"{report['tickets']} tickets, ${report['revenue']:.2f}", "", "Revenue by payment method"]
+    for method, (tickets, revenue) in report["by_method"].items():
+        lines.append(f"  {method}: {tickets} tickets, ${revenue:.2f}")
+    lines += ["", "Group sizes"]
+    for size, groups in report["group_sizes"].items():
+        lines.append(f"  {size} people: {groups} groups")
+    lines += ["", "Top customers by spend"]
+    for rank, (username, spend) in enumerate(report["top_customers"], 1):
+        lines.append(f"  {rank}. {username}: ${spend:.2f}")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reservation reports computed on several processes")
+    parser.add_argument("--data-dir", default=".")
+    parser.add_argument("--db", help="report on this SQLite database instead of the pickle files")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--top", type=int, default=TOP_CUSTOMERS, help="customers in the top-spenders list")
+    parser.add_argument("--save", action="store_true",
+                        help="fold journaled changes into the snapshot first, so they are included")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    profiling.add_arguments(parser)
+    args = parser.parse_args(argv)
+    profiling.configure_from_args(args)
+
+    engine = ReportEngine(args.workers, args.top)
+    start = time.perf_counter()
+    try:
+        with profiling.profile("report"):
+            if args.db:
+                backend = SQLiteBackend(args.db)
+                try:
+                    backend.load_events()
+                    report = engine.report_customers(backend.load_customers())
+                finally:
+                    backend.close()
+            else:
+                if args.save:
+                    backend = PickleBackend(args.data_dir)
+                    events = backend.load_events()
+                    backend.checkpoint(backend.load_customers(), events)
+                    backend.close()
+                elif has_unsaved_changes(args.data_dir):
+                    print("Note: changes since the last save are not included (use --save)", file=sys.stderr)
+                report = engine.report_data_dir(args.data_dir)
+    finally:
+        profiling.close()
+    elapsed = time.perf_counter() - start
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print("\n".join(report_lines(report)))
+    print(f"Reported on {report['reservations']} reservations in {elapsed:.2f}s "
+          f"with {engine.get_workers()} worker(s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import argparse
+import asyncio
+import functools
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import admission
+import metrics
+import profiling
+from admission import AdmissionController, Overloaded
+from service import BookingService, event_to_dict, reservation_to_dict
+from sqlite_storage import SQLiteBackend
+from storage import PickleBackend
+
+# Headless booking server speaking JSON lines over TCP. Each request is one
+# JSON object per line, e.g. {"op": "login", "username": "ahmed", "password": "1234"},
+# answered with {"ok": true, "result": ...} or {"ok": false, "error": "..."}.
+# A request "id" is echoed back. Login state is kept per connection.
+
+
+class BookingServer:
+    def __init__(self, service: BookingService, workers: int = 8):
+        self._service = service
+        # Purchases, cancellations and other journaled writes run here so
+        # file I/O never blocks the event loop
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def _blocking(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = {"customer": None, "admin": None}
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                response = await self.handle_line(session, line)
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def handle_line(self, session: Dict, line: bytes) -> Dict:
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {"ok": False, "error": "Malformed JSON"}
+        if not isinstance(request, dict):
+            return {"ok": False, "error": "Request must be a JSON object"}
+        response = {}
+        if "id" in request:
+            response["id"] = request["id"]
+        try:
+            response["result"] = await self.dispatch(session, request)
+            response["ok"] = True
+        except (ValueError, KeyError, TypeError, PermissionError) as e:
+            response["ok"] = False
+            response["error"] = str(e) if not isinstance(e, KeyError) else f"Missing field: {e.args[0]}"
+            if isinstance(e, Overloaded):
+                response["retry_after"] = round(e.retry_after, 3)
+        return response
+
+    async def dispatch(self, session: Dict, request: Dict):
+        op = request.get("op")
+        service = self._service
+
+        if op == "login":
+            if request.get("role", "customer") == "admin":
+                admin = service.login_admin(request["username"], request["password"])
+                if admin is None:
+                    raise PermissionError("Invalid admin credentials.")
+                session["admin"] = admin
+                return {"name": admin.get_name()}
+            customer = service.login(request["username"], request["password"])
+            if customer is None:
+                raise PermissionError("Invalid customer credentials.")
+            session["customer"] = customer
+            return {"name": customer.get_name()}
+
+        if op == "logout":
+            session["customer"] = session["admin"] = None
+            return None
+
+        if op == "create_account":
+            customer = await self._blocking(service.create_account, request["username"],
+                                            request["password"], request.get("name"))
+            return {"username": customer.get_username()}
+
+        if op == "list_events":
+            return [event_to_dict(e) for e in service.list_events()]
+
+        if op == "reservations":
+            customer = self._require_customer(session)
+            # Lazily loaded reservations may be read from storage
+            reservations = await self._blocking(customer.get_reservations)
+            return [reservation_to_dict(r) for r in reservations]
+
+        if op == "purchase":
+            customer = self._require_customer(session)
+            event = service.find_event(request["event"])
+            if event is None:
+                raise ValueError("Invalid event selected.")
+            res = await self._blocking(service.purchase, customer, event, request["ticket_type"],
+                                       int(request["qty"]), request.get("method", "Credit Card"))
+            return reservation_to_dict(res)
+
+        if op == "hold":
+            customer = self._require_customer(session)
+            event = service.find_event(request["event"])
+            if event is None:
+                raise ValueError("Invalid event selected.")
+            ttl = request.get("ttl")
+            hold = await self._blocking(service.hold, customer, event, int(request["qty"]),
+                                        None if ttl is None else float(ttl))
+            return {"hold_id": hold.get_hold_id(), "qty": hold.get_quantity(),
+                    "expires_in": hold.get_expires_at() - service.get_holds().now()}
+
+        if op == "confirm_hold":
+            customer = self._require_customer(session)
+            res = await self._blocking(service.confirm_hold, customer, request["hold_id"],
+                                       request["ticket_type"], request.get("method", "Credit Card"))
+            return reservation_to_dict(res)
+
+        if op == "release_hold":
+            customer = self._require_customer(session)
+            if not await self._blocking(service.release_hold, customer, request["hold_id"]):
+                raise ValueError("Hold expired or not found.")
+            return None
+
+        if op == "join_waitlist":
+            customer = self._require_customer(session)
+            event = service.find_event(request["event"])
+            if event is None:
+                raise ValueError("Invalid event selected.")
+            entry = await self._blocking(service.join_waitlist, customer, event, request["ticket_type"],
+                                         int(request["qty"]), request.get("method", "Credit Card"))
+            return {"entry_id": entry.get_entry_id(),
+                    "position": service.waitlist_position(entry.get_entry_id())}
+
+        if op == "leave_waitlist":
+            customer = self._require_customer(session)
+            if not await self._blocking(service.leave_waitlist, customer, request["entry_id"]):
+                raise ValueError("Not on the waitlist.")
+            return None
+
+        if op == "cancel":
+            customer = self._require_customer(session)
+            if not await self._blocking(service.cancel, customer, request["reservation_id"]):
+                raise ValueError("No such reservation.")
+            return None
+
+        if op == "sales_report":
+            return service.sales_report(self._require_admin(session), bool(request.get("detailed")))
+
+        if op == "set_discount":
+            admin = self._require_admin(session)
+            await self._blocking(service.set_discount, admin, request["ticket_type"],
+                                 float(request["amount"]))
+            return None
+
+        if op == "set_pricing_rules":
+            admin = self._require_admin(session)
+            await self._blocking(service.set_pricing_rules, admin, list(request["rules"]))
+            return None
+
+        raise ValueError(f"Unknown op: {op}")
+
+    @staticmethod
+    def _require_customer(session: Dict):
+        if session["customer"] is None:
+            raise PermissionError("Log in as a customer first.")
+        return session["customer"]
+
+    @staticmethod
+    def _require_admin(session: Dict):
+        if session["admin"] is None:
+            raise PermissionError("Log in as admin first.")
+        return session["admin"]
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8765) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.handle_client, host, port)
+
+    async def close(self):
+        # Final snapshot, also off the event loop
+        await self._blocking(self._service.close)
+        self._executor.shutdown(wait=True)
+
+
+async def serve(host: str, port: int, data_dir: str, db: Optional[str] = None,
+                cache_size: Optional[int] = None, admission_control: Optional[AdmissionController] = None,
+                compress_snapshots: bool = False):
+    if db:
+        backend = SQLiteBackend(db, cache_size)
+    else:
+        backend = PickleBackend(data_dir, cache_size=cache_size, compress_snapshots=compress_snapshots)
+    booking_server = BookingServer(BookingService(data_dir, backend, cache_size, admission=admission_control))
+    server = await booking_server.start(host, port)
+    print(f"Serving on {host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await booking_server.close()
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description="Headless Grand Prix booking server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--data-dir", default=".")
+    parser.add_argument("--db", help="use this SQLite database instead of the pickle files")
+    parser.add_argument("--cache-size", type=int,
+                        help="load reservations on demand, keeping this many customers in memory")
+    parser.add_argument("--compress-snapshots", action="store_true",
+                        help="zlib-compress the customer and event snapshot files (pickle storage)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="record metrics and serve them for Prometheus at /metrics on this port")
+    profiling.add_arguments(parser)
+    admission.add_arguments(parser)
+    args = parser.parse_args(argv)
+    profiling.configure_from_args(args)
+    if args.metrics_port is not None:
+        metrics.enable()
+        metrics.serve(args.metrics_port, args.host)
+        print(f"Metrics on http://{args.host}:{args.metrics_port}/metrics")
+    try:
+        asyncio.run(serve(args.host, args.port, args.data_dir, args.db, args.cache_size,
+                          admission.from_args(args), args.compress_snapshots))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        profiling.close()
+
+
+if __name__ == "__main__":
+    main()
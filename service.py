@@ -0,0 +1,283 @@
+import contextlib
+import threading
+from typing import Dict, List, Optional
+
+import metrics
+import profiling
+import reports
+from admission import AdmissionController
+from booking import BookingEngine
+from holds import HoldBook, SeatHold
+from waitlist import WaitlistEntry
+from objects import Admin, Customer, Event, EventCatalog, Reservation, SystemManager
+from pricing import PricingEngine
+from storage import PickleBackend, StorageBackend
+
+# Base price per ticket type
+TICKET_PRICES = {
+    "SingleRacePass": 100.0,
+    "WeekendPackage": 180.0,
+    "SeasonMembership": 800.0,
+    "GroupDiscount": 400.0,
+}
+
+PAYMENT_METHODS = ["Credit Card", "Digital Wallet"]
+
+# Customers whose reservations stay in memory when loading lazily
+CUSTOMER_CACHE_SIZE = 1000
+
+# Seconds a burst of changes is collected before the background writer saves it
+WRITE_DELAY = 0.5
+
+LOGIN_SECONDS = metrics.histogram("booking_login_seconds", "Customer login latency")
+PURCHASE_SECONDS = metrics.histogram("booking_purchase_seconds", "Ticket purchase latency, including rejections")
+CANCEL_SECONDS = metrics.histogram("booking_cancel_seconds", "Reservation cancellation latency")
+PURCHASES = metrics.counter("booking_purchases_total", "Completed purchases", ("ticket_type",))
+TICKETS_SOLD = metrics.counter("booking_tickets_sold_total", "Tickets sold", ("ticket_type",))
+CANCELLATIONS = metrics.counter("booking_cancellations_total", "Cancelled reservations")
+CUSTOMERS = metrics.gauge("booking_customers", "Registered customer accounts")
+SEATS_REMAINING = metrics.gauge("booking_seats_remaining", "Seats left per event", ("event",))
+
+
+def event_to_dict(event: Event) -> Dict:
+    return {
+        "event_id": event.get_event_id(),
+        "name": event.get_name(),
+        "date": event.get_date(),
+        "capacity": event.get_capacity(),
+        "remaining": event.get_remaining_capacity(),
+    }
+
+
+def reservation_to_dict(res: Reservation) -> Dict:
+    return {
+        "reservation_id": res.get_reservation_id(),
+        "event_id": res.get_event().get_event_id(),
+        "tickets": res.get_ticket_count(),
+        "total": res.get_total_price(),
+        "paid": res.get_payment().get_amount(),
+        "method": res.get_payment().get_method(),
+    }
+
+
+# Booking operations shared by the Tk GUI and the headless server. Every
+# mutation is handed to the storage backend before the method returns;
+# save() makes everything durable. Nothing here touches tkinter.
+# cache_size turns on lazy loading and write_delay background saves for the
+# default pickle backend. With an AdmissionController, purchases, holds and
+# waitlist joins pass its per-event rate limit, fair queue and per-account
+# ticket limit before reaching the booking engine.
+class BookingService:
+    def __init__(self, data_dir: str = ".", backend: Optional[StorageBackend] = None,
+                 cache_size: Optional[int] = None, write_delay: Optional[float] = None,
+                 admission: Optional[AdmissionController] = None):
+        if backend is None:
+            backend = PickleBackend(data_dir, cache_size=cache_size, write_delay=write_delay)
+        self._backend = backend
+        self._admission = admission
+        with profiling.profile("load"):
+            self._events = EventCatalog(self._backend.load_events())
+            self._customers = self._backend.load_customers()
+            self._system_manager = SystemManager(backend=self._backend)
+            self._system_manager.load_data()
+        if self._system_manager.track_sales() and not self._system_manager.get_sales_analytics():
+            # Data from before sales analytics were kept; backfill once
+            self._system_manager.rebuild_analytics(self._customers)
+        self._engine = BookingEngine(self._system_manager, on_promoted=self._promoted, backend=self._backend)
+        self._accounts_lock = threading.Lock()
+        self._pricing: Optional[PricingEngine] = None
+        self._pricing_version = -1
+        # Read at export time; the most recently opened service is reported
+        CUSTOMERS.set_function(lambda: len(self._customers))
+        SEATS_REMAINING.set_function(
+            lambda: {(e.get_event_id(),): e.get_remaining_capacity() for e in self._events})
+
+    def get_backend(self) -> StorageBackend:
+        return self._backend
+
+    def get_customers(self):
+        return self._customers
+
+    def get_events(self) -> EventCatalog:
+        return self._events
+
+    def get_system_manager(self) -> SystemManager:
+        return self._system_manager
+
+    # Accounts
+    def login(self, username: str, password: str) -> Optional[Customer]:
+        with LOGIN_SECONDS.time():
+            return self._customers.authenticate(username, password)
+
+    def login_admin(self, username: str, password: str) -> Optional[Admin]:
+        if username == "admin" and password == "admin":
+            return Admin(username, password, "Administrator")
+        return None
+
+    def create_account(self, username: str, password: str, name: Optional[str] = None) -> Customer:
+        if not username or not password:
+            raise ValueError("Enter username and password to create account.")
+        customer = Customer(username, password, name or username)
+        with self._accounts_lock:
+            self._customers.add(customer)
+        self._backend.account_created(customer)
+        return customer
+
+    def rename(self, customer: Customer, name: str):
+        if not name:
+            raise ValueError("Name cannot be empty.")
+        customer.set_name(name)
+        self._backend.name_changed(customer)
+
+    # Events and reservations
+    def list_events(self) -> List[Event]:
+        return list(self._events)
+
+    def find_event(self, key: str) -> Optional[Event]:
+        return self._events.get(key) or self._events.get_by_name(key)
+
+    # Compiled price table, rebuilt only after the rules change
+    def get_pricing(self) -> PricingEngine:
+        mgr = self._system_manager
+        version = mgr.get_rules_version()
+        if self._pricing is None or version != self._pricing_version:
+            self._pricing = PricingEngine(TICKET_PRICES, mgr.get_pricing_rules(), mgr.get_discount_rules())
+            self._pricing_version = version
+        return self._pricing
+
+    def purchase(self, customer: Customer, event: Event, ticket_type: str,
+                 qty: int, method: str) -> Reservation:
+        if ticket_type not in TICKET_PRICES:
+            raise ValueError(f"Unknown ticket type: {ticket_type}")
+        if qty <= 0:
+            raise ValueError("Quantity must be positive.")
+        with self._admit(customer, event, qty), PURCHASE_SECONDS.time(), profiling.profile("purchase"):
+            unit_price, discount = self.get_pricing().quote(ticket_type, qty)
+            res = self._engine.purchase(customer, event, ticket_type, qty, unit_price, method, discount)
+        PURCHASES.labels(ticket_type).inc()
+        TICKETS_SOLD.labels(ticket_type).inc(qty)
+        return res
+
+    # Raises admission.Overloaded (a ValueError with retry_after) when the event is too busy
+    def _admit(self, customer: Customer, event: Event, qty: int):
+        admission = self._admission
+        if admission is None:
+            return contextlib.nullcontext()
+        owned = None
+        if admission.get_max_tickets() is not None:
+            # Counted now, outside the admission lock; under it owned() only reads the counts
+            self._engine.get_claimed(customer, event)
+
+            def owned() -> int:
+                return self._engine.get_claimed(customer, event)
+        return admission.admit(customer.get_username(), event.get_event_id(), qty, owned)
+
+    # Seat holds: seats set aside while the customer pays. The hold sweeper
+    # thread starts with the first hold and stops on close().
+    def get_holds(self) -> HoldBook:
+        return self._engine.get_holds()
+
+    def hold(self, customer: Customer, event: Event, qty: int, ttl: Optional[float] = None) -> SeatHold:
+        with self._admit(customer, event, qty):
+            hold = self._engine.hold(customer, event, qty, ttl)
+        self._engine.get_holds().start()
+        return hold
+
+    def release_hold(self, customer: Customer, hold_id: str) -> bool:
+        return self._engine.release_hold(customer, hold_id)
+
+    # Not admitted again: the held seats already count toward the ticket limit
+    def confirm_hold(self, customer: Customer, hold_id: str, ticket_type: str, method: str) -> Reservation:
+        if ticket_type not in TICKET_PRICES:
+            raise ValueError(f"Unknown ticket type: {ticket_type}")
+        hold = self._engine.get_holds().get(hold_id)
+        qty = hold.get_quantity() if hold is not None else 1
+        with PURCHASE_SECONDS.time(), profiling.profile("purchase"):
+            unit_price, discount = self.get_pricing().quote(ticket_type, qty)
+            res = self._engine.confirm_hold(customer, hold_id, ticket_type, unit_price, method, discount)
+        PURCHASES.labels(ticket_type).inc()
+        TICKETS_SOLD.labels(ticket_type).inc(res.get_ticket_count())
+        return res
+
+    # Waitlist for sold-out events: the order is booked at today's price as
+    # soon as enough seats come back. priority puts an entry ahead of
+    # everyone with a lower one; equal priorities are first come, first served.
+    def join_waitlist(self, customer: Customer, event: Event, ticket_type: str, qty: int, method: str,
+                      priority: int = 0) -> WaitlistEntry:
+        if ticket_type not in TICKET_PRICES:
+            raise ValueError(f"Unknown ticket type: {ticket_type}")
+        unit_price, discount = self.get_pricing().quote(ticket_type, qty)
+        with self._admit(customer, event, qty):
+            return self._engine.join_waitlist(customer, event, ticket_type, qty, unit_price, method,
+                                              discount, priority)
+
+    def leave_waitlist(self, customer: Customer, entry_id: str) -> bool:
+        return self._engine.leave_waitlist(customer, entry_id)
+
+    # 1-based place in the queue, or None once booked or withdrawn
+    def waitlist_position(self, entry_id: str) -> Optional[int]:
+        return self._engine.get_waitlist().position(entry_id)
+
+    # Already stored by the engine
+    def _promoted(self, entry: WaitlistEntry, res: Reservation):
+        PURCHASES.labels(entry.get_ticket_type()).inc()
+        TICKETS_SOLD.labels(entry.get_ticket_type()).inc(res.get_ticket_count())
+
+    def cancel(self, customer: Customer, reservation_id: str) -> bool:
+        with CANCEL_SECONDS.time():
+            # Seats go back to the event, and from there to its waitlist
+            if self._engine.cancel(customer, reservation_id) is None:
+                return False
+        CANCELLATIONS.inc()
+        return True
+
+    # Administration
+    def sales_report(self, admin: Admin, detailed: bool = False) -> Dict:
+        with profiling.profile("report"):
+            return admin.view_sales_report(self._system_manager, detailed)
+
+    # Reservation-level report over every customer, on `workers` processes
+    # (see reports.py). Pickle data is saved first, so the workers can read
+    # the snapshot files themselves instead of being sent the customers.
+    def customer_report(self, admin: Admin, workers: Optional[int] = None,
+                        top_n: int = reports.TOP_CUSTOMERS) -> Dict:
+        engine = reports.ReportEngine(workers, top_n)
+        with profiling.profile("report"):
+            if isinstance(self._backend, PickleBackend):
+                self.save()
+                return engine.report_data_dir(self._backend.get_data_dir())
+            return engine.report_customers(self._customers)
+
+    # Sets the flat discount for one ticket type, keeping the others
+    def set_discount(self, admin: Admin, ticket_type: str, amount: float):
+        if ticket_type not in TICKET_PRICES:
+            raise ValueError(f"Unknown ticket type: {ticket_type}")
+        rules = self._system_manager.get_discount_rules()
+        rules[ticket_type] = amount
+        admin.update_discounts(self._system_manager, rules)
+
+    def set_pricing_rules(self, admin: Admin, rules: List[Dict]):
+        # Compiling validates the rules before they are stored
+        PricingEngine(TICKET_PRICES, rules)
+        admin.update_pricing_rules(self._system_manager, rules)
+
+    # Groups many operations into as few backend writes as possible. For a
+    # thread working alone (batch replays, data setup): the block holds the
+    # backend transaction ahead of the engine's locks, against the usual
+    # lock order, so bookings on other threads must not run meanwhile.
+    @contextlib.contextmanager
+    def batch(self):
+        with self._backend.batch():
+            yield self
+
+    # Makes everything durable; for pickles this also folds away the journals
+    def save(self):
+        with profiling.profile("save"):
+            self._backend.checkpoint(self._customers, list(self._events))
+            if self._system_manager.is_dirty():
+                self._system_manager.save_data()
+
+    def close(self):
+        self._engine.get_holds().stop()
+        self.save()
+        self._backend.close()
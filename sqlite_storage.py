@@ -0,0 +1,410 @@
+import contextlib
+import json
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from objects import (
+    Customer, CustomerRegistry, Event, GroupDiscount, Payment,
+    Reservation, TICKET_CLASSES, Ticket, TicketBlock, apply_sale_record
+)
+from storage import (
+    LOAD_CUSTOMERS_SECONDS, SAVE_CUSTOMERS_SECONDS, PickleBackend, StorageBackend,
+    password_of, sample_events
+)
+
+_SQLITE_SAVE = SAVE_CUSTOMERS_SECONDS.labels("sqlite")
+_SQLITE_LOAD = LOAD_CUSTOMERS_SECONDS.labels("sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS customers (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    name TEXT NOT NULL,
+    reservation_seq INTEGER
+);
+CREATE TABLE IF NOT EXISTS events (
+    event_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    date TEXT NOT NULL,
+    capacity INTEGER NOT NULL,
+    tickets_sold INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS events_by_date ON events(date);
+CREATE INDEX IF NOT EXISTS events_by_name ON events(name);
+CREATE TABLE IF NOT EXISTS reservations (
+    username TEXT NOT NULL REFERENCES customers(username) ON DELETE CASCADE ON UPDATE CASCADE,
+    reservation_id TEXT NOT NULL,
+    event_id TEXT NOT NULL REFERENCES events(event_id),
+    amount REAL NOT NULL,
+    method TEXT NOT NULL,
+    date TEXT,
+    PRIMARY KEY (username, reservation_id)
+);
+CREATE INDEX IF NOT EXISTS reservations_by_event ON reservations(event_id);
+CREATE TABLE IF NOT EXISTS ticket_blocks (
+    username TEXT NOT NULL,
+    reservation_id TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    price REAL NOT NULL,
+    discount REAL NOT NULL,
+    group_size INTEGER,
+    FOREIGN KEY (username, reservation_id) REFERENCES reservations(username, reservation_id)
+        ON DELETE CASCADE ON UPDATE CASCADE
+);
+CREATE INDEX IF NOT EXISTS ticket_blocks_by_reservation ON ticket_blocks(username, reservation_id);
+CREATE TABLE IF NOT EXISTS tickets (
+    username TEXT NOT NULL,
+    reservation_id TEXT NOT NULL,
+    ticket_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    price REAL NOT NULL,
+    group_size INTEGER,
+    FOREIGN KEY (username, reservation_id) REFERENCES reservations(username, reservation_id)
+        ON DELETE CASCADE ON UPDATE CASCADE
+);
+CREATE INDEX IF NOT EXISTS tickets_by_reservation ON tickets(username, reservation_id);
+CREATE TABLE IF NOT EXISTS discounts (
+    ticket_type TEXT PRIMARY KEY,
+    amount REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sales (
+    event_id TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sales_analytics (
+    dimension TEXT NOT NULL,
+    key TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    revenue REAL NOT NULL,
+    PRIMARY KEY (dimension, key)
+);
+"""
+
+# Columns added after the first schema version: table -> [(column, type)]
+ADDED_COLUMNS = {
+    "customers": [("reservation_seq", "INTEGER")],
+    "reservations": [("date", "TEXT")],
+}
+
+# Statements are module constants with ? parameters so sqlite3's statement
+# cache compiles each one once per connection
+INSERT_CUSTOMER = "INSERT INTO customers (username, password, name, reservation_seq) VALUES (?, ?, ?, ?)"
+UPDATE_NAME = "UPDATE customers SET name = ? WHERE username = ?"
+UPDATE_RESERVATION_SEQ = "UPDATE customers SET reservation_seq = ? WHERE username = ?"
+UPSERT_EVENT = ("INSERT INTO events (event_id, name, date, capacity, tickets_sold) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(event_id) DO UPDATE SET name = excluded.name, date = excluded.date, "
+                "capacity = excluded.capacity, tickets_sold = excluded.tickets_sold")
+UPDATE_TICKETS_SOLD = "UPDATE events SET tickets_sold = ? WHERE event_id = ?"
+INSERT_RESERVATION = ("INSERT INTO reservations (username, reservation_id, event_id, amount, method, date) "
+                      "VALUES (?, ?, ?, ?, ?, ?)")
+DELETE_RESERVATION = "DELETE FROM reservations WHERE username = ? AND reservation_id = ?"
+INSERT_BLOCK = ("INSERT INTO ticket_blocks (username, reservation_id, prefix, start, count, type, price, "
+                "discount, group_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+INSERT_TICKET = ("INSERT INTO tickets (username, reservation_id, ticket_id, type, price, group_size) "
+                 "VALUES (?, ?, ?, ?, ?, ?)")
+UPSERT_SALE = ("INSERT INTO sales (event_id, count) VALUES (?, ?) "
+               "ON CONFLICT(event_id) DO UPDATE SET count = count + excluded.count")
+INSERT_DISCOUNT = "INSERT INTO discounts (ticket_type, amount) VALUES (?, ?)"
+UPSERT_SETTING = ("INSERT INTO settings (key, value) VALUES (?, ?) "
+                  "ON CONFLICT(key) DO UPDATE SET value = excluded.value")
+UPSERT_ANALYTICS = ("INSERT INTO sales_analytics (dimension, key, count, revenue) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(dimension, key) DO UPDATE SET count = count + excluded.count, "
+                    "revenue = revenue + excluded.revenue")
+
+
+def _ticket_rows(username: str, res: Reservation) -> Tuple[List[tuple], List[tuple]]:
+    rid = res.get_reservation_id()
+    loose, blocks = [], []
+    for t in res.get_loose_tickets():
+        group = t.get_group_size() if isinstance(t, GroupDiscount) else None
+        loose.append((username, rid, t.get_ticket_id(), t.get_type(), t.get_price(), group))
+    for b in res.get_blocks():
+        blocks.append((username, rid, b.get_prefix(), b.get_start(), b.get_count(), b.get_type(),
+                       b.get_price(), b.get_discount(), b.get_group_size()))
+    return loose, blocks
+
+
+def _make_ticket(ticket_id: str, ticket_type: str, price: float, group_size) -> Ticket:
+    cls = TICKET_CLASSES.get(ticket_type)
+    if cls is GroupDiscount:
+        return GroupDiscount(ticket_id, price, group_size or 1)
+    if cls is not None:
+        return cls(ticket_id, price)
+    return Ticket(ticket_id, price, ticket_type)
+
+
+# Normalized SQLite storage in WAL mode. Every change hook is one
+# transaction, so a purchase is stored together with its tickets and the
+# event's updated sold count, or not at all. With a cache_size, customers'
+# reservations are queried on first access instead of at load time.
+class SQLiteBackend(StorageBackend):
+    def __init__(self, db_path: str = "booking.db", cache_size: Optional[int] = None):
+        self._db_path = db_path
+        self._cache_size = cache_size
+        self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(SCHEMA)
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            for column, kind in columns:
+                if column not in existing:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._events: Dict[str, Event] = {}  # canonical events reservations point at
+
+    # A nested batch() is a savepoint, so a failure inside an enclosing batch
+    # undoes only its own part. The change hooks nest without one: their
+    # caller's transaction or batch rolls back as a whole.
+    @contextlib.contextmanager
+    def _transaction(self, savepoint: bool = False):
+        with self._lock:
+            name = f"sp{self._depth}" if savepoint and self._depth else None
+            if self._depth == 0:
+                self._conn.execute("BEGIN IMMEDIATE")
+            elif name is not None:
+                self._conn.execute(f"SAVEPOINT {name}")
+            self._depth += 1
+            try:
+                yield self._conn
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._conn.execute("ROLLBACK")
+                elif name is not None:
+                    self._conn.execute(f"ROLLBACK TO {name}")
+                    self._conn.execute(f"RELEASE {name}")
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                self._conn.execute("COMMIT")
+            elif name is not None:
+                self._conn.execute(f"RELEASE {name}")
+
+    def batch(self):
+        return self._transaction(savepoint=True)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # Events
+    def load_events(self) -> List[Event]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT event_id, name, date, capacity, tickets_sold FROM events ORDER BY rowid").fetchall()
+        if not rows:
+            # Initialize sample events if none exist
+            events = sample_events()
+            self.save_events(events)
+            return events
+        events = []
+        for eid, name, date, capacity, sold in rows:
+            event = Event(eid, name, date, capacity)
+            event.increment_tickets_sold(sold)
+            event.clear_dirty()
+            events.append(event)
+        self._events = {e.get_event_id(): e for e in events}
+        return events
+
+    # Upserts; events are never deleted because reservations reference them
+    def save_events(self, events: List[Event]):
+        with self._transaction() as conn:
+            conn.executemany(UPSERT_EVENT, [
+                (e.get_event_id(), e.get_name(), e.get_date(), e.get_capacity(), e.get_tickets_sold())
+                for e in events])
+        self._events = {e.get_event_id(): e for e in events}
+
+    # Customers
+    def load_customers(self) -> CustomerRegistry:
+        with _SQLITE_LOAD.time():
+            if not self._events:
+                self.load_events()
+            customers = CustomerRegistry(cache_size=self._cache_size)
+            with self._lock:
+                for username, password, name, seq in self._conn.execute(
+                        "SELECT username, password, name, reservation_seq FROM customers ORDER BY rowid"):
+                    customer = Customer(username, password, name)
+                    customer.restore_reservation_seq(seq)
+                    customers.add(customer)
+                if self._cache_size is not None:
+                    for customer in customers:
+                        customer.set_loader(self._load_reservations)
+                        customer.unload()
+                    return customers
+                for username, reservations in self._fetch_reservations().items():
+                    customer = customers.get(username)
+                    for res in reservations:
+                        customer.add_reservation(res)
+                    customer.clear_dirty()
+            return customers
+
+    def _load_reservations(self, customer: Customer) -> List[Reservation]:
+        with self._lock:
+            return self._fetch_reservations(customer.get_username()).get(customer.get_username(), [])
+
+    # Reservations with their tickets per username, for everyone or one customer
+    def _fetch_reservations(self, username: Optional[str] = None) -> Dict[str, List[Reservation]]:
+        where, params = ("", ()) if username is None else (" WHERE username = ?", (username,))
+        tickets = defaultdict(list)
+        for user, rid, tid, ttype, price, group in self._conn.execute(
+                "SELECT username, reservation_id, ticket_id, type, price, group_size "
+                f"FROM tickets{where} ORDER BY rowid", params):
+            tickets[(user, rid)].append(_make_ticket(tid, ttype, price, group))
+        blocks = defaultdict(list)
+        for user, rid, prefix, start, count, ttype, price, disc, group in self._conn.execute(
+                "SELECT username, reservation_id, prefix, start, count, type, price, discount, group_size "
+                f"FROM ticket_blocks{where} ORDER BY rowid", params):
+            blocks[(user, rid)].append(TicketBlock(prefix, start, count, ttype, price, disc, group))
+        by_user = defaultdict(list)
+        for user, rid, eid, amount, method, date in self._conn.execute(
+                "SELECT username, reservation_id, event_id, amount, method, date "
+                f"FROM reservations{where} ORDER BY rowid", params):
+            event = self._events.get(eid) or Event(eid, eid, "", 0)
+            res = Reservation(rid, event, Payment(amount, method), date)
+            res.restore_tickets(tickets.pop((user, rid), []), blocks.pop((user, rid), []))
+            by_user[user].append(res)
+        return by_user
+
+    def save_customers(self, customers):
+        with _SQLITE_SAVE.time():
+            # Events only known through a reservation (e.g. from old pickles) are added first
+            extra = {}
+            for customer in customers:
+                for res in customer.get_reservations():
+                    event = res.get_event()
+                    if event.get_event_id() not in self._events:
+                        extra.setdefault(event.get_event_id(), event)
+            if extra:
+                self.save_events(list(self._events.values()) + list(extra.values()))
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM customers")  # cascades to reservations and tickets
+                conn.executemany(INSERT_CUSTOMER, [
+                    (c.get_username(), password_of(c), c.get_name(), c.get_reservation_seq()) for c in customers])
+                for customer in customers:
+                    for res in customer.get_reservations():
+                        self._insert_reservation(conn, customer.get_username(), res)
+
+    @staticmethod
+    def _insert_reservation(conn, username: str, res: Reservation):
+        payment = res.get_payment()
+        conn.execute(INSERT_RESERVATION, (username, res.get_reservation_id(),
+                                          res.get_event().get_event_id(),
+                                          payment.get_amount(), payment.get_method(), res.get_date()))
+        loose, blocks = _ticket_rows(username, res)
+        if loose:
+            conn.executemany(INSERT_TICKET, loose)
+        if blocks:
+            conn.executemany(INSERT_BLOCK, blocks)
+
+    # Customer data is written as it changes, so only events need saving
+    def checkpoint(self, customers, events: List[Event]):
+        self.save_events(events)
+        with self._lock:
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    # System data
+    def load_system(self) -> Dict:
+        with self._lock:
+            discounts = dict(self._conn.execute("SELECT ticket_type, amount FROM discounts"))
+            sales = dict(self._conn.execute("SELECT event_id, count FROM sales"))
+            row = self._conn.execute("SELECT value FROM settings WHERE key = 'pricing'").fetchone()
+            pricing = json.loads(row[0]) if row else []
+            analytics: Dict[str, Dict] = {}
+            for dimension, key, count, revenue in self._conn.execute(
+                    "SELECT dimension, key, count, revenue FROM sales_analytics"):
+                analytics.setdefault(dimension, {})[key] = [count, revenue]
+        return {"discounts": discounts, "pricing": pricing, "sales": sales, "analytics": analytics}
+
+    def save_system(self, data: Dict):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM discounts")
+            conn.executemany(INSERT_DISCOUNT, list(data["discounts"].items()))
+            conn.execute(UPSERT_SETTING, ("pricing", json.dumps(data.get("pricing", []))))
+            conn.execute("DELETE FROM sales")
+            conn.executemany("INSERT INTO sales (event_id, count) VALUES (?, ?)", list(data["sales"].items()))
+            conn.execute("DELETE FROM sales_analytics")
+            self._add_analytics(conn, data.get("analytics", {}))
+
+    @staticmethod
+    def _add_analytics(conn, analytics: Dict):
+        conn.executemany(UPSERT_ANALYTICS, [
+            (dimension, key, count, revenue)
+            for dimension, by_key in analytics.items()
+            for key, (count, revenue) in by_key.items()])
+
+    # Change hooks
+    def account_created(self, customer: Customer):
+        with self._transaction() as conn:
+            conn.execute(INSERT_CUSTOMER, (customer.get_username(), password_of(customer), customer.get_name(),
+                                           customer.get_reservation_seq()))
+        if self._cache_size is not None:
+            customer.set_loader(self._load_reservations)
+
+    def reservation_added(self, customer: Customer, reservation: Reservation):
+        event = reservation.get_event()
+        with self._transaction() as conn:
+            self._insert_reservation(conn, customer.get_username(), reservation)
+            conn.execute(UPDATE_RESERVATION_SEQ, (customer.get_reservation_seq(), customer.get_username()))
+            conn.execute(UPDATE_TICKETS_SOLD, (event.get_tickets_sold(), event.get_event_id()))
+
+    # The cancelled seats went back to the event, so its sold count is written too
+    def reservation_deleted(self, customer: Customer, reservation_id: str, event: Optional[Event] = None):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT event_id FROM reservations WHERE username = ? AND reservation_id = ?",
+                               (customer.get_username(), reservation_id)).fetchone()
+            conn.execute(DELETE_RESERVATION, (customer.get_username(), reservation_id))
+            event = self._events.get(row[0]) if row else None
+            if event is not None:
+                conn.execute(UPDATE_TICKETS_SOLD, (event.get_tickets_sold(), event.get_event_id()))
+
+    def name_changed(self, customer: Customer):
+        with self._transaction() as conn:
+            conn.execute(UPDATE_NAME, (customer.get_name(), customer.get_username()))
+
+    def system_changed(self, record: Tuple):
+        with self._transaction() as conn:
+            if record[0] == "set_discount_rules":
+                conn.execute("DELETE FROM discounts")
+                conn.executemany(INSERT_DISCOUNT, list(record[1].items()))
+                return
+            if record[0] == "set_pricing_rules":
+                conn.execute(UPSERT_SETTING, ("pricing", json.dumps(record[1])))
+                return
+            # Turn the record into per-row deltas and add them in place
+            sales, analytics = {}, {}
+            apply_sale_record(sales, analytics, record)
+            conn.executemany(UPSERT_SALE, list(sales.items()))
+            self._add_analytics(conn, analytics)
+
+
+# Copies everything in a pickle data directory into a SQLite database
+def migrate_pickles_to_sqlite(data_dir: str, db_path: str) -> Dict[str, int]:
+    source = PickleBackend(data_dir)
+    events = source.load_events()
+    customers = source.load_customers()
+    system = source.load_system()
+    target = SQLiteBackend(db_path)
+    try:
+        with target.batch():
+            target.save_events(events)
+            target.save_customers(customers)
+            target.save_system(system)
+    finally:
+        target.close()
+    return {
+        "customers": len(customers),
+        "events": len(events),
+        "reservations": sum(len(c.get_reservations()) for c in customers),
+    }
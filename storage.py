@@ -0,0 +1,1277 @@
+import contextlib
+import copy
+import io
+import json
+import os
+import pickle
+import shutil
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import codec
+import metrics
+from objects import Customer, CustomerRegistry, Event, Reservation, apply_sale_record
+
+# Default file names inside a data directory
+CUSTOMERS_FILE = "customers.pkl"
+EVENTS_FILE = "events.pkl"
+SYSTEM_FILE = "system_data.pkl"
+CUSTOMERS_JOURNAL = "customers.journal"
+SYSTEM_JOURNAL = "system_data.journal"
+LAZY_CUSTOMERS_FILE = "customers.lazy"
+SHARD_MANIFEST = "customers.manifest.json"
+
+DEFAULT_SHARDS = 16
+
+SAVE_CUSTOMERS_SECONDS = metrics.histogram("storage_save_customers_seconds",
+                                           "Time to write all customers (snapshot or compaction)", ("backend",))
+LOAD_CUSTOMERS_SECONDS = metrics.histogram("storage_load_customers_seconds",
+                                           "Time to load all customers at startup", ("backend",))
+_PICKLE_SAVE = SAVE_CUSTOMERS_SECONDS.labels("pickle")
+_PICKLE_LOAD = LOAD_CUSTOMERS_SECONDS.labels("pickle")
+
+# Each journal record is framed as <payload length><crc32 of payload><pickled payload>
+_RECORD_HEADER = struct.Struct("<II")
+# A lazy customer snapshot ends with the file offset of its index
+_LAZY_FOOTER = struct.Struct("<Q")
+
+
+# Events are stored in full only in events.pkl. Customer snapshots and
+# journal records store ("event", event_id) references instead, resolved
+# against the loaded events, so all reservations of an event share one
+# Event object and its sold count.
+class _EventRefPickler(pickle.Pickler):
+    def __init__(self, file, events: Dict[str, Event]):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._events = events
+
+    def persistent_id(self, obj):
+        # Events missing from the table are pickled in full so nothing is lost
+        if type(obj) is Event and obj.get_event_id() in self._events:
+            return ("event", obj.get_event_id())
+        return None
+
+
+class _EventRefUnpickler(pickle.Unpickler):
+    def __init__(self, file, events: Dict[str, Event]):
+        super().__init__(file)
+        self._events = events
+
+    def persistent_load(self, pid):
+        kind, event_id = pid
+        if kind != "event":
+            raise pickle.UnpicklingError(f"Unknown persistent id: {pid!r}")
+        event = self._events.get(event_id)
+        if event is None:
+            # Event removed since the reference was written; share one placeholder
+            # (setdefault, as shards may be unpickled on several threads)
+            event = self._events.setdefault(event_id, Event(event_id, event_id, "", 0))
+        return event
+
+
+# pickle.dumps/loads, with events by reference when an event table is given
+def dumps(obj, events: Optional[Dict[str, Event]] = None) -> bytes:
+    if events is None:
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    buf = io.BytesIO()
+    _EventRefPickler(buf, events).dump(obj)
+    return buf.getvalue()
+
+
+def loads(data: bytes, events: Optional[Dict[str, Event]] = None):
+    if events is None:
+        return pickle.loads(data)
+    return _EventRefUnpickler(io.BytesIO(data), events).load()
+
+
+# Snapshots written before events were stored by reference carry a private
+# Event copy per reservation; point those at the canonical event instead
+def share_events(reservations: Iterable[Reservation], events: Dict[str, Event],
+                 orphans: Optional[Dict[str, Event]] = None):
+    orphans = {} if orphans is None else orphans  # copies of events missing from the table
+    for res in reservations:
+        event = res.get_event()
+        event_id = event.get_event_id()
+        canonical = events.get(event_id) or orphans.setdefault(event_id, event)
+        if canonical is not event:
+            res.restore_event(canonical)
+
+
+def write_snapshot(path: str, obj, events: Optional[Dict[str, Event]] = None):
+    # Write to a temp file first so a crash never leaves a half-written snapshot
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        if events is None:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            _EventRefPickler(f, events).dump(obj)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# Customer and event snapshots are written in the binary format of
+# codec.py; snapshots pickled by earlier versions are still read
+def write_encoded(path: str, data: bytes):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_snapshot(path: str, events: Optional[Dict[str, Event]] = None) -> list:
+    with open(path, "rb") as f:
+        data = f.read()
+    if codec.is_encoded(data):
+        return codec.decode(data, events)
+    return loads(data, events)
+
+
+def write_customers(path: str, customers: List[Customer], events: Optional[Dict[str, Event]] = None,
+                    compress: bool = False):
+    write_encoded(path, codec.encode_customers(customers, events, compress))
+
+
+# Events created on first run
+def sample_events() -> List[Event]:
+    return [
+        Event("E1", "Friday Practice", "2025-11-21", 200),
+        Event("E2", "Qualifying", "2025-11-22", 200),
+        Event("E3", "Grand Prix Race", "2025-11-23", 200),
+    ]
+
+
+def password_of(customer: Customer) -> str:
+    # There is deliberately no password getter; persistence is the one
+    # place that needs the stored credential
+    return customer._password
+
+
+# True if path exists and was written after other (or other is missing)
+def _newer(path: Optional[str], other: str) -> bool:
+    if path is None or not os.path.exists(path):
+        return False
+    return not os.path.exists(other) or os.stat(path).st_mtime_ns > os.stat(other).st_mtime_ns
+
+
+# Lazy customer snapshots hold each customer's pickled reservation list,
+# followed by a pickled index of (username, password, name, reservation seq,
+# offset, length) rows and a footer pointing at the index. Opening one reads
+# only the index.
+def write_lazy_snapshot(path: str, rows: Iterable[Tuple[str, str, str, Optional[int], bytes]]) -> List[Tuple]:
+    index = _write_lazy_file(path + ".tmp", rows)
+    os.replace(path + ".tmp", path)
+    return index
+
+
+def _write_lazy_file(tmp: str, rows: Iterable[Tuple[str, str, str, Optional[int], bytes]]) -> List[Tuple]:
+    index = []
+    with open(tmp, "wb") as f:
+        for username, password, name, seq, blob in rows:
+            index.append((username, password, name, seq, f.tell(), len(blob)))
+            f.write(blob)
+        index_offset = f.tell()
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.write(_LAZY_FOOTER.pack(index_offset))
+        f.flush()
+        os.fsync(f.fileno())
+    return index
+
+
+def read_lazy_index(path: str) -> List[Tuple]:
+    with open(path, "rb") as f:
+        f.seek(-_LAZY_FOOTER.size, os.SEEK_END)
+        (index_offset,) = _LAZY_FOOTER.unpack(f.read(_LAZY_FOOTER.size))
+        f.seek(index_offset)
+        return pickle.load(f)
+
+
+# Every customer of a lazy snapshot, fully loaded
+def read_lazy_snapshot(path: str, events: Optional[Dict[str, Event]] = None) -> List[Customer]:
+    customers = []
+    with open(path, "rb") as f:
+        for username, password, name, seq, offset, length in read_lazy_index(path):
+            customer = Customer(username, password, name)
+            customer.restore_reservation_seq(seq)
+            f.seek(offset)
+            for res in loads(f.read(length), events):
+                customer.add_reservation(res)
+            customer.clear_dirty()
+            customers.append(customer)
+    return customers
+
+
+def load_events(path: str) -> List[Event]:
+    # Initialize sample events if none exist
+    if not os.path.exists(path):
+        sample = sample_events()
+        save_events(path, sample)
+        return sample
+    try:
+        return read_snapshot(path)
+    except Exception:
+        return []
+
+
+def save_events(path: str, events: List[Event], compress: bool = False):
+    write_encoded(path, codec.encode_events(events, compress))
+
+
+# An event's sold count inside a journal record. It pickles as (event id,
+# sold) read at the moment the record is written, and records are written
+# under the journal lock, so the last one for an event holds its newest count.
+class SoldCount:
+    __slots__ = ("_event",)
+
+    def __init__(self, event: Event):
+        self._event = event
+
+    def __reduce__(self):
+        return tuple, ((self._event.get_event_id(), self._event.get_tickets_sold()),)
+
+
+# Append-only log of mutations, one checksummed record per change
+class Journal:
+    def __init__(self, path: str, compact_threshold: int = 500,
+                 events: Optional[Dict[str, Event]] = None):
+        self._path = path
+        self._old_path = path + ".old"  # records set aside by a checkpoint in progress
+        self._compact_threshold = compact_threshold
+        self._events = events  # event table records refer to, if any
+        self._count = 0
+        self._lock = threading.Lock()
+        self._checkpoint_lock = threading.Lock()
+        self._batches: Dict[int, List[bytes]] = {}  # thread id -> records of its open batch()
+        self._before_drop = None
+
+    def get_path(self) -> str:
+        return self._path
+
+    # before_drop() runs once a checkpoint's snapshot is saved, just before
+    # the records set aside are deleted, to write anything else they cover
+    def set_before_drop(self, before_drop):
+        self._before_drop = before_drop
+
+    def __len__(self) -> int:
+        return self._count
+
+    # Pickled under the lock, so a SoldCount is read in append order
+    def append(self, record: Tuple):
+        with self._lock:
+            payload = dumps(record, self._events)
+            framed = _RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+            buffer = self._batches.get(threading.get_ident())
+            if buffer is not None:
+                buffer.append(framed)
+            else:
+                with open(self._path, "ab") as f:
+                    f.write(framed)
+                self._count += 1
+
+    # Appends the thread makes inside the block are written to disk with a
+    # single write when its outermost block ends. If a block raises, the
+    # records appended inside it are dropped instead. Each thread batches
+    # on its own.
+    @contextlib.contextmanager
+    def batch(self):
+        thread = threading.get_ident()
+        with self._lock:
+            buffer = self._batches.get(thread)
+            outermost = buffer is None
+            if outermost:
+                buffer = self._batches[thread] = []
+            mark = len(buffer)
+        try:
+            yield self
+        except BaseException:
+            with self._lock:
+                del buffer[mark:]
+            raise
+        finally:
+            if outermost:
+                self._flush(thread)
+
+    def _flush(self, thread: int):
+        with self._lock:
+            pending = self._batches.pop(thread)
+            if pending:
+                with open(self._path, "ab") as f:
+                    f.write(b"".join(pending))
+                self._count += len(pending)
+
+    # Records set aside by an unfinished checkpoint come first
+    def replay(self) -> Iterator[Tuple]:
+        self._count = 0
+        yield from self._replay_file(self._old_path)
+        yield from self._replay_file(self._path)
+
+    def _replay_file(self, path: str) -> Iterator[Tuple]:
+        # Yields every intact record; a torn or corrupt tail is cut off so
+        # later appends start on a clean record boundary
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return
+        good_end = 0
+        with f:
+            while True:
+                header = f.read(_RECORD_HEADER.size)
+                if len(header) < _RECORD_HEADER.size:
+                    break
+                length, checksum = _RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    break
+                good_end = f.tell()
+                self._count += 1
+                yield loads(payload, self._events)
+            tail = f.seek(0, os.SEEK_END)
+        if tail != good_end:
+            with open(path, "r+b") as f:
+                f.truncate(good_end)
+
+    def needs_compaction(self) -> bool:
+        return self._count >= self._compact_threshold
+
+    # Checkpoints let appends continue while the snapshot is written:
+    # begin_checkpoint() sets the records so far aside and later appends go
+    # to a fresh file. The caller then writes a snapshot holding at least
+    # the set-aside changes and calls end_checkpoint(True) to delete them.
+    # If the snapshot fails they stay and are replayed. One checkpoint runs
+    # at a time. Records still in an open batch are not set aside: they are
+    # written to the fresh file when their batch ends.
+    def begin_checkpoint(self):
+        self._checkpoint_lock.acquire()
+        try:
+            with self._lock:
+                if os.path.exists(self._old_path):
+                    # An earlier checkpoint failed; keep its records in order
+                    if os.path.exists(self._path):
+                        with open(self._path, "rb") as src, open(self._old_path, "ab") as dst:
+                            shutil.copyfileobj(src, dst)
+                        os.remove(self._path)
+                elif os.path.exists(self._path):
+                    os.replace(self._path, self._old_path)
+                self._count = 0
+        except BaseException:
+            self._checkpoint_lock.release()
+            raise
+
+    def end_checkpoint(self, saved: bool):
+        try:
+            if saved and os.path.exists(self._old_path):
+                if self._before_drop is not None:
+                    self._before_drop()
+                os.remove(self._old_path)
+        finally:
+            self._checkpoint_lock.release()
+
+    # Runs save(), which writes a snapshot, and drops the records it covers
+    def checkpoint(self, save):
+        self.begin_checkpoint()
+        saved = False
+        try:
+            save()
+            saved = True
+        finally:
+            self.end_checkpoint(saved)
+
+    def reset(self):
+        self.checkpoint(lambda: None)
+
+
+# Customer snapshot plus a journal of changes made since it was written.
+# If the data directory was last used in lazy mode, the newer lazy
+# snapshot is read instead.
+class CustomerStore:
+    def __init__(self, snapshot_file: str, journal_file: str, compact_threshold: int = 500,
+                 lazy_snapshot_file: Optional[str] = None, events: Optional[Dict[str, Event]] = None):
+        self._snapshot_file = snapshot_file
+        self._lazy_snapshot_file = lazy_snapshot_file
+        # Canonical events by id, shared with the backend and filled when it loads events
+        self._events = {} if events is None else events
+        self._journal = Journal(journal_file, compact_threshold, self._events)
+        self._customers = CustomerRegistry()
+        self._schedule_compaction = None
+        self._compacting = threading.Lock()
+        self._compress = False
+
+    def get_journal(self) -> Journal:
+        return self._journal
+
+    # With a scheduler (e.g. BackgroundWriter.schedule), a full journal asks
+    # for a compaction instead of compacting on the calling thread
+    def defer_compaction(self, schedule):
+        self._schedule_compaction = schedule
+
+    # Customer snapshots written from now on are zlib-compressed. Lazy
+    # snapshots are pickled per customer and stay as they are.
+    def compress_snapshots(self):
+        self._compress = True
+
+    def has_snapshot(self) -> bool:
+        return any(path is not None and os.path.exists(path)
+                   for path in (self._snapshot_file, self._lazy_snapshot_file))
+
+    def _read_snapshot(self) -> List[Customer]:
+        if _newer(self._lazy_snapshot_file, self._snapshot_file):
+            return read_lazy_snapshot(self._lazy_snapshot_file, self._events)
+        return read_snapshot(self._snapshot_file, self._events)
+
+    def load(self) -> CustomerRegistry:
+        try:
+            customers = CustomerRegistry(self._read_snapshot())
+        except Exception:
+            customers = CustomerRegistry()
+        for record in self._replay():
+            self._apply(record, customers)
+        orphans = {}
+        for customer in customers:
+            share_events(customer.get_reservations(), self._events, orphans)
+            customer.clear_dirty()
+        self._customers = customers
+        return customers
+
+    # Journal records, with the sold counts they carry put back on the events
+    def _replay(self) -> Iterator[Tuple]:
+        for record in self._journal.replay():
+            if record[0] in ("add_reservation", "delete_reservation") and len(record) > 3:
+                event_id, sold = record[3]
+                event = self._events.get(event_id)
+                if event is not None:
+                    event.restore_tickets_sold(sold)
+            yield record
+
+    def compact(self, customers: Optional[CustomerRegistry] = None):
+        if customers is not None:
+            self._customers = customers
+        self._journal.checkpoint(self._write_snapshot)
+
+    def _write_snapshot(self):
+        # Flags are cleared first: a change made while writing marks its customer again
+        customers = list(self._customers)
+        for customer in customers:
+            customer.clear_dirty()
+        write_customers(self._snapshot_file, customers, self._events, self._compress)
+
+    # Mutation records
+    def account_created(self, customer: Customer):
+        self._record(("create_account", customer))
+
+    # Reservation records carry the event's sold count: events.pkl is only
+    # written at checkpoints, and replay restores the count from the journal
+    def reservation_added(self, customer: Customer, reservation: Reservation):
+        self._record(("add_reservation", customer.get_username(), reservation,
+                      SoldCount(reservation.get_event())))
+
+    def reservation_deleted(self, customer: Customer, reservation_id: str, event: Optional[Event] = None):
+        record = ("delete_reservation", customer.get_username(), reservation_id)
+        self._record(record if event is None else record + (SoldCount(event),))
+
+    def name_changed(self, customer: Customer):
+        self._record(("set_name", customer.get_username(), customer.get_name()))
+
+    def _record(self, record: Tuple):
+        self._journal.append(record)
+        self._compact_if_due()
+
+    # Only one writer compacts; the others carry on appending instead of
+    # queueing up to compact the same journal one after another
+    def _compact_if_due(self):
+        if self._journal.needs_compaction():
+            if self._schedule_compaction is not None:
+                self._schedule_compaction()
+            elif self._compacting.acquire(blocking=False):
+                try:
+                    if self._journal.needs_compaction():
+                        self.compact()
+                finally:
+                    self._compacting.release()
+
+    # Replay is idempotent: a change made just before a compaction may be
+    # in both the snapshot and the journal
+    @staticmethod
+    def _apply(record: Tuple, customers: CustomerRegistry):
+        op = record[0]
+        if op == "create_account":
+            if record[1].get_username() not in customers:
+                customers.add(record[1])
+            return
+        customer = customers.get(record[1])
+        if customer is None:
+            return
+        if op == "add_reservation":
+            rid = record[2].get_reservation_id()
+            if all(r.get_reservation_id() != rid for r in customer.get_reservations()):
+                customer.add_reservation(record[2])
+        elif op == "delete_reservation":
+            customer.delete_reservation(record[2])
+        elif op == "set_name":
+            customer.set_name(record[2])
+
+
+# Applies an add/delete reservation record to a plain reservation list
+def _apply_to_reservations(reservations: List[Reservation], record: Tuple) -> List[Reservation]:
+    if record[0] == "add_reservation":
+        rid = record[2].get_reservation_id()
+        if all(r.get_reservation_id() != rid for r in reservations):
+            reservations.append(record[2])
+    elif record[0] == "delete_reservation":
+        reservations = [r for r in reservations if r.get_reservation_id() != record[2]]
+    return reservations
+
+
+# Customer store that starts from the credentials index of a lazy snapshot.
+# A customer's reservations are read from the snapshot on first access and
+# the journal records since the snapshot are applied on top; only
+# cache_size customers keep their reservations in memory.
+class LazyCustomerStore(CustomerStore):
+    def __init__(self, snapshot_file: str, journal_file: str, compact_threshold: int = 500,
+                 cache_size: int = 1000, eager_snapshot_file: Optional[str] = None,
+                 events: Optional[Dict[str, Event]] = None):
+        super().__init__(snapshot_file, journal_file, compact_threshold, events=events)
+        self._eager_snapshot_file = eager_snapshot_file
+        self._cache_size = cache_size
+        # Guards the offsets and pending records, which change together at compaction
+        self._index_lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._offsets: Dict[str, Tuple[int, int]] = {}
+        self._pending: Dict[str, List[Tuple]] = {}  # journaled reservation records per username
+
+    def load(self) -> CustomerRegistry:
+        with self._index_lock:
+            if _newer(self._eager_snapshot_file, self._snapshot_file):
+                # First lazy start on this data directory: convert the eager snapshot
+                self._customers = CustomerRegistry(read_snapshot(self._eager_snapshot_file, self._events))
+                self._offsets = {}
+                self._write_snapshot()
+                self._customers = CustomerRegistry()
+            try:
+                index = read_lazy_index(self._snapshot_file)
+            except Exception:
+                index = []
+            customers = CustomerRegistry(cache_size=self._cache_size)
+            self._offsets = {}
+            for username, password, name, seq, offset, length in index:
+                customer = Customer(username, password, name)
+                customer.restore_reservation_seq(seq)
+                customer.set_loader(self._load_reservations)
+                customer.unload()
+                customers.add(customer)
+                self._offsets[username] = (offset, length)
+            self._pending = {}
+            for record in self._replay():
+                self._apply(record, customers)
+                if record[0] == "create_account":
+                    customers.get(record[1].get_username()).set_loader(self._load_reservations)
+                elif record[0] != "set_name":
+                    self._pending.setdefault(record[1], []).append(record)
+            for customer in customers:
+                customer.clear_dirty()
+            self._customers = customers
+            return customers
+
+    # Journaled records are replayed onto loaded customers only; the others
+    # pick them up from the pending records when they are loaded
+    @staticmethod
+    def _apply(record: Tuple, customers: CustomerRegistry):
+        if record[0] in ("add_reservation", "delete_reservation"):
+            customer = customers.get(record[1])
+            if customer is not None and customer.is_loaded():
+                CustomerStore._apply(record, customers)
+            return
+        CustomerStore._apply(record, customers)
+
+    def _load_reservations(self, customer: Customer) -> List[Reservation]:
+        username = customer.get_username()
+        with self._index_lock:
+            reservations = []
+            span = self._offsets.get(username)
+            if span is not None:
+                with open(self._snapshot_file, "rb") as f:
+                    f.seek(span[0])
+                    reservations = loads(f.read(span[1]), self._events)
+            for record in self._pending.get(username, ()):
+                reservations = _apply_to_reservations(reservations, record)
+            share_events(reservations, self._events)
+            return reservations
+
+    def account_created(self, customer: Customer):
+        customer.set_loader(self._load_reservations)
+        super().account_created(customer)
+
+    # The pending record and the journal append happen together, so a
+    # compaction's cut splits both at the same point
+    def _record(self, record: Tuple):
+        with self._index_lock:
+            if record[0] in ("add_reservation", "delete_reservation"):
+                self._pending.setdefault(record[1], []).append(record)
+            self._journal.append(record)
+        self._compact_if_due()
+
+    # The snapshot is written without holding the index lock, so bookings
+    # and lazy loads carry on meanwhile; records made after the cut stay
+    # pending and are applied on top of the new snapshot
+    def compact(self, customers: Optional[CustomerRegistry] = None):
+        with self._compact_lock:
+            if customers is not None:
+                self._customers = customers
+            with self._index_lock:
+                self._journal.begin_checkpoint()
+                cut = {username: len(records) for username, records in self._pending.items()}
+            saved = False
+            try:
+                self._write_snapshot(cut)
+                saved = True
+            finally:
+                self._journal.end_checkpoint(saved)
+
+    # Customers without changes since the old snapshot have their blobs
+    # copied over as is; the others are pickled from memory or loaded
+    def _write_snapshot(self, cut: Optional[Dict[str, int]] = None):
+        with self._index_lock:
+            old = dict(self._offsets)
+        src = open(self._snapshot_file, "rb") if old else None
+
+        def rows():
+            for customer in self._customers:
+                username = customer.get_username()
+                changed = customer.is_dirty() or username in self._pending
+                customer.clear_dirty()
+                if username in old and not changed:
+                    src.seek(old[username][0])
+                    blob = src.read(old[username][1])
+                elif customer.is_loaded():
+                    blob = dumps(list(customer.get_reservations()), self._events)
+                else:
+                    blob = dumps(self._load_reservations(customer), self._events)
+                yield (username, password_of(customer), customer.get_name(),
+                       customer.get_reservation_seq(), blob)
+
+        tmp = self._snapshot_file + ".tmp"
+        try:
+            index = _write_lazy_file(tmp, rows())
+        finally:
+            if src is not None:
+                src.close()
+        with self._index_lock:
+            os.replace(tmp, self._snapshot_file)
+            self._offsets = {row[0]: (row[4], row[5]) for row in index}
+            for username, count in (cut or {}).items():
+                rest = self._pending.get(username, [])[count:]
+                if rest:
+                    self._pending[username] = rest
+                else:
+                    self._pending.pop(username, None)
+
+
+def shard_of(username: str, shards: int) -> int:
+    return zlib.crc32(username.encode("utf-8")) % shards
+
+
+def shard_file_name(index: int, shards: int) -> str:
+    return f"customers.{index:03d}-of-{shards:03d}.pkl"
+
+
+def read_manifest(path: str) -> Optional[Dict]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(path: str, files: List[str]):
+    manifest = {"version": 1, "hash": "crc32", "shards": len(files), "files": files}
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# The files holding a data directory's saved customers, picked as the
+# customer store would load them: ("shards", the shard files), ("lazy",
+# [lazy snapshot]) or ("single", [customers.pkl]). Changes still in the
+# journal are in none of them.
+def customer_snapshot_files(data_dir: str) -> Tuple[str, List[str]]:
+    manifest = read_manifest(os.path.join(data_dir, SHARD_MANIFEST))
+    if manifest is not None:
+        return "shards", [os.path.join(data_dir, name) for name in manifest["files"]]
+    lazy = os.path.join(data_dir, LAZY_CUSTOMERS_FILE)
+    if _newer(lazy, os.path.join(data_dir, CUSTOMERS_FILE)):
+        return "lazy", [lazy]
+    return "single", [os.path.join(data_dir, CUSTOMERS_FILE)]
+
+
+# Customer store split into shard files by a hash of the username, with a
+# small JSON manifest listing the files. Changes are journaled as usual; a
+# compaction rewrites only the shards whose customers changed since the
+# last one, and loading unpickles the shards on a thread pool. A shard that
+# cannot be read is renamed to *.corrupt and loading carries on without
+# it. Without a manifest, the single-file snapshot is read and split.
+class ShardedCustomerStore(CustomerStore):
+    def __init__(self, manifest_file: str, journal_file: str, compact_threshold: int = 500,
+                 shards: int = DEFAULT_SHARDS, snapshot_file: Optional[str] = None,
+                 lazy_snapshot_file: Optional[str] = None, events: Optional[Dict[str, Event]] = None,
+                 load_workers: int = 4):
+        if shards < 1:
+            raise ValueError("Shard count must be at least 1.")
+        super().__init__(snapshot_file, journal_file, compact_threshold, lazy_snapshot_file, events)
+        self._manifest_file = manifest_file
+        self._data_dir = os.path.dirname(manifest_file)
+        self._load_workers = load_workers
+        self._shards = shards
+        self._files = [shard_file_name(i, shards) for i in range(shards)]
+        self._members: List[Dict[str, Customer]] = [{} for _ in range(shards)]
+        self._dirty_shards: Set[int] = set()  # shards with journaled changes since the last cut
+        self._corrupt: List[str] = []
+        # Guards the members and dirty shards, which change together with the journal
+        self._shard_lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+
+    def get_shard_count(self) -> int:
+        return self._shards
+
+    def get_shard_files(self) -> List[str]:
+        return [os.path.join(self._data_dir, name) for name in self._files]
+
+    # Shards renamed aside at load because they could not be read
+    def get_corrupt_files(self) -> List[str]:
+        return list(self._corrupt)
+
+    def has_snapshot(self) -> bool:
+        return os.path.exists(self._manifest_file)
+
+    def _read_shard(self, path: str) -> List[Customer]:
+        try:
+            return read_snapshot(path, self._events)
+        except FileNotFoundError:
+            return []
+        except Exception:
+            # Kept for recovery by hand; the next write of the shard starts afresh
+            os.replace(path, path + ".corrupt")
+            self._corrupt.append(path + ".corrupt")
+            return []
+
+    def _assign(self, customers: Iterable[Customer]):
+        self._members = [{} for _ in range(self._shards)]
+        for customer in customers:
+            username = customer.get_username()
+            self._members[shard_of(username, self._shards)][username] = customer
+
+    def load(self) -> CustomerRegistry:
+        manifest = read_manifest(self._manifest_file)
+        if manifest is None:
+            # First sharded start on this data directory: split the single-file snapshot
+            try:
+                customers = CustomerRegistry(self._read_snapshot())
+            except Exception:
+                customers = CustomerRegistry()
+            dirty = set(range(self._shards))
+        else:
+            self._shards = manifest["shards"]
+            self._files = list(manifest["files"])
+            with ThreadPoolExecutor(max_workers=max(1, min(self._load_workers, self._shards))) as pool:
+                parts = list(pool.map(self._read_shard, self.get_shard_files()))
+            customers = CustomerRegistry([c for part in parts for c in part])
+            dirty = set()
+        for record in self._replay():
+            self._apply(record, customers)
+            username = record[1].get_username() if record[0] == "create_account" else record[1]
+            dirty.add(shard_of(username, self._shards))
+        orphans = {}
+        for customer in customers:
+            share_events(customer.get_reservations(), self._events, orphans)
+            customer.clear_dirty()
+        with self._shard_lock:
+            self._customers = customers
+            self._assign(customers)
+            self._dirty_shards = dirty
+        if manifest is None:
+            self.compact()
+        return customers
+
+    # The dirty shard and the journal append happen together, so a
+    # compaction's cut splits both at the same point
+    def _record(self, record: Tuple):
+        if record[0] == "create_account":
+            username = record[1].get_username()
+        else:
+            username = record[1]
+        index = shard_of(username, self._shards)
+        with self._shard_lock:
+            if record[0] == "create_account":
+                self._members[index][username] = record[1]
+            self._dirty_shards.add(index)
+            self._journal.append(record)
+        self._compact_if_due()
+
+    # Given a registry (a full save), shards holding customers changed
+    # outside the journal are written too, and all of them for a new registry
+    def compact(self, customers: Optional[CustomerRegistry] = None):
+        with self._compact_lock:
+            with self._shard_lock:
+                if customers is not None:
+                    if customers is not self._customers:
+                        self._customers = customers
+                        self._assign(customers)
+                        self._dirty_shards.update(range(self._shards))
+                    for index, members in enumerate(self._members):
+                        if any(c.is_dirty() for c in members.values()):
+                            self._dirty_shards.add(index)
+                self._journal.begin_checkpoint()
+                dirty, self._dirty_shards = self._dirty_shards, set()
+                shards = {i: list(self._members[i].values()) for i in dirty}
+            saved = False
+            try:
+                self._write_shards(shards)
+                # Written last: a data directory becomes sharded once every shard exists
+                if not os.path.exists(self._manifest_file):
+                    write_manifest(self._manifest_file, self._files)
+                saved = True
+            finally:
+                if not saved:
+                    with self._shard_lock:
+                        self._dirty_shards |= dirty
+                self._journal.end_checkpoint(saved)
+
+    def _write_shards(self, shards: Dict[int, List[Customer]]):
+        for index in sorted(shards):
+            customers = shards[index]
+            for customer in customers:
+                customer.clear_dirty()
+            write_customers(os.path.join(self._data_dir, self._files[index]), customers, self._events,
+                            self._compress)
+
+    # Writes every customer to a new set of shard files, then switches the
+    # manifest over to them. The journal is left alone.
+    def write_all(self, customers: CustomerRegistry):
+        with self._compact_lock, self._shard_lock:
+            self._customers = customers
+            self._files = [shard_file_name(i, self._shards) for i in range(self._shards)]
+            self._assign(customers)
+            self._write_shards({i: list(m.values()) for i, m in enumerate(self._members)})
+            write_manifest(self._manifest_file, self._files)
+            self._dirty_shards = set()
+
+
+def empty_system_data() -> Dict:
+    return {"discounts": {}, "pricing": [], "sales": {}, "analytics": {}}
+
+
+def _negated_sale(record: Tuple) -> Tuple:
+    if record[0] == "log_sale":
+        return record[:2] + (-record[2],)
+    return record[:1] + (-record[1],) + record[2:]
+
+
+# A record that undoes `record` once it has been applied to data
+def _system_undo(data: Dict, record: Tuple) -> Tuple:
+    if record[0] == "set_discount_rules":
+        return ("set_discount_rules", dict(data["discounts"]))
+    if record[0] == "set_pricing_rules":
+        return ("set_pricing_rules", [dict(r) for r in data["pricing"]])
+    return _negated_sale(record)
+
+
+# Applies a SystemManager change record to a system data dict
+def apply_system_record(data: Dict, record: Tuple):
+    if record[0] == "set_discount_rules":
+        data["discounts"] = dict(record[1])
+    elif record[0] == "set_pricing_rules":
+        data["pricing"] = [dict(r) for r in record[1]]
+    else:
+        apply_sale_record(data["sales"], data["analytics"], record)
+
+
+# Runs write() on a daemon thread shortly after the first change of a burst:
+# schedule() calls arriving within `delay` seconds share one write, and the
+# caller never waits for the disk. flush() writes synchronously; close()
+# flushes and stops the thread. An exception from a background write is
+# raised again by the next flush() or close().
+class BackgroundWriter:
+    def __init__(self, write, delay: float = 0.5):
+        self._write = write
+        self._delay = delay
+        self._cond = threading.Condition()
+        self._scheduled = False
+        self._closed = False
+        self._write_lock = threading.Lock()  # one write at a time
+        self._error: Optional[BaseException] = None
+        self._writes = 0
+        self._thread = threading.Thread(target=self._run, name="background-writer", daemon=True)
+        self._thread.start()
+
+    def get_write_count(self) -> int:
+        return self._writes
+
+    def schedule(self):
+        with self._cond:
+            if not self._scheduled:
+                self._scheduled = True
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._scheduled and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                # Let the rest of the burst arrive; close() cuts the wait short
+                deadline = time.monotonic() + self._delay
+                while not self._closed and time.monotonic() < deadline:
+                    self._cond.wait(deadline - time.monotonic())
+                if self._closed:
+                    return
+                self._scheduled = False
+            try:
+                self._run_write()
+            except Exception as e:
+                self._error = e
+
+    def _run_write(self):
+        with self._write_lock:
+            self._write()
+            self._writes += 1
+
+    def flush(self):
+        with self._cond:
+            self._scheduled = False
+        error, self._error = self._error, None
+        self._run_write()
+        if error is not None:
+            raise error
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+
+
+# Persistence interface used by BookingService and SystemManager.
+# load_*/save_* read and replace whole collections; the change hooks persist
+# a single mutation and are what the booking path calls.
+class StorageBackend:
+    def load_customers(self) -> CustomerRegistry:
+        raise NotImplementedError
+
+    def save_customers(self, customers):
+        raise NotImplementedError
+
+    def load_events(self) -> List[Event]:
+        raise NotImplementedError
+
+    def save_events(self, events: List[Event]):
+        raise NotImplementedError
+
+    def load_system(self) -> Dict:
+        raise NotImplementedError
+
+    def save_system(self, data: Dict):
+        raise NotImplementedError
+
+    # Change hooks
+    def account_created(self, customer: Customer):
+        raise NotImplementedError
+
+    def reservation_added(self, customer: Customer, reservation: Reservation):
+        raise NotImplementedError
+
+    # event is the reservation's event, whose sold count went down
+    def reservation_deleted(self, customer: Customer, reservation_id: str, event: Optional[Event] = None):
+        raise NotImplementedError
+
+    def name_changed(self, customer: Customer):
+        raise NotImplementedError
+
+    def system_changed(self, record: Tuple):
+        raise NotImplementedError
+
+    # Makes everything durable on shutdown (SystemManager saves its own data).
+    # Events go first: customer snapshots may refer to them by id.
+    def checkpoint(self, customers, events: List[Event]):
+        self.save_events(events)
+        self.save_customers(customers)
+
+    # Groups the changes made inside the block into as few writes as possible
+    @contextlib.contextmanager
+    def batch(self):
+        yield self
+
+    def close(self):
+        pass
+
+
+# Pickle snapshots plus append-only journals for customers and system data.
+# With a cache_size, customers are loaded lazily (see LazyCustomerStore).
+# With shards, or whenever the data directory has a shard manifest,
+# customers are kept in shard files (see ShardedCustomerStore); the
+# manifest then fixes the shard count and cache_size does not apply.
+# With a write_delay, the events file and journal compactions are written
+# by a BackgroundWriter instead of on the thread making the change.
+# compress_snapshots zlib-compresses the customer and event snapshots:
+# smaller files for some extra CPU on every save and load.
+class PickleBackend(StorageBackend):
+    def __init__(self, data_dir: str = ".", compact_threshold: int = 500,
+                 cache_size: Optional[int] = None, write_delay: Optional[float] = None,
+                 shards: Optional[int] = None, compress_snapshots: bool = False):
+        self._data_dir = data_dir
+        self._compress = compress_snapshots
+        self._events: Dict[str, Event] = {}  # canonical events, as last loaded or saved
+        if shards is not None or os.path.exists(self._path(SHARD_MANIFEST)):
+            self._customer_store = ShardedCustomerStore(self._path(SHARD_MANIFEST), self._path(CUSTOMERS_JOURNAL),
+                                                        compact_threshold,
+                                                        DEFAULT_SHARDS if shards is None else shards,
+                                                        self._path(CUSTOMERS_FILE),
+                                                        self._path(LAZY_CUSTOMERS_FILE), self._events)
+        elif cache_size is None:
+            self._customer_store = CustomerStore(self._path(CUSTOMERS_FILE), self._path(CUSTOMERS_JOURNAL),
+                                                 compact_threshold, self._path(LAZY_CUSTOMERS_FILE),
+                                                 self._events)
+        else:
+            self._customer_store = LazyCustomerStore(self._path(LAZY_CUSTOMERS_FILE),
+                                                     self._path(CUSTOMERS_JOURNAL), compact_threshold,
+                                                     cache_size, self._path(CUSTOMERS_FILE), self._events)
+        self._customer_store.get_journal().set_before_drop(self._write_dirty_events)
+        if compress_snapshots:
+            self._customer_store.compress_snapshots()
+        self._system_journal = Journal(self._path(SYSTEM_JOURNAL), compact_threshold)
+        # Mirror of the system data, so the journal can be compacted without
+        # asking the SystemManager for its state
+        self._system = empty_system_data()
+        self._system_lock = threading.Lock()  # the mirror and its journal change together
+        # thread id -> (record, undo) for the system changes of its open
+        # batch: already in the mirror, journaled when the batch ends
+        self._in_flight: Dict[int, List[Tuple]] = {}
+        self._events_lock = threading.RLock()  # one events.pkl write at a time
+        self._writer: Optional[BackgroundWriter] = None
+        if write_delay is not None:
+            self._writer = BackgroundWriter(self.write_dirty, write_delay)
+            self._customer_store.defer_compaction(self._writer.schedule)
+
+    def get_writer(self) -> Optional[BackgroundWriter]:
+        return self._writer
+
+    def get_data_dir(self) -> str:
+        return self._data_dir
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._data_dir, name)
+
+    def get_customer_store(self) -> CustomerStore:
+        return self._customer_store
+
+    # Reservations are resolved against the loaded events, so load those first
+    def load_customers(self) -> CustomerRegistry:
+        if not self._events:
+            self.load_events()
+        with _PICKLE_LOAD.time():
+            return self._customer_store.load()
+
+    def save_customers(self, customers):
+        with _PICKLE_SAVE.time():
+            self._customer_store.compact(customers)
+
+    def _set_events(self, events: List[Event]):
+        # Updated in place: the customer store holds the same dict
+        self._events.clear()
+        self._events.update((e.get_event_id(), e) for e in events)
+
+    def load_events(self) -> List[Event]:
+        events = load_events(self._path(EVENTS_FILE))
+        self._set_events(events)
+        return events
+
+    def save_events(self, events: List[Event]):
+        with self._events_lock:
+            # A change made while writing marks its event dirty again
+            for event in events:
+                event.clear_dirty()
+            save_events(self._path(EVENTS_FILE), events, self._compress)
+            self._set_events(events)
+
+    def load_system(self) -> Dict:
+        data = empty_system_data()
+        try:
+            with open(self._path(SYSTEM_FILE), "rb") as f:
+                saved = pickle.load(f)
+            for key in data:
+                data[key] = saved.get(key, data[key])
+        except FileNotFoundError:
+            pass
+        # Replay changes made since the last snapshot
+        for record in self._system_journal.replay():
+            apply_system_record(data, record)
+        self._system = copy.deepcopy(data)
+        return data
+
+    # Sale records are not idempotent, so the snapshot must match the
+    # journal cut exactly: both are taken under the system lock. Sales of
+    # open batches are journaled after the cut, so they are left out.
+    def save_system(self, data: Dict):
+        with self._system_lock:
+            self._system_journal.begin_checkpoint()
+            self._system = copy.deepcopy(data)
+            snapshot = copy.deepcopy(data)
+            for in_flight in self._in_flight.values():
+                for record, _ in in_flight:
+                    if record[0] in ("log_sale", "sale"):
+                        apply_system_record(snapshot, _negated_sale(record))
+        saved = False
+        try:
+            write_snapshot(self._path(SYSTEM_FILE), snapshot)
+            saved = True
+        finally:
+            self._system_journal.end_checkpoint(saved)
+
+    def _compact_system(self):
+        with self._system_lock:
+            data = self._system
+        self.save_system(data)
+
+    # Only what changed is written: clean events and an empty journal are skipped
+    def checkpoint(self, customers, events: List[Event]):
+        with self._events_lock:
+            if (any(e.is_dirty() for e in events) or len(events) != len(self._events)
+                    or any(self._events.get(e.get_event_id()) is not e for e in events)
+                    or not os.path.exists(self._path(EVENTS_FILE))):
+                self.save_events(events)
+        store = self._customer_store
+        if len(store.get_journal()) or not store.has_snapshot() or any(c.is_dirty() for c in customers):
+            self.save_customers(customers)
+
+    # The events file, if an event changed. Also run before a compaction
+    # drops journal records, whose sold counts must be on disk by then.
+    def _write_dirty_events(self):
+        with self._events_lock:
+            events = list(self._events.values())
+            if any(e.is_dirty() for e in events):
+                self.save_events(events)
+
+    # Background write: the events file if an event changed, plus any
+    # journal that is due for compaction
+    def write_dirty(self):
+        self._write_dirty_events()
+        if self._customer_store.get_journal().needs_compaction():
+            with _PICKLE_SAVE.time():
+                self._customer_store.compact()
+        if self._system_journal.needs_compaction():
+            self._compact_system()
+
+    def _changed(self):
+        if self._writer is not None:
+            self._writer.schedule()
+
+    def account_created(self, customer: Customer):
+        self._customer_store.account_created(customer)
+
+    # The event's sold count changed too
+    def reservation_added(self, customer: Customer, reservation: Reservation):
+        self._customer_store.reservation_added(customer, reservation)
+        self._changed()
+
+    def reservation_deleted(self, customer: Customer, reservation_id: str, event: Optional[Event] = None):
+        self._customer_store.reservation_deleted(customer, reservation_id, event)
+        self._changed()
+
+    def name_changed(self, customer: Customer):
+        self._customer_store.name_changed(customer)
+
+    # Called with the SystemManager's lock held
+    def system_changed(self, record: Tuple):
+        with self._system_lock:
+            in_flight = self._in_flight.get(threading.get_ident())
+            if in_flight is not None:
+                in_flight.append((record, _system_undo(self._system, record)))
+                apply_system_record(self._system, record)
+                return
+            apply_system_record(self._system, record)
+            self._system_journal.append(record)
+        self._compact_system_if_due()
+
+    def _compact_system_if_due(self):
+        if self._system_journal.needs_compaction():
+            if self._writer is not None:
+                self._writer.schedule()
+            else:
+                self._compact_system()
+
+    # If the block raises, its journal records are dropped and its system
+    # changes taken out of the mirror again. System records are journaled
+    # when the outermost block ends, together with leaving in-flight, so a
+    # snapshot never both holds and leaves out one of them.
+    @contextlib.contextmanager
+    def batch(self):
+        thread = threading.get_ident()
+        with self._system_lock:
+            in_flight = self._in_flight.get(thread)
+            outermost = in_flight is None
+            if outermost:
+                in_flight = self._in_flight[thread] = []
+            mark = len(in_flight)
+        try:
+            with self._customer_store.get_journal().batch():
+                yield self
+        except BaseException:
+            with self._system_lock:
+                for _, undo in reversed(in_flight[mark:]):
+                    apply_system_record(self._system, undo)
+                del in_flight[mark:]
+                if outermost:
+                    del self._in_flight[thread]
+            raise
+        if outermost:
+            with self._system_lock:
+                del self._in_flight[thread]
+                with self._system_journal.batch():
+                    for record, _ in in_flight:
+                        self._system_journal.append(record)
+            self._compact_system_if_due()
+
+    # Stops the background writer after a final write of whatever is pending
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+# Rewrites the customers of a pickle data directory into `shards` shard
+# files, or back into a single customers.pkl when shards is 0. The new
+# files are complete before the manifest is switched or removed, and the
+# journal is only cleared after that. Run it while nothing else uses the
+# data directory.
+def reshard(data_dir: str, shards: int) -> Dict[str, int]:
+    if shards < 0:
+        raise ValueError("Shard count cannot be negative.")
+    source = PickleBackend(data_dir)
+    events = source.load_events()
+    customers = source.load_customers()
+    old_store = source.get_customer_store()
+    old_files = old_store.get_shard_files() if isinstance(old_store, ShardedCustomerStore) else []
+    manifest = os.path.join(data_dir, SHARD_MANIFEST)
+    events_by_id = {e.get_event_id(): e for e in events}
+    if shards == 0:
+        write_customers(os.path.join(data_dir, CUSTOMERS_FILE), list(customers), events_by_id)
+        if os.path.exists(manifest):
+            os.remove(manifest)
+        new_files = []
+    else:
+        target = ShardedCustomerStore(manifest, os.path.join(data_dir, CUSTOMERS_JOURNAL),
+                                      shards=shards, events=events_by_id)
+        target.write_all(customers)
+        new_files = target.get_shard_files()
+    old_store.get_journal().reset()
+    for path in old_files:
+        if path not in new_files and os.path.exists(path):
+            os.remove(path)
+    return {"customers": len(customers), "shards": shards}
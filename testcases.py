@@ -1,12 +1,40 @@
+import asyncio
+import datetime
+import json
 import os
 import pickle
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from objects import (
     User, Customer, Admin,
     Event, Ticket, SingleRacePass, WeekendPackage,
     SeasonMembership, GroupDiscount, Payment,
-    Reservation, SystemManager
+    Reservation, SystemManager, CustomerRegistry, EventCatalog, TicketBlock
 )
+from storage import (
+    BackgroundWriter, Journal, CustomerStore, PickleBackend, write_snapshot,
+    read_snapshot, reshard, shard_of
+)
+from sqlite_storage import SQLiteBackend, migrate_pickles_to_sqlite
+from admission import AdmissionController, Overloaded, TokenBucket
+from booking import BookingEngine
+from holds import HoldBook, SeatHold
+from service import BookingService
+from server import BookingServer
+from batch import BatchProcessor, read_requests
+from loadtest import LoadGenerator, make_data_dir, parse_mix, percentile
+from pricing import PricingEngine
+from views import ReservationRows
+import benchmarks
+import codec
+import metrics
+import profiling
+import reports
 
 class TestUser(unittest.TestCase):
     def setUp(self):
@@ -42,6 +70,46 @@ class TestCustomer(unittest.TestCase):
         self.customer.delete_reservation("R1")
         self.assertEqual(len(self.customer.get_reservations()), 0)
 
+    def test_reservation_ids_not_reused(self):
+        event = Event("E1", "Race 1", "2025-06-10", 100)
+        first = self.customer.next_reservation_id()
+        self.customer.add_reservation(Reservation(first, event, Payment(0, "card")))
+        self.customer.delete_reservation(first)
+        self.assertEqual(first, "Sultan_1")
+        self.assertEqual(self.customer.next_reservation_id(), "Sultan_2")
+
+
+class TestCustomerRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = CustomerRegistry([Customer("ahmed", "pw", "ahmed"),
+                                          Customer("sultan", "pw2", "sultan")])
+
+    def test_lookup_and_authenticate(self):
+        self.assertEqual(len(self.registry), 2)
+        self.assertIn("ahmed", self.registry)
+        self.assertEqual(self.registry.get("sultan").get_name(), "sultan")
+        self.assertIsNone(self.registry.get("nobody"))
+        self.assertIsNotNone(self.registry.authenticate("sultan", "pw2"))
+        self.assertIsNone(self.registry.authenticate("sultan", "wrong"))
+
+    def test_duplicate_username_rejected(self):
+        with self.assertRaises(ValueError):
+            self.registry.add(Customer("ahmed", "x", "x"))
+
+    def test_set_username_keeps_index_consistent(self):
+        cust = self.registry.get("ahmed")
+        cust.set_username("ahmed2")
+        self.assertNotIn("ahmed", self.registry)
+        self.assertIs(self.registry.get("ahmed2"), cust)
+        with self.assertRaises(ValueError):
+            cust.set_username("sultan")
+        self.assertEqual(cust.get_username(), "ahmed2")
+
+    def test_pickle_drops_registry(self):
+        cust = pickle.loads(pickle.dumps(self.registry.get("ahmed")))
+        cust.set_username("renamed")
+        self.assertIn("ahmed", self.registry)
+
 
 class TestAdmin(unittest.TestCase):
     def setUp(self):
@@ -72,6 +140,95 @@ class TestEvent(unittest.TestCase):
         self.assertEqual(self.event.get_capacity(), 100)
 
 
+class TestEventCatalog(unittest.TestCase):
+    def setUp(self):
+        self.catalog = EventCatalog([
+            Event("E3", "Grand Prix Race", "2025-11-23", 200),
+            Event("E1", "Friday Practice", "2025-11-21", 200),
+            Event("E2", "Qualifying", "2025-11-22", 200),
+            Event("E4", "Season Opener", "2026-03-01", 500),
+        ])
+
+    def test_lookup_by_id_and_name(self):
+        self.assertEqual(self.catalog.get("E2").get_name(), "Qualifying")
+        self.assertEqual(self.catalog.get_by_name("Grand Prix Race").get_event_id(), "E3")
+        self.assertIsNone(self.catalog.get("E9"))
+        with self.assertRaises(ValueError):
+            self.catalog.add(Event("E1", "Dup", "2025-01-01", 1))
+
+    def test_date_range_queries(self):
+        ids = [e.get_event_id() for e in self.catalog.between("2025-11-22", "2025-11-23")]
+        self.assertEqual(ids, ["E2", "E3"])
+        ids = [e.get_event_id() for e in self.catalog.upcoming(2, "2025-11-22")]
+        self.assertEqual(ids, ["E2", "E3"])
+        self.assertEqual(self.catalog.upcoming(5, "2027-01-01"), [])
+
+    def test_setters_reindex(self):
+        event = self.catalog.get("E1")
+        event.set_name("Practice 1")
+        event.set_date("2026-04-01")
+        self.assertIsNone(self.catalog.get_by_name("Friday Practice"))
+        self.assertIs(self.catalog.get_by_name("Practice 1"), event)
+        ids = [e.get_event_id() for e in self.catalog.upcoming(3, "2026-01-01")]
+        self.assertEqual(ids, ["E4", "E1"])
+
+    def test_shared_names(self):
+        self.catalog.add(Event("E5", "Qualifying", "2026-03-02", 500))
+        self.catalog.add(Event("E6", "Qualifying", "2026-03-03", 500))
+        self.assertEqual(self.catalog.get_by_name("Qualifying").get_event_id(), "E2")
+        self.catalog.remove("E2")
+        self.assertEqual(self.catalog.get_by_name("Qualifying").get_event_id(), "E5")
+        self.catalog.get("E5").set_name("Sprint")
+        self.assertEqual(self.catalog.get_by_name("Qualifying").get_event_id(), "E6")
+        self.assertEqual(self.catalog.get_by_name("Sprint").get_event_id(), "E5")
+        self.catalog.remove("E6")
+        self.assertIsNone(self.catalog.get_by_name("Qualifying"))
+
+    def test_rename_keeps_order_among_shared_names(self):
+        self.catalog.add(Event("E5", "Qualifying", "2026-03-02", 500))
+        self.catalog.get("E2").set_name("Sprint")
+        self.catalog.get("E2").set_name("Qualifying")
+        self.assertEqual(self.catalog.get_by_name("Qualifying").get_event_id(), "E2")
+
+    def test_type_ahead_search(self):
+        def search(query, limit=50):
+            return [e.get_event_id() for e in self.catalog.search(query, limit)]
+        self.assertEqual(search("pr"), ["E1", "E3"])
+        self.assertEqual(search("PRIX gr"), ["E3"])
+        self.assertEqual(search("e4"), ["E4"])
+        self.assertEqual(search(""), ["E1", "E2", "E3", "E4"])
+        self.assertEqual(search("", 1), ["E1"])
+        self.assertEqual(search("race x"), [])
+        self.catalog.get("E1").set_name("Practice 1")
+        self.assertEqual(search("fri"), [])
+        self.assertEqual(search("practice"), ["E1"])
+        self.catalog.remove("E3")
+        self.assertEqual(search("pr"), ["E1"])
+
+
+class TestReservationRows(unittest.TestCase):
+    def test_pages_and_cached_rows(self):
+        event = Event("E1", "Race", "2026-03-01", 100)
+        customer = Customer("ana", "pw", "Ana")
+        for i in range(40):
+            res = Reservation(customer.next_reservation_id(), event, Payment(100.0, "Credit Card"))
+            res.add_ticket(SingleRacePass(f"T{i}", 100.0))
+            customer.add_reservation(res)
+        rows = ReservationRows()
+        self.assertEqual(len(rows), 0)
+        rows.set_customer(customer)
+        self.assertEqual(len(rows), 40)
+        page = rows.rows(10, 15)
+        self.assertEqual(page[0], "ID: ana_11 | Event: Race | Total: $100.00")
+        self.assertEqual(len(page), 5)
+        self.assertEqual(rows.get_cache_size(), 5)
+        self.assertIs(rows.rows(10, 11)[0], page[0])
+        customer.delete_reservation("ana_11")
+        self.assertEqual(rows.rows(10, 11), ["ID: ana_12 | Event: Race | Total: $100.00"])
+        rows.set_customer(Customer("bo", "pw", "Bo"))
+        self.assertEqual((len(rows), rows.get_cache_size()), (0, 0))
+
+
 class TestTickets(unittest.TestCase):
     def test_general_ticket(self):
         t = Ticket("T1", 150.0, "General")
@@ -135,6 +292,161 @@ class TestReservation(unittest.TestCase):
         with self.assertRaises(ValueError):
             self.res.add_ticket(SingleRacePass("S4", 140.0))
 
+    def test_add_tickets_is_all_or_nothing(self):
+        tickets = [SingleRacePass(f"S{i}", 100.0) for i in range(3)]
+        with self.assertRaises(ValueError):
+            self.res.add_tickets(tickets)
+        self.assertEqual(self.res.get_tickets(), [])
+        self.assertEqual(self.event.get_tickets_sold(), 0)
+
+        self.res.add_tickets(tickets[:2])
+        self.assertEqual(len(self.res.get_tickets()), 2)
+        self.assertEqual(self.event.get_remaining_capacity(), 0)
+
+    def test_try_allocate(self):
+        self.assertFalse(self.event.try_allocate(3))
+        self.assertTrue(self.event.try_allocate(2))
+        self.assertFalse(self.event.try_allocate(1))
+        self.assertEqual(self.event.get_tickets_sold(), 2)
+
+
+class TestTicketBlock(unittest.TestCase):
+    def setUp(self):
+        self.event = Event("E6", "Race 6", "2025-10-01", 1000)
+        self.res = Reservation("R7", self.event, Payment(0, "card"))
+
+    def test_block_expands_lazily(self):
+        block = TicketBlock("R7", 1, 3, "GroupDiscount", 400.0, 5.0, group_size=3)
+        tickets = list(block)
+        self.assertEqual([t.get_ticket_id() for t in tickets], ["R7_1", "R7_2", "R7_3"])
+        self.assertIsInstance(tickets[0], GroupDiscount)
+        self.assertEqual(tickets[0].get_group_size(), 3)
+        self.assertEqual(block.get_total_price(), 1200.0)
+        self.assertEqual(block.get_discounted_total(), 1185.0)
+
+    def test_reservation_with_blocks(self):
+        self.res.add_ticket(SingleRacePass("R7_0", 100.0))
+        self.res.add_block(TicketBlock("R7", 1, 500, "SeasonMembership", 800.0))
+        self.assertEqual(self.res.get_ticket_count(), 501)
+        self.assertEqual(self.res.get_total_price(), 100.0 + 500 * 800.0)
+        self.assertEqual(self.event.get_tickets_sold(), 501)
+        self.assertEqual(len(self.res.get_tickets()), 501)
+
+        with self.assertRaises(ValueError):
+            self.res.add_block(TicketBlock("R7", 501, 500, "SingleRacePass", 100.0))
+        self.assertEqual(self.event.get_tickets_sold(), 501)
+
+    def test_block_pickles_smaller_than_tickets(self):
+        loose = Reservation("R8", Event("E7", "Race 7", "2025-10-01", 1000), Payment(0, "card"))
+        loose.add_tickets([SingleRacePass(f"R8_{i+1}", 100.0) for i in range(200)])
+        self.res.add_block(TicketBlock("R7", 1, 200, "SingleRacePass", 100.0))
+        self.assertLess(len(pickle.dumps(self.res)) * 10, len(pickle.dumps(loose)))
+
+    def test_old_reservation_pickle_still_loads(self):
+        self.res.add_ticket(SingleRacePass("S1", 120.0))
+        del self.res.__dict__["_blocks"]
+        restored = pickle.loads(pickle.dumps(self.res))
+        self.assertEqual(restored.get_total_price(), 120.0)
+        self.assertEqual(restored.get_blocks(), [])
+
+
+class TestSalesAnalytics(unittest.TestCase):
+    def setUp(self):
+        self.mgr = SystemManager()
+        self.event = Event("E1", "Race 1", "2025-11-23", 100)
+
+    def _reservation(self, rid, ttype, qty, price, method, date):
+        res = Reservation(rid, self.event, Payment(qty * price, method), date)
+        res.add_block(TicketBlock(rid, 1, qty, ttype, price))
+        return res
+
+    def test_sales_and_cancellations_update_totals(self):
+        r1 = self._reservation("R1", "SingleRacePass", 2, 100.0, "Credit Card", "2025-10-01")
+        r2 = self._reservation("R2", "WeekendPackage", 1, 180.0, "Digital Wallet", "2025-10-02")
+        self.mgr.log_reservation(r1)
+        self.mgr.log_reservation(r2)
+        report = Admin("admin", "admin", "Administrator").view_sales_report(self.mgr, detailed=True)
+        self.assertEqual(report["event"], {"E1": [3, 380.0]})
+        self.assertEqual(report["ticket_type"], {"SingleRacePass": [2, 200.0], "WeekendPackage": [1, 180.0]})
+        self.assertEqual(report["date"], {"2025-10-01": [2, 200.0], "2025-10-02": [1, 180.0]})
+        self.assertEqual(report["method"], {"Credit Card": [2, 200.0], "Digital Wallet": [1, 180.0]})
+
+        self.mgr.log_cancellation(r1)
+        report = self.mgr.get_sales_analytics()
+        self.assertEqual(report["event"], {"E1": [1, 180.0]})
+        self.assertEqual(report["date"]["2025-10-01"], [0, 0.0])
+        self.assertEqual(self.mgr.track_sales(), {"E1": 1})
+
+    def test_rebuild_matches_incremental(self):
+        cust = Customer("ahmed", "pw", "ahmed")
+        for i, method in enumerate(["Credit Card", "Digital Wallet", "Credit Card"]):
+            res = self._reservation(f"R{i}", "GroupDiscount", 4, 400.0, method, "2025-10-01")
+            cust.add_reservation(res)
+            self.mgr.log_reservation(res)
+        incremental = self.mgr.get_sales_analytics()
+        self.mgr.rebuild_analytics([cust])
+        self.assertEqual(self.mgr.get_sales_analytics(), incremental)
+
+    def test_analytics_persist(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.mgr = SystemManager(os.path.join(tmp, "system_data.pkl"))
+            self.mgr.log_reservation(self._reservation("R1", "SeasonMembership", 1, 800.0, "Credit Card", "2025-10-01"))
+            self.mgr.save_data()
+            mgr2 = SystemManager(os.path.join(tmp, "system_data.pkl"))
+            mgr2.load_data()
+            self.assertEqual(mgr2.get_sales_analytics()["ticket_type"], {"SeasonMembership": [1, 800.0]})
+
+
+class TestPricingEngine(unittest.TestCase):
+    def setUp(self):
+        self.prices = {"SingleRacePass": 100.0, "WeekendPackage": 180.0, "GroupDiscount": 400.0}
+        self.engine = PricingEngine(self.prices, [
+            {"ticket_type": "SingleRacePass", "percent": 10, "min_qty": 5, "max_qty": 9},
+            {"ticket_type": "SingleRacePass", "percent": 20, "min_qty": 10},
+            {"min_group": 8, "flat": 50.0},
+            {"percent": 5, "start": "2025-09-01", "end": "2025-09-30"},
+        ], flat_discounts={"WeekendPackage": 30.0})
+
+    def test_quote_tiers_groups_and_windows(self):
+        self.assertEqual(self.engine.quote("SingleRacePass", 1, "2025-10-01"), (100.0, 0.0))
+        self.assertEqual(self.engine.quote("SingleRacePass", 5, "2025-10-01"), (100.0, 10.0))
+        self.assertEqual(self.engine.quote("SingleRacePass", 12, "2025-10-01"), (100.0, 20.0))
+        self.assertEqual(self.engine.quote("SingleRacePass", 12, "2025-09-30"), (100.0, 25.0))
+        self.assertEqual(self.engine.quote("GroupDiscount", 7, "2025-10-01"), (400.0, 0.0))
+        self.assertEqual(self.engine.quote("GroupDiscount", 8, "2025-10-01"), (400.0, 50.0))
+        self.assertEqual(self.engine.quote("WeekendPackage", 1, "2025-09-01"), (180.0, 39.0))
+        with self.assertRaises(ValueError):
+            self.engine.quote("VIP", 1)
+
+    def test_batch_matches_single_quotes(self):
+        lines = [(t, q, d) for t in self.prices for q in (1, 5, 8, 10, 20)
+                 for d in ("2025-08-31", "2025-09-15", "2025-10-01")]
+        expected = [(base - disc) * q for (t, q, d) in lines
+                    for base, disc in (self.engine.quote(t, q, d),)]
+        self.assertEqual(self.engine.price_lines(lines), expected)
+        self.assertEqual(self.engine.price_order(lines[:3]), sum(expected[:3]))
+        types = self.engine.get_ticket_types()
+        columns = self.engine.price_columns([types.index(t) for t, _, _ in lines],
+                                            [q for _, q, _ in lines],
+                                            [datetime.date.fromisoformat(d).toordinal() for _, _, d in lines])
+        self.assertEqual([round(float(x), 6) for x in columns], [round(x, 6) for x in expected])
+
+    def test_service_uses_rules(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            service = BookingService(tmp)
+            admin = service.login_admin("admin", "admin")
+            service.set_discount(admin, "SingleRacePass", 10.0)
+            service.set_discount(admin, "WeekendPackage", 20.0)
+            service.set_pricing_rules(admin, [{"ticket_type": "SingleRacePass", "percent": 50, "min_qty": 4}])
+            cust = service.create_account("ahmed", "pw")
+            res = service.purchase(cust, service.find_event("E1"), "SingleRacePass", 4, "Credit Card")
+            self.assertEqual(res.get_payment().get_amount(), 4 * 40.0)
+            self.assertEqual(service.get_system_manager().get_discount_rules(),
+                             {"SingleRacePass": 10.0, "WeekendPackage": 20.0})
+
+            reloaded = BookingService(tmp)
+            self.assertEqual(reloaded.get_pricing().quote("SingleRacePass", 4), (100.0, 60.0))
+
 
 class TestSystemManager(unittest.TestCase):
     def setUp(self):
@@ -168,5 +480,1415 @@ class TestSystemManager(unittest.TestCase):
         self.assertEqual(self.mgr._sales_log["E5"], 5)
 
 
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "test.journal")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_append_and_replay(self):
+        journal = Journal(self.path)
+        journal.append(("log_sale", "E1", 2))
+        journal.append(("log_sale", "E2", 1))
+        self.assertEqual(len(journal), 2)
+
+        replayed = list(Journal(self.path).replay())
+        self.assertEqual(replayed, [("log_sale", "E1", 2), ("log_sale", "E2", 1)])
+
+    def test_appends_during_checkpoint_are_kept(self):
+        journal = Journal(self.path)
+        journal.append(("a", 1))
+
+        def save():
+            journal.append(("b", 2))  # lands in the fresh file
+            raise OSError("disk full")
+
+        with self.assertRaises(OSError):
+            journal.checkpoint(save)
+        journal.append(("c", 3))
+        self.assertEqual(list(Journal(self.path).replay()), [("a", 1), ("b", 2), ("c", 3)])
+        journal.checkpoint(lambda: None)
+        self.assertEqual(list(Journal(self.path).replay()), [])
+
+    def test_torn_tail_is_discarded(self):
+        journal = Journal(self.path)
+        journal.append(("log_sale", "E1", 2))
+        journal.append(("log_sale", "E2", 1))
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+
+        journal = Journal(self.path)
+        self.assertEqual(list(journal.replay()), [("log_sale", "E1", 2)])
+        # appends after recovery land on a clean boundary
+        journal.append(("log_sale", "E3", 4))
+        self.assertEqual(list(Journal(self.path).replay()),
+                         [("log_sale", "E1", 2), ("log_sale", "E3", 4)])
+
+
+class TestCustomerStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.snapshot = os.path.join(self.tmp.name, "customers.pkl")
+        self.journal = os.path.join(self.tmp.name, "customers.journal")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_replay_snapshot_plus_journal(self):
+        store = CustomerStore(self.snapshot, self.journal)
+        customers = store.load()
+        cust = Customer("ahmed", "pw", "ahmed")
+        customers.add(cust)
+        store.account_created(cust)
+        store.compact()
+
+        res = Reservation("ahmed_1", Event("E1", "Race 1", "2025-06-10", 10), Payment(100.0, "card"))
+        cust.add_reservation(res)
+        store.reservation_added(cust, res)
+        cust.set_name("Ahmed E.")
+        store.name_changed(cust)
+        sultan = Customer("sultan", "pw", "sultan")
+        customers.add(sultan)
+        store.account_created(sultan)
+
+        loaded = CustomerStore(self.snapshot, self.journal).load()
+        self.assertEqual([c.get_username() for c in loaded], ["ahmed", "sultan"])
+        self.assertEqual(loaded.get("ahmed").get_name(), "Ahmed E.")
+        self.assertEqual(loaded.get("ahmed").get_reservations()[0].get_reservation_id(), "ahmed_1")
+
+        store.reservation_deleted(cust, "ahmed_1")
+        loaded = CustomerStore(self.snapshot, self.journal).load()
+        self.assertEqual(loaded.get("ahmed").get_reservations(), [])
+
+    def test_compaction_folds_journal(self):
+        store = CustomerStore(self.snapshot, self.journal, compact_threshold=3)
+        customers = store.load()
+        for i in range(3):
+            cust = Customer(f"user{i}", "pw", f"user{i}")
+            customers.add(cust)
+            store.account_created(cust)
+        self.assertEqual(len(store.get_journal()), 0)
+        self.assertEqual(len(CustomerStore(self.snapshot, self.journal).load()), 3)
+
+    def test_system_manager_journal(self):
+        mgr = SystemManager(backend=PickleBackend(self.tmp.name, compact_threshold=3))
+        mgr.load_data()
+        event = Event("E1", "Race 1", "2025-06-10", 10)
+        mgr.log_sale(event, 3)
+        mgr.set_discount_rules({"GroupDiscount": 5.0})
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "system_data.pkl")))
+        mgr.log_sale(event, 2)  # third record triggers compaction
+        mgr.log_sale(event, 1)
+
+        mgr2 = SystemManager(backend=PickleBackend(self.tmp.name))
+        mgr2.load_data()
+        self.assertEqual(mgr2.track_sales(), {"E1": 6})
+        self.assertEqual(mgr2._discount_rules, {"GroupDiscount": 5.0})
+
+
+class TestBackgroundWrites(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_dirty_flags(self):
+        event = Event("E1", "Race 1", "2025-06-10", 10)
+        cust = Customer("ahmed", "pw", "ahmed")
+        mgr = SystemManager(os.path.join(self.tmp.name, "system_data.pkl"))
+        self.assertFalse(event.is_dirty() or cust.is_dirty() or mgr.is_dirty())
+        event.try_allocate(2)
+        cust.add_reservation(Reservation("ahmed_1", event, Payment(1.0, "card")))
+        mgr.log_sale(event, 2)
+        self.assertTrue(event.is_dirty() and cust.is_dirty() and mgr.is_dirty())
+        self.assertFalse(pickle.loads(pickle.dumps(event)).is_dirty())
+        self.assertFalse(pickle.loads(pickle.dumps(cust)).is_dirty())
+        mgr.save_data()
+        self.assertFalse(mgr.is_dirty())
+
+    def test_writer_coalesces_bursts(self):
+        writes = []
+        writer = BackgroundWriter(lambda: writes.append(1), delay=0.05)
+        for _ in range(100):
+            writer.schedule()
+        deadline = time.monotonic() + 2
+        while not writes and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(writes), 1)
+        writer.close()  # the final flush always writes
+        self.assertEqual(len(writes), 2)
+
+        def fail():
+            raise OSError("disk full")
+        writer = BackgroundWriter(fail, delay=0)
+        writer.schedule()
+        with self.assertRaises(OSError):
+            writer.close()
+
+    def test_service_saves_in_background(self):
+        service = BookingService(self.tmp.name, backend=PickleBackend(self.tmp.name, compact_threshold=5,
+                                                                      write_delay=60))
+        cust = service.create_account("ahmed", "pw")
+        for _ in range(6):
+            service.purchase(cust, service.find_event("E2"), "SingleRacePass", 1, "Credit Card")
+        # Nothing is written on the calling thread; the journal just keeps growing
+        self.assertEqual(len(service.get_backend().get_customer_store().get_journal()), 7)
+        service.get_backend().get_writer().flush()
+        self.assertEqual(len(service.get_backend().get_customer_store().get_journal()), 0)
+        # Crash without close(): sold counts and sales were written by the writer
+        reloaded = BookingService(self.tmp.name)
+        self.assertEqual(reloaded.find_event("E2").get_tickets_sold(), 6)
+        self.assertEqual(reloaded.get_system_manager().track_sales(), {"E2": 6})
+        self.assertEqual(len(reloaded.login("ahmed", "pw").get_reservations()), 6)
+        service.close()
+
+    def test_close_skips_unchanged_files(self):
+        service = BookingService(self.tmp.name)
+        service.create_account("ahmed", "pw")
+        service.close()
+        paths = [os.path.join(self.tmp.name, f) for f in ("customers.pkl", "events.pkl")]
+        before = [os.stat(p).st_mtime_ns for p in paths]
+        BookingService(self.tmp.name).close()
+        self.assertEqual([os.stat(p).st_mtime_ns for p in paths], before)
+
+
+class TestEventReferences(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _assert_shared(self, service):
+        for cust in service.get_customers():
+            for res in cust.get_reservations():
+                canonical = service.get_events().get(res.get_event().get_event_id())
+                self.assertIs(res.get_event(), canonical or res.get_event())
+
+    def test_reservations_share_canonical_events(self):
+        service = BookingService(self.tmp.name)
+        cust = service.create_account("ahmed", "pw")
+        service.purchase(cust, service.find_event("E1"), "SingleRacePass", 2, "Credit Card")
+        service.save()
+        service.purchase(cust, service.find_event("E1"), "WeekendPackage", 1, "Credit Card")
+        service.purchase(cust, service.find_event("E3"), "SingleRacePass", 1, "Credit Card")
+        service.get_backend().save_events(service.list_events())  # journal still holds two purchases
+
+        for cache_size in (None, 10):
+            reloaded = BookingService(self.tmp.name, cache_size=cache_size)
+            self._assert_shared(reloaded)
+            res = reloaded.login("ahmed", "pw").get_reservations()[1]
+            self.assertEqual(res.get_event().get_tickets_sold(), 3)
+
+    def test_old_snapshot_with_event_copies(self):
+        events = [Event("E1", "Race 1", "2025-06-10", 10)]
+        PickleBackend(self.tmp.name).save_events(events)
+        cust = Customer("ahmed", "pw", "ahmed")
+        for i in range(2):
+            res = Reservation(f"ahmed_{i}", Event("E1", "Race 1", "2025-06-10", 10), Payment(1.0, "card"))
+            cust.add_reservation(res)
+        orphan = Event("E9", "Old Race", "2024-01-01", 10)
+        cust.add_reservation(Reservation("ahmed_9", orphan, Payment(1.0, "card")))
+        write_snapshot(os.path.join(self.tmp.name, "customers.pkl"), [cust])
+
+        service = BookingService(self.tmp.name)
+        self._assert_shared(service)
+        self.assertEqual(service.login("ahmed", "pw").get_reservations()[2].get_event().get_name(), "Old Race")
+
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        self.events = {"E1": Event("E1", "Race 1", "2025-06-10", 100)}
+        self.cust = Customer("ahmed", "pw", "Ahmed E.")
+        res = Reservation(self.cust.next_reservation_id(), self.events["E1"], Payment(290.0, "Credit Card"))
+        res.add_block(TicketBlock(res.get_reservation_id(), 1, 3, "GroupDiscount", 100.0, 5.0, 3))
+        res.add_block(TicketBlock("legacy", 7, 1, "SingleRacePass", 100.0))
+        res.add_tickets([WeekendPackage("t1", 250.0), GroupDiscount("t2", 80.0, 4), Ticket("t3", 9.5, "Parking")])
+        self.cust.add_reservation(res)
+        orphan = Event("E9", "Old Race", "2024-01-01", 10)
+        self.cust.add_reservation(Reservation("ahmed_x", orphan, Payment(1.0, "card"), "2024-01-01"))
+
+    def test_customer_round_trip(self):
+        table = dict(self.events)
+        for compress in (False, True):
+            data = codec.encode_customers([self.cust], self.events, compress)
+            (cust,) = codec.decode(data, table)
+            self.assertEqual((cust.get_username(), cust.get_name(), cust.get_reservation_seq()),
+                             ("ahmed", "Ahmed E.", 1))
+            self.assertTrue(cust.check_password("pw"))
+            res, old = cust.get_reservations()
+            self.assertIs(res.get_event(), self.events["E1"])
+            self.assertEqual(old.get_event().get_name(), "Old Race")  # carried in the file
+            self.assertNotIn("E9", table)
+            self.assertEqual(old.get_date(), "2024-01-01")
+            self.assertEqual(res.get_payment().get_method(), "Credit Card")
+            self.assertEqual([t.get_ticket_id() for t in res.iter_tickets()],
+                             ["t1", "t2", "t3", "ahmed_1_1", "ahmed_1_2", "ahmed_1_3", "legacy_7"])
+            tickets = res.get_tickets()
+            self.assertEqual([type(t) for t in tickets[:3]], [WeekendPackage, GroupDiscount, Ticket])
+            self.assertEqual(tickets[1].get_group_size(), 4)
+            self.assertEqual(res.get_blocks()[0].get_discounted_total(), 285.0)
+            self.assertEqual(res.get_total_price(), 739.5)
+
+    def test_smaller_than_pickle(self):
+        customers = [pickle.loads(pickle.dumps(self.cust)) for _ in range(200)]
+        plain = pickle.dumps(customers, protocol=5)
+        self.assertLess(len(codec.encode_customers(customers, self.events)), len(plain))
+        self.assertLess(len(codec.encode_customers(customers, self.events, compress=True)),
+                        len(codec.encode_customers(customers, self.events)))
+        events = codec.decode(codec.encode_events(list(self.events.values())))
+        self.assertEqual((events[0].get_event_id(), events[0].get_capacity()), ("E1", 100))
+
+    def test_schema_migrations(self):
+        data = codec.encode_events(list(self.events.values()))
+        calls = []
+
+        def migrate(kind, body):
+            calls.append(kind)
+            return body
+
+        version = codec.SCHEMA_VERSION
+        try:
+            codec.SCHEMA_VERSION = version + 1
+            with self.assertRaises(ValueError):
+                codec.decode(data)  # no migration registered yet
+            codec.MIGRATIONS[version] = migrate
+            self.assertEqual(codec.decode(data)[0].get_name(), "Race 1")
+            self.assertEqual(calls, [codec.EVENTS])
+            newer = codec.encode_events(list(self.events.values()))
+        finally:
+            codec.SCHEMA_VERSION = version
+            codec.MIGRATIONS.pop(version, None)
+        with self.assertRaises(ValueError):
+            codec.decode(newer)
+
+    def test_reads_version_1_files(self):
+        # One customer with one reservation for an event carried in the file,
+        # as written before snapshots had a checksum
+        data = (
+            b"GPBK\x01\x00\x01\x00\x05\x00\x00\x00\x02\x00E1\n\x002025-06-01\x0b\x00Credit Card\x0e"
+            b"\x00SingleRacePass\n\x002025-11-23\x01\x00\x00\x00\x06\x00\x00\x00\x00\x00\x04\x00\x00"
+            b"\x00d\x00\x00\x00\x00\x00\x00\x00\x02\x00\x00\x00\x00\x00\x00\x00Race 1\x01\x00\x00\x00"
+            b"\x05\x00\x02\x00\x05\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00ahmedpwAhmed\x07"
+            b"\x00\x00\x00\x00\x00\x01\x00\x00\x00\x02\x00\x00\x00\x00\x00\x00\x00\x00\x80f@\x01\x00"
+            b"\x00\x00\x00\x00\x00\x00ahmed_1\x01\x03\x00\x00\x00\x01\x00\x00\x00\x02\x00\x00\x00\x00"
+            b"\x00\x00\x00\x00\x00Y@\x00\x00\x00\x00\x00\x00$@\xff\xff\xff\xff\xff\xff\xff\xff"
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "customers.pkl")
+            with open(path, "wb") as f:
+                f.write(data)
+            (cust,) = read_snapshot(path, {})
+        self.assertEqual((cust.get_username(), cust.get_name()), ("ahmed", "Ahmed"))
+        (res,) = cust.get_reservations()
+        self.assertEqual((res.get_event().get_name(), res.get_date()), ("Race 1", "2025-06-01"))
+        self.assertEqual(res.get_payment().get_amount(), 180.0)
+        self.assertEqual(res.get_blocks()[0].get_discounted_total(), 180.0)
+
+    def test_damaged_snapshot_is_refused(self):
+        data = bytearray(codec.encode_customers([self.cust], self.events))
+        data[-20] ^= 1
+        with self.assertRaises(ValueError):
+            codec.decode(bytes(data), dict(self.events))
+
+    def test_backend_compresses_snapshots(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = PickleBackend(tmp, compress_snapshots=True)
+            backend.save_events(list(self.events.values()))
+            backend.save_customers(CustomerRegistry([self.cust]))
+            for name in ("events.pkl", "customers.pkl"):
+                with open(os.path.join(tmp, name), "rb") as f:
+                    self.assertTrue(f.read(8)[7] & codec.COMPRESSED)
+            (cust,) = PickleBackend(tmp).load_customers()
+        self.assertEqual(len(cust.get_reservations()), 2)
+
+
+class TestLazyLoading(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _populate(self, service, users=5):
+        for i in range(users):
+            cust = service.create_account(f"user{i}", "pw")
+            for _ in range(i + 1):
+                service.purchase(cust, service.find_event("E1"), "SingleRacePass", 1, "Credit Card")
+
+    def test_registry_evicts_least_recently_used(self):
+        customers = CustomerRegistry(cache_size=2)
+        loads = []
+        for name in ("a", "b", "c"):
+            cust = Customer(name, "pw", name)
+            cust.set_loader(lambda c: loads.append(c.get_username()) or [])
+            cust.unload()
+            customers.add(cust)
+        for name in ("a", "b", "a", "c"):
+            customers.get(name).get_reservations()
+        self.assertEqual(loads, ["a", "b", "c"])
+        self.assertEqual([c.get_username() for c in customers if c.is_loaded()], ["a", "c"])
+        self.assertEqual(customers.get_loaded_count(), 2)
+
+    def test_pickle_backend_loads_on_demand(self):
+        service = BookingService(self.tmp.name)
+        self._populate(service)
+        service.close()  # eager snapshot, converted on the first lazy start
+
+        lazy = BookingService(self.tmp.name, cache_size=2)
+        customers = lazy.get_customers()
+        self.assertFalse(any(c.is_loaded() for c in customers))
+        cust = lazy.login("user3", "pw")
+        self.assertEqual(len(cust.get_reservations()), 4)
+        res = lazy.purchase(cust, lazy.find_event("E2"), "WeekendPackage", 2, "Credit Card")
+        self.assertEqual(res.get_reservation_id(), "user3_5")
+        lazy.cancel(lazy.login("user0", "pw"), "user0_1")
+        for name in ("user1", "user2"):
+            customers.get(name).get_reservations()
+        self.assertFalse(cust.is_loaded())
+        # reloaded from the snapshot plus the journaled purchase
+        self.assertEqual([r.get_reservation_id() for r in cust.get_reservations()][-1], "user3_5")
+
+        lazy.get_backend().get_customer_store().compact()
+        self.assertEqual(len(lazy.get_backend().get_customer_store().get_journal()), 0)
+        lazy.create_account("late", "pw")
+        lazy2 = BookingService(self.tmp.name, cache_size=2)
+        counts = {c.get_username(): len(c.get_reservations()) for c in lazy2.get_customers()}
+        self.assertEqual(counts, {"user0": 0, "user1": 2, "user2": 3, "user3": 5, "user4": 5, "late": 0})
+        lazy2.close()
+
+        # Switching back to eager loading picks up the newer lazy snapshot
+        eager = BookingService(self.tmp.name)
+        self.assertEqual(len(eager.login("user3", "pw").get_reservations()), 5)
+        self.assertIn("late", eager.get_customers())
+
+    def test_sqlite_backend_loads_on_demand(self):
+        db = os.path.join(self.tmp.name, "booking.db")
+        service = BookingService(backend=SQLiteBackend(db))
+        self._populate(service)
+        service.close()
+
+        lazy = BookingService(backend=SQLiteBackend(db, cache_size=2))
+        self.assertFalse(any(c.is_loaded() for c in lazy.get_customers()))
+        cust = lazy.login("user2", "pw")
+        self.assertEqual(len(cust.get_reservations()), 3)
+        self.assertIs(cust.get_reservations()[0].get_event(), lazy.find_event("E1"))
+        # the id counter survives a restart instead of colliding with stored ids
+        res = lazy.purchase(cust, lazy.find_event("E1"), "SingleRacePass", 1, "Credit Card")
+        self.assertEqual(res.get_reservation_id(), "user2_4")
+        lazy.close()
+
+
+class TestShardedStorage(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _populate(self, service, users=8):
+        for i in range(users):
+            cust = service.create_account(f"user{i}", "pw")
+            service.purchase(cust, service.find_event("E1"), "SingleRacePass", i + 1, "Credit Card")
+
+    def _counts(self, service):
+        return {c.get_username(): len(c.get_reservations()) for c in service.get_customers()}
+
+    def test_single_file_is_split_on_first_sharded_start(self):
+        service = BookingService(self.tmp.name)
+        self._populate(service)
+        service.close()
+
+        sharded = BookingService(self.tmp.name, PickleBackend(self.tmp.name, shards=4))
+        store = sharded.get_backend().get_customer_store()
+        self.assertEqual(store.get_shard_count(), 4)
+        self.assertTrue(all(os.path.exists(p) for p in store.get_shard_files()))
+        self.assertEqual(self._counts(sharded), {f"user{i}": 1 for i in range(8)})
+        sharded.purchase(sharded.login("user2", "pw"), sharded.find_event("E2"), "SingleRacePass", 1, "Cash")
+        sharded.close()
+
+        # The manifest alone makes later starts sharded
+        again = BookingService(self.tmp.name)
+        self.assertEqual(again.get_backend().get_customer_store().get_shard_count(), 4)
+        self.assertEqual(self._counts(again)["user2"], 2)
+
+    def test_compaction_rewrites_only_changed_shards(self):
+        service = BookingService(self.tmp.name, PickleBackend(self.tmp.name, shards=4))
+        self._populate(service)
+        service.close()
+
+        service = BookingService(self.tmp.name)
+        store = service.get_backend().get_customer_store()
+        before = {p: os.stat(p).st_mtime_ns for p in store.get_shard_files()}
+        time.sleep(0.01)
+        service.cancel(service.login("user5", "pw"), "user5_1")
+        store.compact()
+        changed = [p for p in store.get_shard_files() if os.stat(p).st_mtime_ns != before[p]]
+        self.assertEqual(changed, [store.get_shard_files()[shard_of("user5", 4)]])
+        self.assertEqual(len(store.get_journal()), 0)
+        self.assertEqual(self._counts(BookingService(self.tmp.name))["user5"], 0)
+
+    def test_corrupt_shard_loses_only_its_customers(self):
+        service = BookingService(self.tmp.name, PickleBackend(self.tmp.name, shards=4))
+        self._populate(service)
+        service.close()
+        bad = shard_of("user0", 4)
+        path = service.get_backend().get_customer_store().get_shard_files()[bad]
+        with open(path, "wb") as f:
+            f.write(b"not a pickle")
+
+        service = BookingService(self.tmp.name)
+        store = service.get_backend().get_customer_store()
+        self.assertEqual(store.get_corrupt_files(), [path + ".corrupt"])
+        expected = {f"user{i}" for i in range(8) if shard_of(f"user{i}", 4) != bad}
+        self.assertEqual(set(self._counts(service)), expected)
+
+    def test_reshard_keeps_journaled_changes(self):
+        service = BookingService(self.tmp.name, PickleBackend(self.tmp.name, shards=4))
+        self._populate(service)
+        service.create_account("late", "pw")  # journaled only
+        expected = self._counts(service)
+
+        self.assertEqual(reshard(self.tmp.name, 3), {"customers": 9, "shards": 3})
+        store = BookingService(self.tmp.name).get_backend().get_customer_store()
+        self.assertEqual(store.get_shard_count(), 3)
+        self.assertNotIn("customers.000-of-004.pkl", os.listdir(self.tmp.name))
+        self.assertEqual(self._counts(BookingService(self.tmp.name)), expected)
+
+        reshard(self.tmp.name, 0)
+        single = BookingService(self.tmp.name)
+        self.assertIsInstance(single.get_backend().get_customer_store(), CustomerStore)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "customers.manifest.json")))
+        self.assertEqual(self._counts(single), expected)
+
+
+class TestBookingEngine(unittest.TestCase):
+    def setUp(self):
+        self.mgr = SystemManager()
+        self.engine = BookingEngine(self.mgr)
+        self.switch_interval = sys.getswitchinterval()
+        # force frequent thread switches so unsafe code would oversell
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    def test_purchase_prices_and_logs(self):
+        self.mgr.set_discount_rules({"GroupDiscount": 5.0})
+        cust = Customer("ahmed", "pw", "ahmed")
+        event = Event("E1", "Race 1", "2025-06-10", 10)
+        res = self.engine.purchase(cust, event, "GroupDiscount", 4, 400.0, "Credit Card")
+        self.assertEqual(res.get_reservation_id(), "ahmed_1")
+        self.assertEqual(res.get_payment().get_amount(), 4 * 395.0)
+        self.assertEqual(self.mgr.track_sales(), {"E1": 4})
+        with self.assertRaises(ValueError):
+            self.engine.purchase(cust, event, "SingleRacePass", 7, 100.0, "Credit Card")
+        self.assertEqual(len(cust.get_reservations()), 1)
+        self.assertEqual(event.get_tickets_sold(), 4)
+
+    def test_concurrent_purchases_never_oversell(self):
+        events = [Event(f"E{i}", f"Race {i}", "2025-06-10", 300) for i in range(3)]
+        customers = [Customer(f"user{i}", "pw", f"user{i}") for i in range(16)]
+
+        def worker(cust):
+            for n in range(200):
+                try:
+                    self.engine.purchase(cust, events[n % 3], "SingleRacePass", 1 + n % 3, 100.0, "card")
+                except ValueError:
+                    pass
+
+        threads = [threading.Thread(target=worker, args=(c,)) for c in customers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        sales = self.mgr.track_sales()
+        for event in events:
+            booked = sum(r.get_ticket_count() for c in customers
+                         for r in c.get_reservations() if r.get_event() is event)
+            self.assertLessEqual(event.get_tickets_sold(), event.get_capacity())
+            self.assertEqual(booked, event.get_tickets_sold())
+            self.assertEqual(sales[event.get_event_id()], booked)
+        for cust in customers:
+            ids = [r.get_reservation_id() for r in cust.get_reservations()]
+            self.assertEqual(len(ids), len(set(ids)))
+
+
+class TestSeatHolds(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.engine = BookingEngine(SystemManager(), hold_ttl=60.0, clock=lambda: self.now)
+        self.event = Event("E1", "Race 1", "2025-06-10", 10)
+        self.ana = Customer("ana", "pw", "Ana")
+        self.bo = Customer("bo", "pw", "Bo")
+
+    def test_hold_confirm_release_and_expire(self):
+        first = self.engine.hold(self.ana, self.event, 4)
+        second = self.engine.hold(self.bo, self.event, 5, ttl=10.0)
+        self.assertEqual((self.event.get_held(), self.event.get_remaining_capacity()), (9, 1))
+        with self.assertRaises(ValueError):
+            self.engine.purchase(self.ana, self.event, "SingleRacePass", 2, 100.0, "card")
+        with self.assertRaises(ValueError):
+            self.engine.confirm_hold(self.ana, second.get_hold_id(), "SingleRacePass", 100.0, "card")
+        res = self.engine.confirm_hold(self.ana, first.get_hold_id(), "SingleRacePass", 100.0, "card")
+        self.assertEqual(res.get_ticket_count(), 4)
+        self.assertEqual((self.event.get_tickets_sold(), self.event.get_held()), (4, 5))
+        with self.assertRaises(ValueError):
+            self.engine.confirm_hold(self.ana, first.get_hold_id(), "SingleRacePass", 100.0, "card")
+
+        self.now = 10.0
+        self.assertEqual(self.engine.get_holds().expire_due(), 1)
+        self.assertEqual((self.event.get_held(), self.event.get_remaining_capacity()), (0, 6))
+        with self.assertRaises(ValueError):
+            self.engine.confirm_hold(self.bo, second.get_hold_id(), "SingleRacePass", 100.0, "card")
+
+        third = self.engine.hold(self.bo, self.event, 6)
+        self.assertTrue(self.engine.release_hold(self.bo, third.get_hold_id()))
+        self.assertFalse(self.engine.release_hold(self.bo, third.get_hold_id()))
+        self.assertEqual(self.event.get_remaining_capacity(), 6)
+        self.assertEqual(len(self.engine.get_holds()), 0)
+        # Held seats are not persisted
+        self.engine.hold(self.bo, self.event, 2)
+        self.assertEqual(pickle.loads(pickle.dumps(self.event)).get_remaining_capacity(), 6)
+
+    def test_failing_give_back_does_not_stop_expiry(self):
+        given_back = []
+
+        def give_back(hold):
+            given_back.append(hold.get_hold_id())
+            if len(given_back) == 1:
+                raise OSError("disk full")
+
+        book = HoldBook(give_back, clock=lambda: self.now)
+        for hold_id in ("H1", "H2"):
+            book.add(SeatHold(hold_id, "ana", self.event, 1, 5.0))
+        self.now = 5.0
+        with self.assertRaises(OSError):
+            book.expire_due()
+        self.assertEqual((given_back, len(book)), (["H1", "H2"], 0))
+
+    def test_sweeper_thread_expires_holds(self):
+        engine = BookingEngine(SystemManager(), hold_ttl=0.05)
+        engine.hold(self.ana, self.event, 3)
+        engine.get_holds().start()
+        try:
+            deadline = time.monotonic() + 2
+            while self.event.get_held() and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            engine.get_holds().stop()
+        self.assertEqual(self.event.get_remaining_capacity(), 10)
+
+    def test_service_hold_and_confirm(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            service = BookingService(tmp)
+            cust = service.create_account("ana", "pw")
+            event = service.find_event("Grand Prix Race")
+            hold = service.hold(cust, event, 2)
+            res = service.confirm_hold(cust, hold.get_hold_id(), "WeekendPackage", "Credit Card")
+            self.assertEqual(res.get_payment().get_amount(), 360.0)
+            service.close()
+            reloaded = BookingService(tmp)
+            self.assertEqual(reloaded.find_event("Grand Prix Race").get_tickets_sold(), 2)
+            reloaded.close()
+
+
+class TestWaitlist(unittest.TestCase):
+    def setUp(self):
+        self.promoted = []
+        self.mgr = SystemManager()
+        self.engine = BookingEngine(self.mgr, on_promoted=lambda entry, res: self.promoted.append(entry))
+        self.event = Event("E1", "Race 1", "2025-06-10", 4)
+        self.customers = [Customer(f"user{i}", "pw", f"user{i}") for i in range(5)]
+
+    def join(self, i, qty, priority=0):
+        return self.engine.join_waitlist(self.customers[i], self.event, "SingleRacePass", qty, 100.0,
+                                         "card", priority=priority)
+
+    def test_cancel_releases_seats_and_sales(self):
+        res = self.engine.purchase(self.customers[0], self.event, "SingleRacePass", 4, 100.0, "card")
+        self.assertEqual(self.event.get_remaining_capacity(), 0)
+        self.assertIs(self.engine.cancel(self.customers[0], res.get_reservation_id()), res)
+        self.assertIsNone(self.engine.cancel(self.customers[0], res.get_reservation_id()))
+        self.assertEqual((self.event.get_tickets_sold(), self.event.get_remaining_capacity()), (0, 4))
+        self.assertEqual(self.mgr.track_sales(), {"E1": 0})
+        self.assertEqual(self.customers[0].get_reservations(), [])
+
+    def test_priority_then_fifo_backfill(self):
+        first = self.engine.purchase(self.customers[0], self.event, "SingleRacePass", 3, 100.0, "card")
+        second = self.engine.purchase(self.customers[0], self.event, "SingleRacePass", 1, 100.0, "card")
+        a, b = self.join(1, 2), self.join(2, 1)
+        vip = self.join(3, 1, priority=5)
+        gone = self.join(4, 1)
+        self.assertEqual([self.engine.get_waitlist().position(e.get_entry_id()) for e in (vip, a, b, gone)],
+                         [1, 2, 3, 4])
+        self.assertTrue(self.engine.leave_waitlist(self.customers[4], gone.get_entry_id()))
+        self.assertFalse(self.engine.leave_waitlist(self.customers[1], b.get_entry_id()))
+
+        # One seat back: the priority entry gets it; the head then needs 2, so b keeps waiting
+        self.engine.cancel(self.customers[0], second.get_reservation_id())
+        self.assertEqual(self.promoted, [vip])
+        self.assertEqual(len(self.customers[3].get_reservations()), 1)
+        self.engine.cancel(self.customers[0], first.get_reservation_id())
+        self.assertEqual(self.promoted, [vip, a, b])
+        self.assertEqual((self.event.get_tickets_sold(), len(self.engine.get_waitlist())), (4, 0))
+        self.assertEqual(self.mgr.track_sales(), {"E1": 4})
+
+    def test_failed_promotion_requeues_the_rest(self):
+        res = self.engine.purchase(self.customers[0], self.event, "SingleRacePass", 4, 100.0, "card")
+        first, failing, last = self.join(1, 1), self.join(2, 1), self.join(3, 2)
+        log_reservation = self.mgr.log_reservation
+
+        def fail_for_user2(reservation, sign=1):
+            if reservation.get_reservation_id().startswith("user2_"):
+                raise OSError("disk full")
+            log_reservation(reservation, sign)
+
+        self.mgr.log_reservation = fail_for_user2
+        with self.assertRaises(OSError):
+            self.engine.cancel(self.customers[0], res.get_reservation_id())
+        # The cancellation stands; only the first entry was booked
+        self.assertEqual(self.customers[0].get_reservations(), [])
+        self.assertEqual(self.promoted, [first])
+        self.assertEqual((self.event.get_tickets_sold(), self.event.get_held()), (1, 0))
+        self.assertEqual(self.mgr.track_sales(), {"E1": 1})
+        self.assertIsNone(self.engine.get_waitlist().position(failing.get_entry_id()))
+        self.assertEqual(self.engine.get_waitlist().position(last.get_entry_id()), 1)
+        self.assertEqual(self.customers[2].get_reservations(), [])
+
+        del self.mgr.log_reservation
+        self.join(4, 1)
+        self.assertEqual(len(self.promoted), 3)
+        self.assertIs(self.promoted[1], last)
+        self.assertEqual(self.event.get_tickets_sold(), 4)
+
+    def test_released_hold_backfills_and_joining_with_free_seats_books(self):
+        hold = self.engine.hold(self.customers[0], self.event, 4)
+        entry = self.join(1, 3)
+        self.assertEqual(self.promoted, [])
+        self.engine.release_hold(self.customers[0], hold.get_hold_id())
+        self.assertEqual(self.promoted, [entry])
+        self.join(2, 1)
+        self.assertEqual(len(self.promoted), 2)
+        with self.assertRaises(ValueError):
+            self.join(3, 5)
+
+    def test_interleaved_cancellations_and_promotions(self):
+        events = [Event(f"E{i}", f"Race {i}", "2025-06-10", 20) for i in range(2)]
+        customers = [Customer(f"user{i}", "pw", f"user{i}") for i in range(12)]
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+        def worker(i):
+            rng = random.Random(i)
+            cust = customers[i]
+            for n in range(300):
+                event = events[n % 2]
+                roll = rng.random()
+                try:
+                    if roll < 0.4:
+                        self.engine.purchase(cust, event, "SingleRacePass", rng.randint(1, 3), 100.0, "card")
+                    elif roll < 0.75:
+                        reservations = cust.get_reservations()
+                        if reservations:
+                            self.engine.cancel(cust, rng.choice(reservations).get_reservation_id())
+                    elif roll < 0.95:
+                        self.engine.join_waitlist(cust, event, "SingleRacePass", rng.randint(1, 3), 100.0,
+                                                  "card", priority=rng.randint(0, 2))
+                    else:
+                        hold = self.engine.hold(cust, event, 2)
+                        self.engine.release_hold(cust, hold.get_hold_id())
+                except ValueError:
+                    pass
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(customers))]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+
+        self.assertGreater(len(self.promoted), 0)
+        sales = self.mgr.track_sales()
+        waitlist = self.engine.get_waitlist()
+        for event in events:
+            booked = sum(r.get_ticket_count() for c in customers
+                         for r in c.get_reservations() if r.get_event() is event)
+            self.assertEqual(event.get_held(), 0)
+            self.assertEqual(event.get_tickets_sold(), booked)
+            self.assertLessEqual(booked, event.get_capacity())
+            self.assertEqual(sales[event.get_event_id()], booked)
+            # Nobody is left waiting for seats that are free
+            waiting = waitlist.waiting(event.get_event_id())
+            if waiting:
+                self.assertGreater(waiting[0].get_quantity(), event.get_remaining_capacity())
+        for cust in customers:
+            ids = [r.get_reservation_id() for r in cust.get_reservations()]
+            self.assertEqual(len(ids), len(set(ids)))
+
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self):
+        self.now = [0.0]
+        self.clock = lambda: self.now[0]
+
+    def test_token_bucket_and_overloaded(self):
+        bucket = TokenBucket(10, 2, self.clock)
+        self.assertTrue(bucket.try_take() and bucket.try_take())
+        self.assertFalse(bucket.try_take())
+        self.assertAlmostEqual(bucket.wait_time(), 0.1)
+        self.now[0] = 0.1
+        self.assertTrue(bucket.try_take())
+
+        controller = AdmissionController(rate=10, burst=1, queue_size=0, clock=self.clock)
+        with controller.admit("alice", "E1", 1):
+            pass
+        with self.assertRaises(Overloaded) as ctx:
+            with controller.admit("bob", "E1", 1):
+                pass
+        self.assertAlmostEqual(ctx.exception.retry_after, 0.1)
+        with controller.admit("bob", "E2", 1):  # other events have their own bucket
+            pass
+
+    def test_queue_is_served_round_robin_across_customers(self):
+        controller = AdmissionController(rate=1, burst=1, max_wait=100, clock=self.clock)
+        with controller.admit("greedy", "E1", 1):
+            pass
+        order = []
+        gate = controller._gates["E1"]
+
+        def buy(username, label):
+            with controller.admit(username, "E1", 1):
+                order.append(label)
+
+        threads = []
+        for username, label in [("greedy", "g1"), ("greedy", "g2"), ("fair", "f1")]:
+            threads.append(threading.Thread(target=buy, args=(username, label)))
+            threads[-1].start()
+            while gate.size < len(threads):
+                time.sleep(0.001)
+        # Over the per-customer limit of two waiting purchases
+        with self.assertRaises(Overloaded):
+            buy("greedy", "g3")
+        for served in range(1, 4):
+            self.now[0] += 1
+            with gate.cond:
+                gate.cond.notify_all()
+            while len(order) < served:
+                time.sleep(0.001)
+        for t in threads:
+            t.join()
+        self.assertEqual(order, ["g1", "f1", "g2"])
+
+    def test_ticket_limit_counts_queued_requests(self):
+        controller = AdmissionController(rate=5, burst=1, max_wait=100, max_tickets=4, clock=self.clock)
+        with controller.admit("other", "E1", 1):
+            pass
+        owned = []
+        gate = controller._gates["E1"]
+
+        def buy():
+            try:
+                with controller.admit("u", "E1", 3, lambda: sum(owned)):
+                    owned.append(3)
+            except ValueError:
+                pass
+
+        threads = [threading.Thread(target=buy) for _ in range(2)]
+        threads[0].start()
+        while gate.size < 1:
+            time.sleep(0.001)
+        # The first is still queued; together they would make 6 tickets
+        threads[1].start()
+        threads[1].join()
+        self.now[0] += 1
+        with gate.cond:
+            gate.cond.notify_all()
+        threads[0].join(5)
+        self.assertEqual(owned, [3])
+        self.assertEqual(dict(gate.in_flight), {})
+        with self.assertRaises(ValueError):
+            with controller.admit("u", "E1", 2, lambda: sum(owned)):
+                pass
+
+    def test_service_enforces_ticket_limit(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            service = BookingService(tmp, admission=AdmissionController(max_tickets=3))
+            cust = service.create_account("ahmed", "pw")
+            event = service.find_event("Grand Prix Race")
+            res = service.purchase(cust, event, "SingleRacePass", 2, "Credit Card")
+            with self.assertRaises(ValueError):
+                service.purchase(cust, event, "SingleRacePass", 2, "Credit Card")
+            service.purchase(cust, event, "SingleRacePass", 1, "Credit Card")
+            service.cancel(cust, res.get_reservation_id())
+            service.purchase(cust, event, "SingleRacePass", 2, "Credit Card")
+            service.close()
+
+    def test_ticket_limit_covers_holds_and_waitlist(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            service = BookingService(tmp, admission=AdmissionController(max_tickets=3))
+            cust = service.create_account("ahmed", "pw")
+            event = service.find_event("Grand Prix Race")
+            hold = service.hold(cust, event, 2)
+            with self.assertRaises(ValueError):
+                service.purchase(cust, event, "SingleRacePass", 2, "Credit Card")
+            service.confirm_hold(cust, hold.get_hold_id(), "SingleRacePass", "Credit Card")
+            with self.assertRaises(ValueError):
+                service.hold(cust, event, 2)
+            with self.assertRaises(ValueError):
+                service.join_waitlist(cust, event, "SingleRacePass", 2, "Credit Card")
+            hold = service.hold(cust, event, 1)
+            service.release_hold(cust, hold.get_hold_id())
+            service.join_waitlist(cust, event, "SingleRacePass", 1, "Credit Card")
+            self.assertEqual(sum(r.get_ticket_count() for r in cust.get_reservations()), 3)
+            with self.assertRaises(ValueError):
+                service.purchase(cust, event, "SingleRacePass", 1, "Credit Card")
+            service.close()
+
+    def test_events_are_admitted_independently(self):
+        controller = AdmissionController(max_tickets=4)
+        entered = threading.Event()
+        release = threading.Event()
+
+        def slow_owned():
+            entered.set()
+            release.wait(5)
+            return 0
+
+        thread = threading.Thread(target=lambda: controller.admit("u", "E1", 1, slow_owned).__enter__())
+        thread.start()
+        entered.wait(5)
+        # E1's check is still running; E2 doesn't wait for it
+        with controller.admit("u", "E2", 1, lambda: 0):
+            pass
+        release.set()
+        thread.join(5)
+
+
+class TestReports(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        catalog = benchmarks.make_events(5)
+        self.customers = [benchmarks.make_customer(c, catalog, 6, ("Credit Card", "PayPal"))
+                          for c in range(40)]
+        # Loose group tickets of one reservation count as one group
+        res = Reservation("user0_99", catalog[0], Payment(800.0, "Cash"))
+        res.add_tickets([GroupDiscount(f"G{i}", 400.0, 5) for i in range(2)])
+        self.customers[0].add_reservation(res)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def single_pass(self):
+        partial = reports.ReportPartial(5)
+        for customer in self.customers:
+            partial.add_customer(customer.get_username(), customer.get_reservations())
+        return partial.to_dict()
+
+    def test_merged_partials_match_a_single_pass(self):
+        expected = self.single_pass()
+        self.assertEqual((expected["customers"], expected["reservations"]), (40, 241))
+        self.assertEqual(expected["group_sizes"], {4: 60, 5: 1})
+        mgr = SystemManager()
+        for customer in self.customers:
+            for res in customer.get_reservations():
+                mgr.log_reservation(res)
+        self.assertEqual(expected["by_method"], mgr.get_sales_analytics()["method"])
+        spends = sorted(((sum(r.get_payment().get_amount() for r in c.get_reservations()), c.get_username())
+                         for c in self.customers), reverse=True)[:5]
+        self.assertEqual(expected["top_customers"], [[name, spend] for spend, name in spends])
+
+        # Any split, merged in any order, gives the same report
+        parts = [self.customers[i::3] for i in range(3)]
+        partials = [reports.map_partition(("customers", [(c.get_username(), c.get_reservations()) for c in p]), 5)
+                    for p in parts]
+        merged = reports.ReportPartial(5)
+        for partial in reversed(partials):
+            merged.merge(partial)
+        self.assertEqual(merged.to_dict(), expected)
+        self.assertIn("  5 people: 1 groups", reports.report_lines(expected))
+
+    def test_data_dir_layouts_on_worker_processes(self):
+        expected = self.single_pass()
+        backend = PickleBackend(self.tmp.name)
+        backend.save_events(list({r.get_event().get_event_id(): r.get_event()
+                                  for c in self.customers for r in c.get_reservations()}.values()))
+        backend.save_customers(CustomerRegistry(self.customers))
+        engine = reports.ReportEngine(workers=2, top_n=5)
+        self.assertEqual(engine.report_data_dir(self.tmp.name), expected)
+        reshard(self.tmp.name, 4)
+        self.assertEqual(len(reports.data_dir_partitions(self.tmp.name, 8)), 4)
+        self.assertEqual(engine.report_data_dir(self.tmp.name), expected)
+        reshard(self.tmp.name, 0)
+        lazy = BookingService(self.tmp.name, cache_size=10)
+        lazy.close()
+        self.assertEqual(reports.data_dir_partitions(self.tmp.name, 8)[0][0], "lazy")
+        self.assertEqual(engine.report_data_dir(self.tmp.name), expected)
+        self.assertEqual(engine.report_customers(self.customers), expected)
+
+    def test_service_report_includes_unsaved_changes(self):
+        make_data_dir(self.tmp.name, customers=3, events=1, capacity=10)
+        service = BookingService(self.tmp.name)
+        customer = service.login("user1", "pw")
+        service.purchase(customer, service.list_events()[0], "GroupDiscount", 3, "PayPal")
+        self.assertTrue(reports.has_unsaved_changes(self.tmp.name))
+        admin = Admin("admin", "admin", "Administrator")
+        report = service.customer_report(admin, workers=1)
+        self.assertFalse(reports.has_unsaved_changes(self.tmp.name))
+        self.assertEqual(report["customers"], 3)
+        self.assertEqual(report["top_customers"][0][0], "user1")
+        self.assertEqual(report["group_sizes"], {3: 1})
+        service.close()
+        with self.assertRaises(ValueError):
+            reports.ReportEngine(workers=0)
+
+
+class TestBookingService(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.service = BookingService(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_purchase_cancel_and_reload(self):
+        cust = self.service.create_account("ahmed", "pw")
+        with self.assertRaises(ValueError):
+            self.service.create_account("ahmed", "pw")
+        event = self.service.find_event("Grand Prix Race")
+        res = self.service.purchase(cust, event, "WeekendPackage", 2, "Credit Card")
+        self.assertEqual(res.get_payment().get_amount(), 360.0)
+        with self.assertRaises(ValueError):
+            self.service.purchase(cust, event, "VIP", 1, "Credit Card")
+        self.service.purchase(cust, event, "SingleRacePass", 1, "Credit Card")
+        self.assertTrue(self.service.cancel(cust, res.get_reservation_id()))
+        self.assertFalse(self.service.cancel(cust, "nope"))
+
+        # journaled changes survive without an explicit save
+        reloaded = BookingService(self.tmp.name)
+        cust2 = reloaded.login("ahmed", "pw")
+        self.assertEqual([r.get_reservation_id() for r in cust2.get_reservations()], ["ahmed_2"])
+        # cancelled tickets no longer count as sold
+        self.assertEqual(reloaded.get_system_manager().track_sales(), {"E3": 1})
+
+    def test_crash_without_close_keeps_sold_counts(self):
+        for cache_size in (None, 10):
+            with tempfile.TemporaryDirectory() as tmp:
+                BookingService(tmp).close()
+                service = BookingService(tmp, cache_size=cache_size)
+                cust = service.create_account("ahmed", "pw")
+                event = service.find_event("E1")
+                service.purchase(cust, event, "SingleRacePass", 150, "Credit Card")
+                small = service.purchase(cust, event, "SingleRacePass", 20, "Credit Card")
+                service.cancel(cust, small.get_reservation_id())
+
+                # Reopened without close(): events.pkl still says nothing was sold
+                reloaded = BookingService(tmp, cache_size=cache_size)
+                event = reloaded.find_event("E1")
+                self.assertEqual((event.get_tickets_sold(), event.get_remaining_capacity()), (150, 50))
+                with self.assertRaises(ValueError):
+                    reloaded.purchase(reloaded.login("ahmed", "pw"), event, "SingleRacePass", 150, "Credit Card")
+
+                # A compaction drops the journaled counts only once events.pkl has them
+                reloaded.get_backend().get_customer_store().compact()
+                event = BookingService(tmp, cache_size=cache_size).find_event("E1")
+                self.assertEqual(event.get_tickets_sold(), 150)
+
+    def test_failed_purchase_leaves_nothing_on_disk(self):
+        def fail(customer, reservation):
+            raise OSError("disk full")
+
+        for cache_size in (None, 10):
+            with tempfile.TemporaryDirectory() as tmp:
+                BookingService(tmp).close()
+                service = BookingService(tmp, cache_size=cache_size)
+                backend = service.get_backend()
+                cust = service.create_account("ana", "pw")
+                event = service.find_event("E3")
+                with service.batch():
+                    service.purchase(cust, event, "WeekendPackage", 2, "Credit Card")
+                    backend.reservation_added = fail
+                    with self.assertRaises(OSError):
+                        service.purchase(cust, event, "WeekendPackage", 3, "Credit Card")
+                    del backend.reservation_added
+                self.assertEqual(event.get_tickets_sold(), 2)
+                self.assertEqual(service.get_system_manager().track_sales(), {"E3": 2})
+
+                # Reopened without close(), from the journals alone
+                reloaded = BookingService(tmp, cache_size=cache_size)
+                self.assertEqual(reloaded.find_event("E3").get_tickets_sold(), 2)
+                self.assertEqual(reloaded.get_system_manager().track_sales(), {"E3": 2})
+                self.assertEqual(len(reloaded.login("ana", "pw").get_reservations()), 1)
+
+                # A compaction writes the backend's mirror of the system data
+                backend._compact_system()
+                reloaded = BookingService(tmp, cache_size=cache_size)
+                self.assertEqual(reloaded.get_system_manager().track_sales(), {"E3": 2})
+
+
+class TestSQLiteBackend(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmp.name, "booking.db")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_service_round_trip(self):
+        service = BookingService(backend=SQLiteBackend(self.db))
+        cust = service.create_account("ahmed", "pw", "Ahmed")
+        event = service.find_event("E2")
+        service.purchase(cust, event, "GroupDiscount", 4, "Digital Wallet")
+        res = service.purchase(cust, event, "SingleRacePass", 1, "Credit Card")
+        service.cancel(cust, res.get_reservation_id())
+        service.rename(cust, "Ahmed E.")
+        service.set_discount(Admin("admin", "admin", "Administrator"), "SingleRacePass", 10.0)
+        service.get_backend().close()
+
+        reloaded = BookingService(backend=SQLiteBackend(self.db))
+        cust2 = reloaded.login("ahmed", "pw")
+        self.assertEqual(cust2.get_name(), "Ahmed E.")
+        [res2] = cust2.get_reservations()
+        self.assertEqual(res2.get_ticket_count(), 4)
+        self.assertEqual([t.get_group_size() for t in res2.get_tickets()], [4] * 4)
+        # reservations point at the canonical event, whose sold count was stored
+        # (the cancelled ticket went back to the event)
+        self.assertIs(res2.get_event(), reloaded.find_event("E2"))
+        self.assertEqual(res2.get_event().get_tickets_sold(), 4)
+        self.assertEqual(reloaded.get_system_manager().track_sales(), {"E2": 4})
+        analytics = reloaded.get_system_manager().get_sales_analytics()
+        self.assertEqual(analytics["method"], {"Digital Wallet": [4, 1600.0], "Credit Card": [0, 0.0]})
+        self.assertEqual(reloaded.get_system_manager()._discount_rules, {"SingleRacePass": 10.0})
+        reloaded.get_backend().close()
+
+    def test_failed_transaction_rolls_back(self):
+        backend = SQLiteBackend(self.db)
+        backend.load_events()
+        cust = Customer("ahmed", "pw", "ahmed")
+        backend.account_created(cust)
+        with self.assertRaises(RuntimeError):
+            with backend.batch():
+                backend.account_created(Customer("sultan", "pw", "sultan"))
+                raise RuntimeError("boom")
+        self.assertEqual([c.get_username() for c in backend.load_customers()], ["ahmed"])
+        backend.close()
+
+    def test_failed_purchase_is_undone(self):
+        backend = SQLiteBackend(self.db)
+        service = BookingService(backend=backend)
+        cust = service.create_account("sultan", "pw")
+        event = service.find_event("E3")
+
+        def fail(customer, reservation):
+            raise sqlite3.OperationalError("disk I/O error")
+
+        backend.reservation_added = fail
+        with self.assertRaises(sqlite3.OperationalError):
+            service.purchase(cust, event, "WeekendPackage", 2, "Credit Card")
+        self.assertEqual(event.get_tickets_sold(), 0)
+        self.assertEqual(cust.get_reservations(), [])
+        self.assertEqual(service.get_system_manager().track_sales().get("E3", 0), 0)
+        self.assertEqual(backend._conn.execute("SELECT COUNT(*) FROM sales").fetchone()[0], 0)
+        backend.close()
+
+    def test_concurrent_purchases_and_cancels(self):
+        service = BookingService(backend=SQLiteBackend(self.db))
+        customers = [service.create_account(f"user{i}", "pw") for i in range(8)]
+        event = service.find_event("E1")
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+        def worker(cust):
+            for n in range(60):
+                try:
+                    res = service.purchase(cust, event, "SingleRacePass", 1 + n % 2, "Credit Card")
+                    if n % 3:
+                        service.cancel(cust, res.get_reservation_id())
+                except ValueError:
+                    pass
+
+        threads = [threading.Thread(target=worker, args=(c,), daemon=True) for c in customers]
+        deadline = time.monotonic() + 30
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(max(0.0, deadline - time.monotonic()))
+        finally:
+            sys.setswitchinterval(switch_interval)
+        self.assertFalse(any(t.is_alive() for t in threads), "purchase and cancel threads deadlocked")
+
+        booked = sum(r.get_ticket_count() for c in customers for r in c.get_reservations())
+        self.assertEqual(event.get_tickets_sold(), booked)
+        service.close()
+        reloaded = BookingService(backend=SQLiteBackend(self.db))
+        self.assertEqual(reloaded.find_event("E1").get_tickets_sold(), booked)
+        self.assertEqual(reloaded.get_system_manager().track_sales()["E1"], booked)
+        self.assertEqual(sum(r.get_ticket_count() for c in reloaded.get_customers()
+                             for r in c.get_reservations()), booked)
+        reloaded.get_backend().close()
+
+    def test_migrate_pickles(self):
+        pickles = BookingService(self.tmp.name)
+        cust = pickles.create_account("sultan", "pw")
+        pickles.purchase(cust, pickles.find_event("E3"), "WeekendPackage", 2, "Credit Card")
+        pickles.save()
+        counts = migrate_pickles_to_sqlite(self.tmp.name, self.db)
+        self.assertEqual(counts, {"customers": 1, "events": 3, "reservations": 1})
+
+        backend = SQLiteBackend(self.db)
+        service = BookingService(backend=backend)
+        self.assertEqual(service.login("sultan", "pw").get_reservations()[0].get_total_price(), 360.0)
+        backend.close()
+
+
+class TestBookingServer(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_json_lines_session(self):
+        async def scenario():
+            booking_server = BookingServer(BookingService(self.tmp.name))
+            server = await booking_server.start("127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+            async def call(**request):
+                writer.write(json.dumps(request).encode() + b"\n")
+                await writer.drain()
+                return json.loads(await reader.readline())
+
+            replies = [
+                await call(op="purchase", event="E1", ticket_type="SingleRacePass", qty=1),
+                await call(op="create_account", username="sultan", password="pw"),
+                await call(op="login", username="sultan", password="pw"),
+                await call(op="list_events"),
+                await call(id=7, op="purchase", event="E1", ticket_type="SingleRacePass", qty=3),
+                await call(op="sales_report"),
+                await call(op="login", role="admin", username="admin", password="admin"),
+                await call(op="sales_report"),
+                await call(op="cancel", reservation_id="sultan_1"),
+                await call(op="bogus"),
+            ]
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            await booking_server.close()
+            return replies
+
+        replies = asyncio.run(scenario())
+        self.assertFalse(replies[0]["ok"])
+        self.assertTrue(all(r["ok"] for r in replies[1:5]))
+        self.assertEqual(len(replies[3]["result"]), 3)
+        self.assertEqual(replies[4]["id"], 7)
+        self.assertEqual(replies[4]["result"]["tickets"], 3)
+        self.assertFalse(replies[5]["ok"])
+        self.assertEqual(replies[7]["result"], {"E1": 3})
+        self.assertTrue(replies[8]["ok"])
+        self.assertFalse(replies[9]["ok"])
+
+
+class TestBatchProcessor(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_stream_of_operations(self):
+        lines = [
+            '{"op": "create_account", "username": "ahmed", "password": "pw"}',
+            '{"op": "set_discount", "ticket_type": "SingleRacePass", "amount": 10}',
+            '{"op": "purchase", "username": "ahmed", "event": "E1", "ticket_type": "SingleRacePass", "qty": 2}',
+            'not json',
+            '',
+            '{"op": "purchase", "username": "nobody", "event": "E1", "ticket_type": "SingleRacePass", "qty": 1}',
+            '{"op": "purchase", "username": "ahmed", "event": "E2", "ticket_type": "WeekendPackage", "qty": 1}',
+            '{"op": "cancel", "username": "ahmed", "reservation_id": "ahmed_2"}',
+        ]
+        processor = BatchProcessor(BookingService(self.tmp.name), batch_size=3)
+        results = list(processor.process(read_requests(iter(lines))))
+        self.assertEqual([r["line"] for r in results], [1, 2, 3, 4, 6, 7, 8])
+        self.assertEqual([r["ok"] for r in results], [True, True, True, False, False, True, True])
+        self.assertEqual(results[2]["result"]["paid"], 180.0)
+
+        reloaded = BookingService(self.tmp.name)
+        cust = reloaded.login("ahmed", "pw")
+        self.assertEqual([r.get_reservation_id() for r in cust.get_reservations()], ["ahmed_1"])
+        self.assertEqual(reloaded.get_system_manager().track_sales(), {"E1": 2, "E2": 0})
+
+    def test_batch_is_written_once(self):
+        journal = Journal(os.path.join(self.tmp.name, "test.journal"))
+        with journal.batch():
+            journal.append(("log_sale", "E1", 1))
+            journal.append(("log_sale", "E1", 2))
+            self.assertFalse(os.path.exists(journal.get_path()))
+        self.assertEqual(len(list(journal.replay())), 2)
+
+
+class TestLoadGenerator(unittest.TestCase):
+    def test_percentiles_and_mix(self):
+        values = [float(i) for i in range(1, 101)]
+        self.assertEqual([percentile(values, p) for p in (50, 95, 99, 100)], [50.0, 95.0, 99.0, 100.0])
+        self.assertEqual(parse_mix("login=2, GroupDiscount=1"), {"login": 2.0, "GroupDiscount": 1.0})
+        with self.assertRaises(ValueError):
+            parse_mix("teleport=1")
+
+    def test_spike_never_oversells(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            make_data_dir(tmp, customers=20, events=2, capacity=30)
+            service = BookingService(tmp)
+            usernames = [c.get_username() for c in service.get_customers()]
+            generator = LoadGenerator(service, usernames, workers=8, seed=1,
+                                      mix={"login": 1, "SingleRacePass": 4, "GroupDiscount": 2,
+                                           "cancel": 1, "report": 1})
+            report = generator.run(0.3)
+            service.close()
+        self.assertGreater(report["total"]["count"], 0)
+        self.assertEqual(report["total"]["count"],
+                         sum(s["count"] for s in report["operations"].values()))
+        self.assertGreater(report["sold_out"], 0)
+        self.assertEqual(report["errors"], 0)
+        self.assertEqual(report["oversold"], {})
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+    def test_suite_runs_and_baselines_compare(self):
+        results = benchmarks.run_suite(customers=20, events=3, reservations_per_customer=2, repeat=1)
+        self.assertIn("purchase and cancel", results)
+        self.assertTrue(all(seconds > 0 for seconds in results.values()))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "baseline.json")
+            benchmarks.save_baseline(path, {"customers": 20}, results)
+            benchmarks.save_storage_baseline(path, [100], {"pickle 100 save": 0.01})
+            # Saving the suite again keeps the recorded storage timings
+            benchmarks.save_baseline(path, {"customers": 20}, results)
+            baseline = benchmarks.load_baseline(path)
+        self.assertEqual(baseline["results"], results)
+        self.assertEqual(baseline["storage"]["results"], {"pickle 100 save": 0.01})
+        current = dict(results, login=results["login"] * 1.5, extra=1.0)
+        self.assertEqual(benchmarks.compare_results(results, current, 0.25),
+                         [("login", results["login"], results["login"] * 1.5)])
+        self.assertEqual(benchmarks.compare_results(results, current, 0.6), [])
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry(enabled=True)
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.REGISTRY.reset()
+
+    def test_disabled_registry_records_nothing(self):
+        registry = metrics.Registry()
+        hits = registry.counter("hits_total", "Hits")
+        latency = registry.histogram("latency_seconds", "Latency")
+        hits.inc()
+        latency.observe(0.1)
+        with latency.time():
+            pass
+        self.assertEqual(hits.get(), 0)
+        self.assertEqual(latency.get().count, 0)
+        self.assertIs(registry.counter("hits_total", "Hits"), hits)
+        with self.assertRaises(ValueError):
+            registry.gauge("hits_total", "Hits")
+
+    def test_prometheus_text(self):
+        sold = self.registry.counter("sold_total", "Tickets sold", ("ticket_type",))
+        sold.labels("GroupDiscount").inc(4)
+        self.registry.gauge("seats", "Seats left").set(12)
+        latency = self.registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 2.0):
+            latency.observe(value)
+        text = self.registry.to_prometheus()
+        self.assertIn("# TYPE sold_total counter\n", text)
+        self.assertIn('sold_total{ticket_type="GroupDiscount"} 4\n', text)
+        self.assertIn("seats 12\n", text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 3\n', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 4\n', text)
+        self.assertIn("latency_seconds_count 4\n", text)
+        self.assertAlmostEqual(latency.get().quantile(0.5), 0.55)
+
+    def test_service_is_instrumented(self):
+        metrics.enable()
+        with tempfile.TemporaryDirectory() as tmp:
+            make_data_dir(tmp, customers=2, events=1, capacity=3)
+            service = BookingService(tmp)
+            customer = service.login("user0", "pw")
+            event = service.list_events()[0]
+            res = service.purchase(customer, event, "SingleRacePass", 2, "Credit Card")
+            with self.assertRaises(ValueError):
+                service.purchase(customer, event, "SingleRacePass", 2, "Credit Card")
+            service.cancel(customer, res.get_reservation_id())
+            path = os.path.join(tmp, "metrics.prom")
+            metrics.write_prometheus(path)
+            service.close()
+            with open(path, encoding="utf-8") as f:
+                text = f.read()
+        registry = {m.name: m for m in metrics.REGISTRY.get_metrics()}
+        self.assertEqual(registry["booking_tickets_sold_total"].get("SingleRacePass"), 2)
+        self.assertEqual(registry["booking_sold_out_total"].get(), 1)
+        self.assertEqual(registry["booking_login_seconds"].get().count, 1)
+        self.assertEqual(registry["booking_purchase_seconds"].get().count, 2)
+        self.assertEqual(registry["booking_customers"].get(), 2)
+        self.assertIn("booking_cancel_seconds_count 1\n", text)
+        self.assertIn('booking_seats_remaining{event="E1"}', text)
+
+
+def _busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class TestProfiling(unittest.TestCase):
+    def tearDown(self):
+        profiling.close()
+
+    def test_threshold_and_collapsed_output(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler = profiling.Profiler(tmp, threshold=0.02, operations=("report",),
+                                          interval=0.001, deterministic=True)
+            with profiler.profile("report"):
+                _busy(0.05)
+            with profiler.profile("report"):
+                pass
+            self.assertIs(profiler.profile("purchase"), profiling.profile("purchase"))
+            profiler.close()
+            self.assertEqual(profiler.get_counts(), {"report": (1, 1)})
+            with open(os.path.join(tmp, "report.collapsed"), encoding="utf-8") as f:
+                lines = f.read().splitlines()
+            self.assertTrue(os.path.exists(os.path.join(tmp, "report.pstats")))
+            self.assertTrue(os.path.exists(os.path.join(tmp, "profile.log")))
+        self.assertTrue(any("testcases:_busy" in line for line in lines))
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            self.assertGreater(int(count), 0)
+            self.assertNotIn(" ", stack)
+
+    def test_service_operations_are_profiled(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            make_data_dir(tmp, customers=2, events=1, capacity=10)
+            out = os.path.join(tmp, "profile")
+            profiling.configure(out, operations=("purchase", "save"))
+            service = BookingService(tmp)
+            customer = service.login("user0", "pw")
+            service.purchase(customer, service.list_events()[0], "SingleRacePass", 1, "Credit Card")
+            service.close()
+            profiling.close()
+            self.assertEqual(sorted(os.listdir(out)), ["profile.log", "purchase.collapsed", "save.collapsed"])
+
+
 if __name__ == "__main__":
     unittest.main()
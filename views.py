@@ -0,0 +1,45 @@
+from typing import Dict, List, Optional, Tuple
+
+from objects import Customer, Reservation
+
+# Paged row sources for the GUI's virtual lists. A source has len() and
+# rows(start, stop), so a list only formats the rows in view. Nothing here
+# touches tkinter.
+
+
+# One line per reservation of the current customer. Lines are cached by
+# reservation id (a reservation's tickets don't change after purchase), so
+# scrolling back or reopening the view doesn't add up ticket prices again.
+class ReservationRows:
+    def __init__(self):
+        self._customer: Optional[Customer] = None
+        self._cache: Dict[str, Tuple[Reservation, str]] = {}
+
+    def set_customer(self, customer: Optional[Customer]):
+        if customer is not self._customer:
+            self._customer = customer
+            self._cache.clear()
+
+    def _reservations(self) -> List[Reservation]:
+        return self._customer.get_reservations() if self._customer is not None else []
+
+    def __len__(self) -> int:
+        return len(self._reservations())
+
+    def get(self, index: int) -> Reservation:
+        return self._reservations()[index]
+
+    def rows(self, start: int, stop: int) -> List[str]:
+        return [self.format(res) for res in self._reservations()[start:stop]]
+
+    def format(self, res: Reservation) -> str:
+        cached = self._cache.get(res.get_reservation_id())
+        if cached is not None and cached[0] is res:
+            return cached[1]
+        text = (f"ID: {res.get_reservation_id()} | Event: {res.get_event().get_name()} | "
+                f"Total: ${res.get_total_price():.2f}")
+        self._cache[res.get_reservation_id()] = (res, text)
+        return text
+
+    def get_cache_size(self) -> int:
+        return len(self._cache)
@@ -0,0 +1,134 @@
+import heapq
+import itertools
+import threading
+from typing import Dict, List, Optional
+
+from objects import Customer, Event
+
+# Customers waiting for seats on a sold-out event. Each entry is booked
+# automatically, at the price quoted when it joined, once enough seats
+# come back (cancellations, released or expired holds). Entries live in
+# memory only.
+
+
+class WaitlistEntry:
+    __slots__ = ("_entry_id", "_customer", "_event", "_quantity", "_ticket_type", "_unit_price",
+                 "_discount", "_method", "_priority", "_seq")
+
+    def __init__(self, entry_id: str, customer: Customer, event: Event, quantity: int, ticket_type: str,
+                 unit_price: float, method: str, discount: Optional[float] = None, priority: int = 0):
+        self._entry_id = entry_id
+        self._customer = customer
+        self._event = event
+        self._quantity = quantity
+        self._ticket_type = ticket_type
+        self._unit_price = unit_price
+        self._discount = discount
+        self._method = method
+        self._priority = priority
+        self._seq = 0
+
+    def get_entry_id(self) -> str:
+        return self._entry_id
+
+    def get_customer(self) -> Customer:
+        return self._customer
+
+    def get_event(self) -> Event:
+        return self._event
+
+    def get_quantity(self) -> int:
+        return self._quantity
+
+    def get_ticket_type(self) -> str:
+        return self._ticket_type
+
+    def get_unit_price(self) -> float:
+        return self._unit_price
+
+    def get_discount(self) -> Optional[float]:
+        return self._discount
+
+    def get_method(self) -> str:
+        return self._method
+
+    def get_priority(self) -> int:
+        return self._priority
+
+
+# One heap per event ordered by (-priority, arrival), so higher priorities
+# go first and equal priorities are first come, first served. Entries that
+# leave stay in the heap and are dropped when they reach the top. The head
+# is never skipped: if it needs more seats than are free, those behind it
+# keep waiting too.
+class Waitlist:
+    def __init__(self):
+        self._heaps: Dict[str, List[tuple]] = {}
+        self._entries: Dict[str, WaitlistEntry] = {}
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def next_id(self) -> str:
+        return f"W{next(self._seq)}"
+
+    def get(self, entry_id: str) -> Optional[WaitlistEntry]:
+        return self._entries.get(entry_id)
+
+    def add(self, entry: WaitlistEntry):
+        with self._lock:
+            entry._seq = next(self._seq)
+            self._entries[entry.get_entry_id()] = entry
+            heap = self._heaps.setdefault(entry.get_event().get_event_id(), [])
+            heapq.heappush(heap, (-entry.get_priority(), entry._seq, entry.get_entry_id()))
+
+    # Puts popped entries back at the places they had
+    def requeue(self, entries: List[WaitlistEntry]):
+        with self._lock:
+            for entry in entries:
+                self._entries[entry.get_entry_id()] = entry
+                heap = self._heaps.setdefault(entry.get_event().get_event_id(), [])
+                heapq.heappush(heap, (-entry.get_priority(), entry._seq, entry.get_entry_id()))
+
+    def remove(self, entry_id: str) -> Optional[WaitlistEntry]:
+        with self._lock:
+            return self._entries.pop(entry_id, None)
+
+    # Pops entries from the head of the event's queue while their seats fit
+    # in `seats`; O(log n) per entry popped. The caller holds the event's lock.
+    def pop_fitting(self, event_id: str, seats: int) -> List[WaitlistEntry]:
+        promoted = []
+        with self._lock:
+            heap = self._heaps.get(event_id)
+            while heap:
+                entry = self._entries.get(heap[0][2])
+                if entry is None:
+                    heapq.heappop(heap)  # left the waitlist
+                    continue
+                if entry.get_quantity() > seats:
+                    break
+                heapq.heappop(heap)
+                del self._entries[entry.get_entry_id()]
+                seats -= entry.get_quantity()
+                promoted.append(entry)
+            if heap is not None and not heap:
+                del self._heaps[event_id]
+        return promoted
+
+    # Entries still waiting for the event, in the order they will be served
+    def waiting(self, event_id: str) -> List[WaitlistEntry]:
+        with self._lock:
+            heap = sorted(self._heaps.get(event_id, []))
+            return [self._entries[e[2]] for e in heap if e[2] in self._entries]
+
+    # 1-based place in the event's queue, or None if no longer waiting
+    def position(self, entry_id: str) -> Optional[int]:
+        entry = self._entries.get(entry_id)
+        if entry is None:
+            return None
+        key = (-entry.get_priority(), entry._seq)
+        with self._lock:
+            heap = self._heaps.get(entry.get_event().get_event_id(), [])
+            return 1 + sum(1 for p, s, eid in heap if (p, s) < key and eid in self._entries)